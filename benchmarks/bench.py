@@ -0,0 +1,184 @@
+"""
+bench.py
+
+Measures how long aptly_update.py takes end to end without aptly or the
+internet, so that execution modes can be compared and scheduling regressions
+caught. For each mode it:
+
+  - makes a scratch directory holding a copy of aptly_update.py, its plugins
+    and one copy of benchplugin.py per synthetic plugin,
+  - writes a synthetic YAML file with the requested number of mirrors, entries
+    and plugins, some mirrors being shared between entries,
+  - puts fake_aptly.py on the PATH as 'aptly', with upstream InRelease files
+    served from a local HTTP server,
+  - runs the script and reports wall time, peak memory (of the script itself)
+    and how many aptly processes were started.
+
+Usage:
+
+    python benchmarks/bench.py --mirrors 200 --entries 40 --plugins 20
+
+With --warm, each mode is run twice in the same directory and only the second
+run is measured; --changed says what fraction of the mirrors change upstream in
+between. See --help for the rest.
+"""
+
+import argparse
+import os
+import random
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import yaml
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SOURCE = os.path.join(HERE, "..", "src", "aptly_update")
+
+MODES = {'serial':   {'jobs': 1, 'jobs_per_host': 1},
+         'parallel': {},
+         'batch':    {'batch': True}}
+
+def main():
+    args = parse_args()
+    upstream = Upstream()
+    print("mode".ljust(10) + "wall (s)".rjust(10) + "peak RSS (MiB)".rjust(16) + "aptly spawns".rjust(14) + "exit".rjust(6))
+    for mode in args.modes.split(','):
+        wall, rss, spawns, status = run(mode, args, upstream)
+        print(mode.ljust(10) + ("%.2f" % wall).rjust(10) + ("%.1f" % (rss / 1024)).rjust(16)
+              + str(spawns).rjust(14) + str(status).rjust(6))
+    upstream.server.shutdown()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark aptly_update.py against a fake aptly.")
+    parser.add_argument('--mirrors', type=int, default=200, help='number of mirrors')
+    parser.add_argument('--entries', type=int, default=40, help='number of publish entries')
+    parser.add_argument('--plugins', type=int, default=20, help='number of plugins')
+    parser.add_argument('--shared', type=float, default=0.2,
+                        help='fraction of entries that also merge a mirror of another entry')
+    parser.add_argument('--modes', default=",".join(MODES), help='comma separated: ' + ", ".join(MODES))
+    parser.add_argument('--jobs', type=int, help='override jobs for every mode')
+    parser.add_argument('--hosts', type=int, default=4, help='number of upstream hosts')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per aptly command')
+    parser.add_argument('--update-latency', type=float, default=1, help='seconds per mirror update')
+    parser.add_argument('--plugin-latency', type=float, default=1, help='seconds per plugin download')
+    parser.add_argument('--output', type=int, default=10000, help='bytes of output per mirror update')
+    parser.add_argument('--fail', type=float, default=0, help='fraction of aptly commands that fail')
+    parser.add_argument('--warm', action='store_true', help='measure a second run over the same state')
+    parser.add_argument('--changed', type=float, default=0.1,
+                        help='with --warm, fraction of mirrors that change between the runs')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the configuration')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch directories')
+    return parser.parse_args()
+
+def make_config(args):
+# Mirrors are dealt out to the entries in turn and plugins likewise. A fraction
+# of the entries also merge a mirror belonging to another entry, as
+# bookworm-security is both published alone and merged into bookworm.
+    rng = random.Random(args.seed)
+    entries = [{'name': "dist-" + str(i), 'mirrors': []} for i in range(args.entries)]
+    for i in range(args.mirrors):
+        entries[i % args.entries]['mirrors'].append("mirror-" + str(i))
+    for entry in rng.sample(entries, int(args.shared * args.entries)):
+        other = rng.choice(entries)
+        if other is not entry and other['mirrors']:
+            entry['mirrors'].append(other['mirrors'][0])
+    for i in range(args.plugins):
+        name = "bench_plugin_" + str(i)
+        entries[i % args.entries].setdefault('plugins', []).append({name: {'name': name}})
+    return [entry for entry in entries if entry['mirrors']]
+
+class Upstream:
+# Serves /debian/dists/<mirror>/InRelease for every mirror. The content depends
+# on a generation number per mirror, which is bumped to make it change.
+    def __init__(self):
+        generations = self.generations = {}
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+            def do_GET(self):
+                mirror = self.path.strip('/').split('/')[-2]
+                body = (mirror + " " + str(generations.get(mirror, 0)) + "\n").encode()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+        self.server = ThreadingHTTPServer(('', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.port = self.server.server_port
+
+    def change(self, fraction, mirrors, rng):
+        for i in rng.sample(range(mirrors), int(fraction * mirrors)):
+            self.generations["mirror-" + str(i)] = self.generations.get("mirror-" + str(i), 0) + 1
+
+def setup(directory, args, mode):
+    shutil.copy(os.path.join(SOURCE, "aptly_update.py"), directory)
+    shutil.copy(os.path.join(SOURCE, "downloads.py"), directory)
+    shutil.copytree(os.path.join(SOURCE, "plugins"), os.path.join(directory, "plugins"))
+    for i in range(args.plugins):
+        shutil.copy(os.path.join(HERE, "benchplugin.py"),
+                    os.path.join(directory, "plugins", "bench_plugin_" + str(i) + ".py"))
+    bin = os.path.join(directory, "bin")
+    os.mkdir(bin)
+    aptly = os.path.join(bin, "aptly")
+    with open(aptly, "w") as wrapper:
+        wrapper.write("#!" + sys.executable + "\n")
+        with open(os.path.join(HERE, "fake_aptly.py")) as fake:
+            wrapper.write(fake.read())
+    os.chmod(aptly, os.stat(aptly).st_mode | stat.S_IEXEC)
+    settings = dict(MODES[mode], retry_backoff=0, locked_wait=1)
+    if args.jobs:
+        settings['jobs'] = args.jobs
+    with open(os.path.join(directory, "bench.yaml"), "w") as yaml_file:
+        yaml.safe_dump([{'settings': settings}] + make_config(args), yaml_file)
+
+def run(mode, args, upstream):
+# Returns wall time, peak RSS in KiB, aptly processes started and exit status
+# of the measured run of one mode.
+    directory = tempfile.mkdtemp(prefix="aptly-bench-" + mode + "-")
+    try:
+        setup(directory, args, mode)
+        if args.warm:
+            run_once(directory, args, upstream)
+            upstream.change(args.changed, args.mirrors, random.Random(args.seed))
+        return run_once(directory, args, upstream)
+    finally:
+        if args.keep:
+            print("Kept " + directory)
+        else:
+            shutil.rmtree(directory)
+
+def run_once(directory, args, upstream):
+    spawns = os.path.join(directory, "spawns")
+    if os.path.exists(spawns):
+        os.remove(spawns)
+    env = dict(os.environ,
+               PATH=os.path.join(directory, "bin") + os.pathsep + os.environ.get('PATH', ""),
+               FAKE_APTLY_LATENCY=str(args.latency),
+               FAKE_APTLY_UPDATE_LATENCY=str(args.update_latency),
+               FAKE_APTLY_OUTPUT=str(args.output),
+               FAKE_APTLY_FAIL=str(args.fail),
+               FAKE_APTLY_HOSTS=str(args.hosts),
+               FAKE_APTLY_MIRRORS=str(args.mirrors),
+               FAKE_APTLY_UPSTREAM=str(upstream.port),
+               FAKE_APTLY_SPAWNS=spawns,
+               FAKE_APTLY_DB=os.path.join(directory, "db.lock"),
+               FAKE_PLUGIN_LATENCY=str(args.plugin_latency))
+    start = time.monotonic()
+    process = subprocess.Popen([sys.executable, "aptly_update.py", "-y", "bench.yaml"],
+                               cwd=directory, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    pid, status, usage = os.wait4(process.pid, 0)
+    wall = time.monotonic() - start
+    count = 0
+    if os.path.exists(spawns):
+        with open(spawns) as spawn_file:
+            count = sum(1 for line in spawn_file)
+    return wall, usage.ru_maxrss, count, os.waitstatus_to_exitcode(status)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,18 @@
+"""
+benchplugin.py
+
+A plugin for benchmarking. It pretends to download for FAKE_PLUGIN_LATENCY
+seconds (default 1), then adds to its repo and snapshots it, as vscode.py does.
+bench.py copies it into the plugins directory once for every plugin in the
+synthetic configuration, because the name of a plugin is the name of its module.
+"""
+
+import os
+import time
+
+def fetch_repo(args):
+    name = args['name']
+    time.sleep(float(os.environ.get('FAKE_PLUGIN_LATENCY', 1)))
+    args['backend'].repo_add(name, [name + ".deb"])
+    args['backend'].snapshot_from_repo(name + "-" + args['timestamp'], name)
+    return {'bytes': 0}
@@ -0,0 +1,150 @@
+"""
+fake_aptly.py
+
+A stand-in for the aptly binary, for benchmarking aptly_update.py without aptly
+or the internet. bench.py installs it on the PATH as 'aptly'. It understands just
+enough of the command line for aptly_update.py and behaves according to these
+environment variables:
+
+    FAKE_APTLY_LATENCY         seconds each command takes (default 0.05)
+    FAKE_APTLY_UPDATE_LATENCY  seconds a mirror update takes (default 1)
+    FAKE_APTLY_OUTPUT          bytes of output from a mirror update (default 10000)
+    FAKE_APTLY_FAIL            fraction of commands that fail (default 0)
+    FAKE_APTLY_HOSTS           number of upstream hosts mirrors are spread over (default 4)
+    FAKE_APTLY_MIRRORS         number of mirrors, mirror-0 to mirror-<n - 1> (default 0)
+    FAKE_APTLY_UPSTREAM        port of bench.py's fake upstream server
+    FAKE_APTLY_SPAWNS          file to which a line is appended for every process started
+    FAKE_APTLY_DB              lock file standing in for aptly's database (default none)
+    FAKE_APTLY_DB_WAIT         seconds between tries at opening it (default 0.1)
+
+With FAKE_APTLY_DB, the database is locked as aptly's LevelDB is: one process
+at a time, and a process that cannot open it gives up after 10 tries (aptly's
+-db-open-attempts). A mirror update lets go of it while it downloads, but not
+while it reads the indexes, the first tenth of the time, or while it records
+what it got, the last tenth.
+"""
+
+import contextlib
+import os
+import random
+import sys
+import time
+
+HELD = [] # The open database, while this process has it
+
+class Locked(Exception):
+    pass
+
+@contextlib.contextmanager
+def database():
+    path = os.environ.get('FAKE_APTLY_DB')
+    if not path or HELD:
+        yield
+        return
+    import fcntl
+    db = open(path, "a")
+    try:
+        for attempt in range(10):
+            try:
+                fcntl.flock(db, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                time.sleep(env('FAKE_APTLY_DB_WAIT', 0.1))
+        else:
+            raise Locked()
+        HELD.append(db)
+        try:
+            yield
+        finally:
+            HELD.remove(db)
+    finally:
+        db.close()
+
+def env(name, default):
+    return float(os.environ.get(name, default))
+
+def archive_root(name):
+    # Mirrors are called mirror-<n> and spread over 127.0.0.1, 127.0.0.2 etc,
+    # which all reach bench.py's upstream server but count as different hosts.
+    number = int(name.rsplit('-', 1)[-1]) if name.rsplit('-', 1)[-1].isdigit() else 0
+    host = "127.0.0." + str(1 + number % int(env('FAKE_APTLY_HOSTS', 4)))
+    port = os.environ.get('FAKE_APTLY_UPSTREAM')
+    return "http://" + host + ":" + port + "/debian/" if port else ""
+
+def mirror_show(name):
+    print("Name: " + name)
+    print("Archive Root URL: " + archive_root(name))
+    print("Distribution: " + name)
+    print("Components: main")
+
+def mirror_list():
+    print("List of mirrors:")
+    for i in range(int(env('FAKE_APTLY_MIRRORS', 0))):
+        name = "mirror-" + str(i)
+        print(" * [" + name + "]: " + archive_root(name) + " " + name)
+
+def command(argv):
+    # Runs one aptly command and returns its exit code.
+    try:
+        if argv[:2] == ['mirror', 'update']:
+            return mirror_update(argv)
+        with database():
+            return run(argv)
+    except Locked:
+        print("ERROR: can't open database: resource temporarily unavailable")
+        return 1
+
+def mirror_update(argv):
+    latency = env('FAKE_APTLY_UPDATE_LATENCY', 1)
+    with database():
+        time.sleep(latency / 10)
+    time.sleep(latency * 8 / 10)
+    with database():
+        time.sleep(latency / 10)
+        size = int(env('FAKE_APTLY_OUTPUT', 10000))
+        print("Download queue: 25 items (" + "%.2f" % (size / 1048576) + " MiB)")
+        line = "Downloading http://upstream/pool/main/p/package/package_1.0_amd64.deb...\n"
+        sys.stdout.write(line * (size // len(line)))
+        return result(argv)
+
+def run(argv):
+    if argv[:2] == ['mirror', 'show']:
+        mirror_show(argv[2])
+        return 0
+    if argv[:2] == ['mirror', 'list']:
+        mirror_list()
+        return 0
+    if argv[:2] == ['publish', 'list'] or argv[:2] == ['snapshot', 'list']:
+        return 0
+    if argv[:2] == ['task', 'run']:
+        return task_run(argv[2][len('-filename='):])
+    time.sleep(env('FAKE_APTLY_LATENCY', 0.05))
+    return result(argv)
+
+def result(argv):
+    if random.random() < env('FAKE_APTLY_FAIL', 0):
+        print("ERROR: simulated failure of " + " ".join(argv))
+        return 1
+    print(" ".join(argv) + " done")
+    return 0
+
+def task_run(filename):
+    with open(filename) as task_file:
+        cmds = [line.split() for line in task_file if line.strip()]
+    failed = False
+    for i, argv in enumerate(cmds):
+        if failed:
+            print(str(i + 1) + ") [Skipping]: " + " ".join(argv))
+            continue
+        print(str(i + 1) + ") [Running]: " + " ".join(argv))
+        print("Begin command output: ----------------------------")
+        failed = command(argv) != 0
+        print("End command output: ------------------------------")
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    spawns = os.environ.get('FAKE_APTLY_SPAWNS')
+    if spawns:
+        with open(spawns, "a") as spawn_file:
+            spawn_file.write(" ".join(sys.argv[1:3]) + "\n")
+    sys.exit(command(sys.argv[1:]))
@@ -9,7 +9,8 @@ Usage:
 where <yaml file> is the name of the YAML file containing the configuration.
 The -d flag can be used for debug mode. No updates will take place, but the
 commands that would be sent to Aptly and the internet will be printed to the
-screen.
+screen. The -j flag sets how many mirrors are updated at once, overriding the
+YAML settings described below.
 
 Log files:
 
@@ -69,6 +70,258 @@ about 4 minutes, so the 600 seconds timeout should be plenty. You may be faster
 or slower. The path is where the download will be stored; again, this will be
 dependent on your implementation.
 
+Settings:
+
+An entry called 'settings' instead of 'name' holds options for the whole run
+rather than a publication. It can go anywhere in the file and is optional.
+
+- 
+  settings:
+    jobs: 6
+    jobs_per_host: 2
+
+Mirror updates are mostly waiting on the network, so they are run in parallel.
+'jobs' is the most that will run at once (default 4) and 'jobs_per_host' the
+most that will hit any one upstream server (default 2), which keeps us polite
+to deb.debian.org and friends. Plugins run at the same time as the mirror
+updates, as their downloads come from other servers; 'plugin_jobs' is the most
+that will run at once (default 4). Anything that changes the aptly database,
+other than a mirror update, waits its turn. aptly lets go of its database
+while a mirror update downloads packages, but not while it reads the indexes
+or records what it got, so with the command line a step that finds the
+database locked by another aptly process is run again, every 15 seconds up to
+10 times. With 'backend: api' (see Talking to aptly) the server keeps the
+database itself and this does not happen.
+
+How a run is worked out:
+
+Before anything is run, the entries are turned into a graph of steps: update
+each mirror, snapshot it, run each plugin, merge the snapshots of an entry and
+publish the result. A mirror or plugin named in several entries, for example
+bookworm-security published on its own and also merged into bookworm, is
+updated and snapshotted once, and both entries use that snapshot. A plugin is
+configured by the first entry that names it. Each step starts as soon as the
+steps it needs have finished, so one entry can publish while another is still
+downloading. Steps that change the aptly database (snapshots, merges and
+publishing) run one at a time. If a step fails, the steps that need it are
+skipped.
+
+The yaml is checked before anything is done. An entry without a name or a list
+of mirrors, a mirror that aptly does not have (aptly is asked once, with
+'aptly mirror list') or a plugin that cannot be loaded stops the run at once.
+The steps are kept in a file next to the log files, named after the script
+with '-plan.json' on the end, or wherever 'plan_file' in the settings says, and
+used again while neither the yaml nor the mirror list has changed.
+
+    aptly_update.py --plan -y <yaml file>
+
+prints the steps as JSON, each with an estimate of how long it will take, the
+average over the last 10 runs in which it was done, and an estimate for the
+whole run, then exits without doing anything.
+
+Priorities and the deadline:
+
+An entry can be given a 'priority', a number, which is 0 if it is not given.
+Steps are started most important first, so with
+
+- 
+  name: bookworm-security
+  priority: 10
+  mirrors:
+    - bookworm-security
+
+the security mirror is updated before the others and published as soon as it
+is ready. A mirror or plugin shared by several entries has the priority of the
+most important. Among steps of the same priority, those with the most work
+still to do after them, going by how long each step took on past runs, start
+first, so that the long mirrors are not left until last.
+
+    aptly_update.py --deadline 06:00 -y <yaml file>
+
+or 'deadline' in the settings, gives the time by which the run should be over,
+for example before clients start their unattended upgrades. A step of an entry
+with priority 0 or less that would not get its entry published by then, going
+by past runs, is skipped, as are the steps that need it, and the entries that
+were not published because of this are listed at the end. Entries with a
+priority above 0 are always done, however late. A deadline that has already
+passed when the run starts is taken to be the next day's, with a warning.
+
+Running as a daemon:
+
+    aptly_update.py --daemon -y <yaml file>
+
+keeps running instead of doing one run and exiting, so that security updates
+can be published within minutes of their release rather than the next night.
+An entry with a 'poll', in minutes, is run that often:
+
+- 
+  name: bookworm-security
+  priority: 10
+  poll: 10
+  mirrors:
+    - bookworm-security
+
+and the rest once a day at 'nightly' in the settings (default 03:00). A mirror
+whose upstream has not changed is not updated, so polling costs one download
+of its InRelease file. The plugins, the plan and the state are kept between
+runs rather than loaded each time, and the yaml is read again when it changes;
+a yaml with a mistake in it is reported and the last good one kept. Each run
+has its own timestamp and log file. Old snapshots and the download store are
+only culled by the nightly runs. SIGTERM stops the daemon once the run in
+progress is over.
+
+Publishing:
+
+An entry that is already published is switched over to its new snapshot with
+'aptly publish switch', so clients never see it missing and aptly only
+regenerates the indexes that have changed. It is only dropped and published
+from scratch the first time, or if the switch fails. Setting 'publish_mode' to
+'drop' in the settings goes back to always dropping and publishing. Debug mode
+does not ask aptly what is published, so it always shows a drop and publish.
+
+Talking to aptly:
+
+By default every operation runs the aptly command line. With 'backend: api'
+in the settings the script talks to 'aptly api serve' at 'api_url' instead
+(default http://localhost:8080), which saves starting aptly and opening its
+database for every step, and stops the steps fighting over the database lock.
+Plugins are given the backend as 'backend' in their dictionary and should use
+it for anything that changes aptly.
+
+With 'batch: true' in the settings, the command line is started as few times
+as possible. Mirror updates still run one per process, in parallel. Once they
+have all finished, the snapshots are sent to aptly together in one 'aptly task
+run', then the merges, then the publishing. How each command did is written to the
+log file after the task's own output.
+
+Commands:
+
+aptly is run without a shell and its output is copied to the log file as it
+arrives, between '==>' and '<==' lines giving the command, its exit code and how
+long it took. A step whose command fails fails too, and the steps after it are
+skipped rather than publishing something half done. 'update_timeout' and
+'command_timeout' kill mirror updates and other aptly commands that take more
+than that many seconds (default: never). 'update_retries' and
+'command_retries' say how many more times to try a command that fails (default
+1 for updates, 0 for the rest), waiting 'retry_backoff' seconds (default 30)
+and doubling the wait each time. A command that fails because another aptly
+process has the database open is tried again up to 'locked_retries' more times
+(default 10), 'locked_wait' seconds apart (default 15), without counting
+against those retries and without holding up the other aptly commands while it
+waits.
+
+Mirror options:
+
+A mirror can be given options by writing it as a dictionary, and options for
+every mirror can go in the settings as 'mirror_options'. A mirror's own options
+win, and a mirror named by several entries takes its options from the first.
+
+- 
+  settings:
+    mirror_options:
+      download_concurrency: auto
+- 
+  name: bookworm
+  mirrors:
+    - bookworm-main:
+        download_limit: 2048
+        skip_existing_packages: true
+    - bookworm-security
+
+'download_limit' (KiB/s), 'max_tries' and 'skip_existing_packages' are passed
+to 'aptly mirror update' as the flags of the same names. 'download_concurrency'
+and 'download_retries' can only be set in aptly's configuration file, so the
+update is given a copy of it, ~/.aptly.conf or /etc/aptly.conf or wherever
+'aptly_config' in the settings says, with them changed. The API backend cannot
+do this, and ignores them.
+
+'download_concurrency: auto' starts at aptly's default of 4 and then moves the
+concurrency up or down by one each run, following the download rate of the last
+run, which is kept in the state file. It keeps going while the rate holds up
+and turns back when it drops, so each mirror settles near the most its upstream
+will take, up to 'max_download_concurrency' (default 16).
+
+Bandwidth:
+
+'bandwidth' in the settings is the most, in KiB/s, that the whole run may
+download at once, so that a run in working hours leaves room for everyone else.
+
+- 
+  settings:
+    bandwidth: 8192
+
+Each mirror update is given a share of it as its 'download_limit' when it
+starts: the total split equally between the updates that can run at once and
+the plugins, but no more than the updates already running have left, and no
+more than the mirror's own 'download_limit'. The plugins share what the running
+updates are not using, which changes as they start and finish, and never less
+than an equal share while any are left to run. An update that would get less
+than 1 KiB/s waits for another to finish rather than going over. A plugin keeps
+to it by calling bandwidth.take(size), or 'await ctx.throttle(size)', with the
+size of each chunk it downloads; 'bandwidth' is None when there is no budget.
+As aptly fixes the limit for the length of an update, the shares are only
+rebalanced as updates start and finish. Without 'bandwidth' nothing is limited
+except by the mirrors' own options.
+
+History:
+
+Every update, snapshot, merge, publish and plugin of every run is recorded in a
+SQLite database next to the log files, named after the script with
+'-history.db' on the end, or wherever 'history' in the settings says. Each has
+its start and end times, how long it took, whether it worked and, where aptly
+or the plugin says, how much was downloaded. Setting 'history' to null turns
+this off. Debug runs are not recorded.
+
+    aptly_update.py --report [RUNS] [-y <yaml file>]
+
+prints how long each mirror has taken to update over the last RUNS runs
+(default 10) and the slowest steps, then exits without updating anything.
+
+Metrics:
+
+    aptly_update.py --metrics <file> -y <yaml file>
+
+or 'metrics' in the settings writes what the run did to <file> at the end of
+it, in the OpenMetrics text format: how long each mirror update took and its
+exit status (0 if it worked, else what aptly returned), how much each plugin
+downloaded and how long it took, how long each publish took, how long the run
+took and how many snapshots aptly has. It also has, for every distribution
+the state file knows of, when it was last published or found to be up to
+date, which is kept in the state file, so that a distribution going stale can
+be alerted on even when the runs themselves are not failing. Point it at a
+'.prom' file in node_exporter's textfile collector directory; it is written
+to a temporary file and renamed, so the collector never reads half of it.
+With --daemon each run writes the file afresh, with the steps of that run.
+Debug runs do not write it.
+
+Tracing:
+
+    aptly_update.py --trace <file> -y <yaml file>
+
+writes a timeline of the run to <file> as Chrome Trace Event JSON, which
+Perfetto (https://ui.perfetto.dev) or chrome://tracing can open. Reading the
+yaml, checking it, working out the plan, every step and the clean-up at the
+end each get a span, as do the parts of a step: fetching the upstream
+InRelease and updating a mirror, and switching, dropping and publishing a
+distribution. Plugins add spans of their own, vscode.py and http_deb.py for
+each HEAD request, download, repo add and snapshot. Each thread has a lane of
+its own, and so does each async plugin, with the spans nested inside the step
+they are part of, so idle workers and steps waiting on one another are easy to
+see. With --daemon each run writes the file afresh.
+
+Skipping what has not changed:
+
+The checksum of each mirror's upstream InRelease (or Release) file is kept in a
+state file, next to the log files and named after the script with '-state.json'
+on the end, or wherever 'state_file' in the settings says. If upstream has not
+changed since the last run, the mirror is not updated and the snapshot made last
+time is used again. If nothing going into an entry has changed, its merge and
+publish are skipped too, which saves re-signing an unchanged distribution.
+A plugin counts as changed unless it says otherwise (see Plugins). --force
+ignores the state file, so everything is updated and published, and the state
+is rewritten from scratch. In debug mode upstream is not checked and the state
+file is not written.
+
 Plugins:
 
 It is impossible to define what information a plugin will need or the commands that
@@ -79,10 +332,83 @@ in the parent directory.
 
 The name of the plugin is also the name of the snapshot that will be used. The yaml
 must contain all the information the plugin needs, in a format that will result in
-a dictionary containing the correct data structure. Three key/value pairs will be
-added, 'timestamp', 'logfile' and 'debug'. This dictionary will be the only
-parameter passed to the plugin. The plugin must contain a function called 'fetch_repo'
-that will accept the dictionary as its only parameter.
+a dictionary containing the correct data structure. Eight key/value pairs will be
+added, 'timestamp', 'logfile', 'debug', 'backend', 'bandwidth', 'store',
+'repo_index' and 'trace'. This dictionary will be the only parameter passed to
+the plugin. The plugin must contain a function called 'fetch_repo' that will
+accept the dictionary as its only parameter.
+
+Alternatively, 'fetch_repo' can be a coroutine, 'async def fetch_repo(ctx)'. It
+is then given a context instead of the dictionary, with the dictionary as
+'ctx.args', an HTTP client shared by all plugins as 'ctx.http' (this needs
+aiohttp), 'ctx.limit(url)' to keep to the per-host connection limit,
+'ctx.run()' and 'ctx.aptly()' to run commands and call the backend,
+'ctx.throttle(size)' to keep to the bandwidth budget, 'ctx.span(name)' to
+add to the --trace timeline, and 'ctx.log()'. All plugins run on one event
+loop, the plain ones in a pool of 'plugin_jobs' threads, so async plugins do
+not need a thread each. See PluginContext below. Either kind of plugin may
+return a dictionary saying what it did, with any of these keys, or nothing if
+it made the snapshot named after it and the timestamp. A plugin that fails must
+raise an exception, so that its step fails and the entries that need it are
+skipped rather than published without it:
+
+    bytes     the number of bytes it downloaded, which is recorded in the history
+    snapshot  the snapshot to use, if it is not the plugin name and the timestamp,
+              for example one from an earlier run
+    changed   False if nothing has changed since the last run, so that the entry
+              need not be published again if nothing else has changed either
+    inputs    the snapshots 'snapshot' was merged from, if the plugin made
+              several, so that they are kept while it is in use
+
+A plugin can also be installed as a package, with an entry point in the
+'aptly_update.plugins' group named after the plugin. One in the plugins
+subdirectory is used in preference to an installed one of the same name.
+
+Every plugin named in the yaml is loaded, and its parameters checked, before
+anything else is done, so a missing plugin or a mistake in its parameters stops
+the run straight away rather than after the mirrors have been updated. A plugin
+says what it takes with SCHEMA, a dictionary of the parameters it accepts and
+their types, and REQUIRED, the ones that must be given, and can have a
+function check(args) that returns a list of anything else wrong with them (see
+PluginRegistry below, vscode.py and http_deb.py). A plugin that declares none
+of these is not checked.
+
+'repo_index' knows what the local repos hold, and is read from aptly once per
+run, however many plugins ask. A plugin should add its files with
+repo_index.add(repo, files) rather than through the backend: only the packages
+not already in the repo are added, all in one 'aptly repo add', and if none
+are, it can leave the repo's snapshot as it was (see RepoIndex below).
+
+Two plugins come with aptly-update: vscode, for Visual Studio Code, and http_deb,
+for any number of .deb packages that vendors publish at a fixed URL, each added
+to a repo of its own. See their documentation for their parameters. What they
+share for downloading is in downloads.py, next to this script, which other
+plugins can import as well.
+
+Download store:
+
+Plugins download a new file whenever upstream has a new version, and left to
+themselves would keep every one of them. With a download store they keep them
+in one directory instead, under their SHA-256, and hardlink them into their own
+directories, so a file is only kept once however many plugins or names it has.
+
+- 
+  settings:
+    download_store:
+      path: /media/thumb/aptly/store
+      keep_last: 3
+      max_size: 4096
+
+A file whose SHA-256 is known before it is downloaded, from a checksum URL, and
+that is already in the store is not downloaded again, and one that has already
+been added to a repo is not added again, whatever it is called now. At the end
+of each run the store keeps the 'keep_last' most recently used versions of each
+package, and then drops the least recently used files until it is no bigger
+than 'max_size' MiB; either may be left out. Files used in the run are always
+kept. A file is removed with the links to it. The store should be on the same
+filesystem as the plugins' directories, as otherwise the files are copied
+rather than linked. The store is given to plugins as 'store' (see
+DownloadStore below), and is None without 'download_store'.
 
 Aptly configuration:
 
@@ -95,8 +421,23 @@ Aptly snapshots:
 
 The aptly documentation states that snapshots use no space. A new snapshot is created
 for every mirror, for every plugin and for every repo that contains more than one
-mirror and/or plugin. This can lead to the snapshot list being hard to read and
-manual culling is advised.
+mirror and/or plugin. Left alone, the snapshot list grows without end, aptly gets
+slower and the pool keeps packages nothing needs any more. A retention policy in
+the settings has the script cull them at the end of each run:
+
+- 
+  settings:
+    retention:
+      keep_last: 5
+      keep_days: 30
+
+For each mirror, plugin and publication, the newest 'keep_last' snapshots are
+kept, and any made in the last 'keep_days' days; either may be left out. Only
+snapshots named by this script, a name followed by a timestamp, are dropped,
+and never one that is published, one the state file may use again or one from
+this run. The rest are dropped together and 'aptly db cleanup' then deletes the
+packages nothing refers to. The number of snapshots dropped and the disk space
+freed are printed. Without 'retention' nothing is dropped.
 
 """
 
@@ -106,10 +447,67 @@ import sys
 import yaml
 import datetime
 import platform
+import concurrent.futures
+import urllib.parse
+import urllib.request
+import hashlib
+import json
+import os
+import threading
+import time
+import requests
+import collections
+import sqlite3
+import asyncio
+import re
+import tempfile
+import shutil
+import tarfile
+import io
+import signal
+import contextlib
 
 TIMESTAMP = datetime.datetime.now().strftime("%Y%m%dT%H:%M:%S")
 LOGFILE   = sys.argv[0] + "-run-" + TIMESTAMP
+STATEFILE = sys.argv[0] + "-state.json"
+HISTORY   = sys.argv[0] + "-history.db"
+PLANFILE  = sys.argv[0] + "-plan.json"
+PLUGIN_GROUP = 'aptly_update.plugins' # entry points of installed plugins
+LATE = 18 * 3600 # A deadline further off than this has most likely just passed
+SIZE_UNITS = {'B': 1, 'KiB': 1 << 10, 'MiB': 1 << 20, 'GiB': 1 << 30, 'TiB': 1 << 40}
 SEPARATOR = "\\" if platform.system() == "Windows" else "/" # Because I'm developing on Windows
+DEFAULT_SETTINGS = {'jobs': 4,              # mirror updates running at once
+                    'jobs_per_host': 2,     # of which against any one upstream host
+                    'plugin_jobs': 4,       # plugins running at once
+                    'state_file': STATEFILE,
+                    'history': HISTORY,       # SQLite file of past runs, or None
+                    'plan_file': PLANFILE,    # where the compiled plan is kept, or None
+                    'publish_mode': 'switch', # or 'drop' to drop and publish again
+                    'backend': 'cli',         # or 'api' to use 'aptly api serve'
+                    'batch': False,           # run the cli in batches with 'aptly task run'
+                    'update_timeout': None,   # seconds before a mirror update is killed
+                    'update_retries': 1,      # times a failed mirror update is tried again
+                    'command_timeout': None,  # the same for other aptly commands
+                    'command_retries': 0,
+                    'retry_backoff': 30,      # seconds before the first retry, doubling
+                    'locked_retries': 10,     # times a command is tried again while aptly's database is locked
+                    'locked_wait': 15,        # seconds between them
+                    'retention': None,        # {'keep_last': N, 'keep_days': N}, or None to keep everything
+                    'mirror_options': {},     # options for every mirror, see MIRROR_OPTIONS
+                    'aptly_config': None,     # aptly's configuration file, if not the usual one
+                    'deadline': None,         # 'HH:MM' by which the run should be done
+                    'nightly': '03:00',       # when --daemon runs the entries without a 'poll'
+                    'bandwidth': None,        # KiB/s for all downloads together, or None for no limit
+                    'download_store': None,   # {'path': dir, 'keep_last': N, 'max_size': MiB}, or None
+                    'metrics': None,          # OpenMetrics file written at the end of each run, or None
+                    'api_url': 'http://localhost:8080'}
+
+MIRROR_OPTIONS = {'download_concurrency': (int, str), # downloads at once, or 'auto'
+                  'max_download_concurrency': int,   # the most 'auto' will go to (default 16)
+                  'download_retries': int,
+                  'download_limit': int,             # KiB/s
+                  'max_tries': int,
+                  'skip_existing_packages': bool}
 
 def main():
 # Parses command line arguments using parse_args().
@@ -119,46 +517,2011 @@ def main():
 # For each top-level key, it updates and publishes a Debian mirror using Aptly.
 #   Within each such key, it adds to the repo all named mirrors provided by 
 #   other mirrors and adds any applications for which a plugin is specified.
+# The entries are checked, with one 'aptly mirror list', and compiled into a
+# Plan first, so that a mistake stops the run before anything is done and a
+# mirror or plugin shared between entries is only done once. build_graph()
+# turns the plan into a graph of steps, which is run by run_graph().
+# With --daemon, a Daemon runs the entries on its schedule instead.
     args = parse_args()
-    if args.yaml is None:
+    if args.yaml is None and args.report is not None:
+        print_report(History(HISTORY), args.report)
+    elif args.yaml is None:
             print("No YAML file specified. Dying.")
             sys.exit(1)
+    elif args.daemon:
+        Daemon(args).run()
+    else:
+        trace = Trace(args.trace)
+        with trace.span("read config"):
+            text, config, settings, entries = read_config(args.yaml[0], args)
+        if args.report is not None:
+            print_report(History(settings['history']), args.report)
+            return
+        backend = make_backend(settings, args.debug)
+        with trace.span("check config"):
+            mirrors, problems = list_mirrors(backend, args.debug)
+            registry = PluginRegistry(args.debug)
+            problems = problems or check_config(entries, mirrors, settings, registry)
+        if problems:
+            for problem in problems:
+                print("Error: " + problem)
+            sys.exit(1)
+        with trace.span("plan"):
+            plan = get_plan(text, entries, mirrors, settings, args.debug, backend)
+        if args.plan:
+            known = settings['history'] and os.path.exists(settings['history'])
+            print_plan(plan, History(settings['history']) if known else None)
+            return
+        state = State(None if args.force else settings['state_file'])
+        run_plan(plan, entries, settings, state, backend, registry, args.debug, trace=trace)
+
+def read_config(path, args):
+# Reads the yaml file and returns its text, what it holds, the settings and
+# the entries other than the settings.
+    with open(path) as yaml_file:
+        text = yaml_file.read()
+    config = yaml.safe_load(text)
+    if not isinstance(config, list) or not all(isinstance(hash, dict) for hash in config):
+        raise yaml.YAMLError(path + " should be a list of entries")
+    dbgprint(args.debug, "Config:      ", config)
+    settings = get_settings(config, args)
+    dbgprint(args.debug, "Settings:    ", settings)
+    entries = [hash for hash in config if 'settings' not in hash]
+    return text, config, settings, entries
+
+def list_mirrors(backend, debug):
+# Returns the mirrors aptly has, for check_config(), and what went wrong asking.
+# Debug mode does not ask aptly, so no mirror names are checked. If aptly
+# cannot be asked, that is the one problem, rather than every mirror in the
+# yaml being reported missing.
+    if debug:
+        return None, []
+    result = backend.mirror_list()
+    if not result.ok:
+        return None, ["could not list aptly's mirrors: " + result.error()]
+    return result.data, []
+
+def check_config(entries, mirrors, settings, registry):
+# Returns everything wrong with the entries and settings, and then, if nothing
+# is, with the plugins they name.
+    problems = check_entries(entries, mirrors) + check_options("settings", settings['mirror_options'])
+    for name in ('deadline', 'nightly'):
+        when = settings[name]
+        if when is not None and not valid_time(when):
+            problems.append("the " + name + " should be HH:MM, not " + str(when))
+    return problems or check_plugins(entries, registry)
+
+def run_plan(plan, entries, settings, state, backend, registry, debug, cleanup=True, trace=None):
+# Runs a plan and then, if 'cleanup', culls old snapshots and the download
+# store. The state, history and metrics are saved unless in debug mode. The
+# trace, if there is one, is saved even then.
+    trace = trace if trace is not None else Trace(None)
+    with trace.span("build graph"):
+        nodes = build_graph(entries, debug, state, settings, backend, registry, plan)
+        store = DownloadStore(settings['download_store'], debug) if settings['download_store'] else None
+        repo_index = RepoIndex(backend)
+        for node in nodes.values():
+            node.store = store
+            node.repo_index = repo_index
+            node.trace = trace
+        if settings['history'] and os.path.exists(settings['history']):
+            history = History(settings['history'])
+            for node in nodes.values():
+                node.estimate = estimate(history, node.key[0], node.key[1])
+    started = time.time()
+    with trace.span("run graph"):
+        run_graph(nodes, settings, debug)
+    if cleanup and settings['retention']:
+        with trace.span("retention"):
+            collect_garbage(nodes, state, backend, settings['retention'], debug)
+    if store is not None and not debug:
+        with trace.span("download store"):
+            if cleanup:
+                store.prune()
+            store.save()
+    if not debug:
+        with trace.span("save"):
+            state.save(settings['state_file'])
+            ended = time.time()
+            if settings['history']:
+                History(settings['history']).record(get_timestamp(), started, ended, nodes)
+            if settings['metrics']:
+                write_metrics(settings['metrics'], nodes, state, started, ended, backend.snapshot_list().data)
+    trace.save()
+    return nodes
+
+def select_plan(plan, names):
+# The part of a plan that publishes the entries 'names': their publish steps
+# and every step those need, in the plan's order.
+    steps = dict(((step['step'], step['name']), step) for step in plan.steps)
+    wanted = set()
+    todo = [('publish', name) for name in names]
+    while todo:
+        key = todo.pop()
+        if key not in wanted:
+            wanted.add(key)
+            todo.extend(tuple(dep) for dep in steps[key]['deps'])
+    return Plan(None, [step for step in plan.steps if (step['step'], step['name']) in wanted])
+
+class Daemon:
+# Runs the entries again and again without exiting, for --daemon. The plugins,
+# the plan, the backend and the state, with the fingerprints of every mirror's
+# upstream, are kept from one run to the next, so a run that finds nothing new
+# upstream costs little more than asking. The yaml is read and checked again
+# when the file changes; if it has a mistake, the last good one is kept.
+#
+# An entry with 'poll', a number of minutes, is run that often. The others
+# are run once a day at the 'nightly' time. Each run does only the entries
+# that are due, with its own timestamp and log file, and only a run with
+# nightly entries in it culls old snapshots and the download store. A SIGTERM
+# or SIGINT stops the daemon once the run in progress is over.
+    CHECK = 60 # The longest it sleeps before looking at the yaml again
+
+    def __init__(self, args):
+        self.args = args
+        self.path = args.yaml[0]
+        self.debug = args.debug
+        self.registry = PluginRegistry(args.debug)
+        self.loaded = None
+        self.plan = None
+        self.state = None
+        self.schedule = {}
+        self.polls = {}
+        self.stop = threading.Event()
+
+    def load(self, now):
+        # Reads the yaml if it has changed since it was last read, and works
+        # out when each entry is next due: a new entry, or one whose 'poll' has
+        # changed, straight away if it has a 'poll' and otherwise at 'nightly'.
+        # A yaml that is missing or cannot be parsed, as it may be for a moment
+        # while an editor saves it, counts as a mistake.
+        try:
+            modified = os.path.getmtime(self.path)
+            if modified == self.loaded:
+                return
+            self.loaded = modified
+            text, config, settings, entries = read_config(self.path, self.args)
+        except (OSError, yaml.YAMLError) as err:
+            problems = [str(err)]
+        else:
+            backend = make_backend(settings, self.debug)
+            mirrors, problems = list_mirrors(backend, self.debug)
+            problems = problems or check_config(entries, mirrors, settings, self.registry)
+        if problems:
+            for problem in problems:
+                print("Error: " + problem)
+            if self.plan is None:
+                sys.exit(1)
+            print("Daemon: keeping the configuration as it was")
+            return
+        self.settings, self.entries, self.backend = settings, entries, backend
+        self.plan = get_plan(text, entries, mirrors, settings, self.debug, backend)
+        if self.state is None:
+            self.state = State(None if self.args.force else settings['state_file'])
+        schedule = {}
+        polls = {}
+        for entry in entries:
+            name = entry['name']
+            polls[name] = entry.get('poll')
+            if name in self.schedule and self.polls.get(name) == polls[name]:
+                schedule[name] = self.schedule[name]
+            else:
+                schedule[name] = now if polls[name] else next_time(settings['nightly'], datetime.datetime.fromtimestamp(now))
+        self.schedule = schedule
+        self.polls = polls
+        print("Daemon: read " + self.path)
+
+    def step(self, now):
+        # Runs the entries that are due at 'now', if any, and returns how many
+        # seconds to wait before the next step.
+        started = time.time()
+        self.load(now)
+        due = sorted(name for name, when in self.schedule.items() if when <= now)
+        if due:
+            new_run()
+            print("Daemon: " + get_timestamp() + " running " + ", ".join(due))
+            nightly = any(not self.polls[name] for name in due)
+            try:
+                run_plan(select_plan(self.plan, due), self.entries, self.settings, self.state, self.backend,
+                         self.registry, self.debug, cleanup=nightly, trace=Trace(self.args.trace))
+            except Exception as err:
+                print("Error: " + repr(err))
+            for name in due:
+                if self.polls[name]:
+                    self.schedule[name] = now + self.polls[name] * 60
+                else:
+                    self.schedule[name] = next_time(self.settings['nightly'], datetime.datetime.fromtimestamp(now))
+        after = min(self.schedule.values(), default=now + self.CHECK) - now
+        return max(0, min(after, self.CHECK) - (time.time() - started))
+
+    def run(self):
+        for number in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(number, lambda *args: self.stop.set())
+        while not self.stop.is_set():
+            self.stop.wait(self.step(time.time()))
+        print("Daemon: stopped")
+
+def get_settings(config, args):
+# Returns the run-wide settings. Defaults are overridden by an optional
+# 'settings' entry in the YAML, which is overridden by the command line.
+#
+#   - 
+#     settings:
+#       jobs: 6
+#       jobs_per_host: 2
+    settings = dict(DEFAULT_SETTINGS)
+    for hash in config:
+        if 'settings' in hash:
+            settings.update(hash['settings'] or {})
+    if args.jobs is not None:
+        settings['jobs'] = args.jobs
+    if args.deadline is not None:
+        settings['deadline'] = args.deadline
+    if args.metrics is not None:
+        settings['metrics'] = args.metrics
+    return settings
+
+class Node:
+# One step of a run: a mirror update, a snapshot, a plugin, a merge or a
+# publish. 'action' is called with the node itself once every node in 'deps'
+# has finished. 'snapshot' is the name of the snapshot the step leaves behind,
+# which is what the steps that depend on it will use.
+    def __init__(self, key, kind, action, deps=(), snapshot=None, host=None):
+        self.key = key
+        self.kind = kind
+        self.action = action
+        self.deps = list(deps)
+        self.snapshot = snapshot
+        self.host = host
+        self.status = 'pending'
+        self.unchanged = False
+        self.started = None
+        self.ended = None
+        self.bytes = None
+        self.priority = 0
+        self.estimate = None
+        self.late = False
+        self.trace = NO_TRACE
+
+    def __repr__(self):
+        return self.key[0] + ":" + self.key[1]
+
+def build_graph(entries, debug, state=None, settings=DEFAULT_SETTINGS, backend=None, registry=None, plan=None):
+# Turns a Plan, compiled from the YAML entries if it is not given, into a
+# dictionary of nodes, keyed by (step, name) and in the order they should be
+# considered.
+    nodes = {}
+    if backend is None:
+        backend = CliBackend(debug)
+    if registry is None:
+        registry = PluginRegistry(debug)
+    if plan is None:
+        plan = compile_plan(entries, debug, backend, settings=settings)
+    published = published_distributions(backend) if settings['publish_mode'] == 'switch' else set()
+    actions = {'update': update_mirror, 'snapshot': create_snapshot, 'plugin': run_plugin,
+               'merge': merge_snapshots, 'publish': publish_snapshot}
+    for step in plan.steps:
+        snapshot = step['snapshot'] + "-" + get_timestamp() if step.get('snapshot') else None
+        node = add_node(nodes, Node((step['step'], step['name']), step['kind'], actions[step['step']],
+                                    [nodes[tuple(dep)] for dep in step['deps']], snapshot, step.get('host')))
+        node.priority = step.get('priority', 0)
+        if step['step'] == 'update':
+            node.info = step['info']
+            node.options = step.get('options', {})
+        elif step['step'] == 'plugin':
+            node.mod = registry.get(step['name'])
+            node.plugin_dict = dict(step['config'])
+        elif step['step'] == 'publish':
+            node.switch = step['name'] in published
+    if state is None:
+        state = State(None)
+    for node in nodes.values():
+        node.debug = debug
+        node.state = state
+        node.backend = backend
+    return nodes
+
+class Plan:
+# What a run will do, worked out from the entries before anything is run: a
+# list of steps in the order they should be considered. Each step is a
+# dictionary, so that the plan can be saved and printed as JSON:
+#
+#     step      'update', 'snapshot', 'plugin', 'merge' or 'publish'
+#     name      the mirror, plugin or entry it is for
+#     kind      'update', 'plugin' or 'aptly', which decides how many run at once
+#     deps      the [step, name] of each step it needs
+#     host      for an update, the upstream host
+#     info      for an update, what aptly knows about the mirror
+#     options   for an update, the mirror's options (see MIRROR_OPTIONS)
+#     snapshot  the snapshot it makes, without the timestamp
+#     config    for a plugin, its dictionary from the yaml
+#     priority  the highest 'priority' of the entries that need it
+#
+# 'key' identifies the yaml and aptly mirror list the plan was worked out
+# from, or is None if the plan should not be kept.
+    def __init__(self, key, steps):
+        self.key = key
+        self.steps = steps
+
+    def save(self, path):
+        with open(path + ".tmp", "w") as plan_file:
+            json.dump({'key': self.key, 'steps': self.steps}, plan_file, indent=2)
+        os.replace(path + ".tmp", path)
+
+    @staticmethod
+    def load(path, key):
+        # Returns the plan saved in 'path' if it has the same key, or None.
+        try:
+            with open(path) as plan_file:
+                saved = json.load(plan_file)
+        except (OSError, ValueError):
+            return None
+        if saved.get('key') != key:
+            return None
+        return Plan(key, saved['steps'])
+
+def compile_plan(entries, debug, backend, mirrors=None, key=None, settings=DEFAULT_SETTINGS):
+# Turns the YAML entries into a Plan. Each mirror gets an update and a
+# snapshot step, and each plugin a plugin step, however many entries they
+# appear in. Each entry gets a publish step, preceded by a merge step if it
+# has more than one input. What aptly knows about a mirror is taken from
+# 'mirrors', what 'aptly mirror list' said, or else from 'aptly mirror show'.
+# A mirror's options are those in the settings, overridden by those given
+# with it by the first entry that names it. Each step has the priority of the
+# most important entry that needs it.
+    steps = {}
+    def add(step, name, kind, deps=(), **fields):
+        steps[(step, name)] = dict(step=step, name=name, kind=kind, deps=[list(dep) for dep in deps], **fields)
+        return (step, name)
+    for hash in entries:
+        publish = hash['name']
+        dbgprint(debug, "Publish:     ", publish)
+        inputs = []
+        for item in hash['mirrors']:
+            mirror, options = mirror_entry(item)
+            dbgprint(debug, "Mirror:      ", mirror)
+            if ('snapshot', mirror) not in steps:
+                info = mirrors[mirror] if mirrors and mirror in mirrors else mirror_info(mirror, backend)
+                update = add('update', mirror, 'update', host=mirror_host(info), info=info,
+                             options=dict(settings['mirror_options'], **options))
+                add('snapshot', mirror, 'aptly', [update], snapshot=mirror)
+            inputs.append(('snapshot', mirror))
+        for plugin in hash.get('plugins') or []:
+            plugin_name, plugin_dict = next(iter(plugin.items()))
+            dbgprint(debug, "Plugin:      ", plugin_name)
+            if ('plugin', plugin_name) not in steps:
+                add('plugin', plugin_name, 'plugin', snapshot=plugin_name,
+                    config=plugin_dict if plugin_dict is not None else {})
+            inputs.append(('plugin', plugin_name))
+        if 1 < len(inputs):
+            inputs = [add('merge', publish, 'aptly', inputs, snapshot=publish)]
+        used = [add('publish', publish, 'aptly', inputs)]
+        while used:
+            step = steps[used.pop()]
+            step['priority'] = max(step.get('priority', hash.get('priority', 0)), hash.get('priority', 0))
+            used.extend(tuple(dep) for dep in step['deps'])
+    return Plan(key, list(steps.values()))
+
+def get_plan(text, entries, mirrors, settings, debug, backend):
+# Returns the plan for a run: the one in 'plan_file' if it was worked out from
+# the same yaml and the same aptly mirror list, or else a new one, which is
+# saved there. In debug mode aptly is not asked for the mirror list, so the
+# plan is always worked out afresh and is not saved.
+    key = None
+    if mirrors is not None and settings['plan_file']:
+        key = hashlib.sha256((text + json.dumps(mirrors, sort_keys=True)).encode()).hexdigest()
+        plan = Plan.load(settings['plan_file'], key)
+        if plan is not None:
+            dbgprint(debug, "Plan:        ", settings['plan_file'])
+            return plan
+    plan = compile_plan(entries, debug, backend, mirrors, key, settings)
+    if key is not None:
+        plan.save(settings['plan_file'])
+    return plan
+
+def check_entries(entries, mirrors):
+# Returns everything that is wrong with the shape of the entries, and any
+# mirror they name that is not in 'mirrors', what 'aptly mirror list' said.
+# Mirror names are not checked if 'mirrors' is None.
+    problems = []
+    names = set()
+    for number, hash in enumerate(entries, 1):
+        if not isinstance(hash, dict) or not isinstance(hash.get('name'), str):
+            problems.append("entry " + str(number) + " has no name")
+            continue
+        name = hash['name']
+        if name in names:
+            problems.append("entry " + name + " appears more than once")
+        names.add(name)
+        if not isinstance(hash.get('priority', 0), (int, float)):
+            problems.append("entry " + name + ": priority should be a number")
+        poll = hash.get('poll')
+        if poll is not None and (not isinstance(poll, (int, float)) or poll <= 0):
+            problems.append("entry " + name + ": poll should be a number of minutes")
+        if not isinstance(hash.get('mirrors'), list):
+            problems.append("entry " + name + " has no list of mirrors")
+            continue
+        for item in hash['mirrors']:
+            if isinstance(item, dict) and len(item) != 1:
+                problems.append("entry " + name + ": a mirror with options should be one name and its options")
+                continue
+            mirror, options = mirror_entry(item)
+            if mirrors is not None and mirror not in mirrors:
+                problems.append("entry " + name + ": aptly has no mirror called " + str(mirror))
+            problems.extend(check_options("entry " + name + ", mirror " + str(mirror), options))
+        plugins = hash.get('plugins')
+        if plugins is not None and (not isinstance(plugins, list) or
+                                    not all(isinstance(plugin, dict) and len(plugin) == 1 for plugin in plugins)):
+            problems.append("entry " + name + ": plugins should be a list of plugins, each with its parameters")
+        elif not hash['mirrors'] and not plugins:
+            problems.append("entry " + name + " has no mirrors or plugins to publish")
+    return problems
+
+def mirror_entry(item):
+# A mirror in an entry is either its name or, to give it options, a dictionary
+# of its name and its options. Returns the name and the options.
+    if isinstance(item, dict):
+        mirror, options = next(iter(item.items()))
+        return mirror, options or {}
+    return item, {}
+
+def check_options(where, options):
+# Returns everything wrong with a dictionary of mirror options.
+    if not isinstance(options, dict):
+        return [where + ": the options should be a dictionary"]
+    problems = []
+    for option, value in options.items():
+        if option not in MIRROR_OPTIONS:
+            problems.append(where + ": unknown option '" + str(option) + "'")
+        elif not isinstance(value, MIRROR_OPTIONS[option]) or \
+                (option == 'download_concurrency' and isinstance(value, str) and value != 'auto'):
+            problems.append(where + ": '" + option + "' cannot be " + repr(value))
+    return problems
+
+def print_plan(plan, history, runs=10):
+# Prints the plan as JSON, with each step's 'estimate', the average of how
+# long it took over the last 'runs' runs in which it was done (null if it has
+# not been), and the 'estimate' for the whole run: the longest chain of steps,
+# ignoring the limits on how many run at once.
+    finished = {}
+    steps = []
+    for step in plan.steps:
+        seconds = estimate(history, step['step'], step['name'], runs)
+        start = max([finished[tuple(dep)] for dep in step['deps']] or [0])
+        finished[(step['step'], step['name'])] = start + (seconds or 0)
+        steps.append(dict(step, estimate=seconds))
+    print(json.dumps({'key': plan.key, 'timestamp': get_timestamp(),
+                      'estimate': max(finished.values() or [0]), 'steps': steps}, indent=2))
+
+def add_node(nodes, node):
+    nodes[node.key] = node
+    return node
+
+def run_graph(nodes, settings, debug):
+# Runs every node once all of its dependencies have finished, starting ready
+# nodes in the order they were added. At most 'jobs' mirror updates run at once
+# and at most 'jobs_per_host' against any one upstream host. Plugins run
+# alongside them, as their downloads come from other servers. Steps that change
+# the aptly database run one at a time, as they would fight over its lock, and
+# the backend makes the plugins queue for it too. If a node fails, everything
+# that depends on it is skipped.
+# Nodes whose action is a coroutine, which is to say plugins, run on the
+# PluginLoop rather than in a thread of the pool.
+# In batch mode the aptly steps wait for every mirror update to finish and then
+# run together, and their commands are collected into one 'aptly task run' per
+# phase (see TaskBatch). Those of entries with a priority above 0 do not wait.
+#
+# Ready nodes are started highest priority first and then, going by how long
+# their steps took on past runs, those with the longest chain of steps still
+# to come after them. A dependency never has a lower priority or a shorter
+# chain than a node that needs it, so the nodes are still in an order in which
+# every node comes after its dependencies.
+# With a 'bandwidth', the nodes share a Bandwidth.
+# With a 'deadline', a node of priority 0 or less that would not get to the end
+# of its chain by then is skipped, as is everything that needs it, and the
+# entries left unpublished are listed at the end.
+    limits = {'update': settings['jobs'], 'aptly': None if settings.get('batch') else 1}
+    chain_lengths(nodes)
+    pending = sorted(nodes.values(), key=lambda node: (-node.priority, -node.remaining))
+    deadline = next_time(settings['deadline']) if settings.get('deadline') is not None else None
+    if deadline is not None and deadline - time.time() > LATE:
+        print("Warning: the deadline " + str(settings['deadline']) + " has already passed today,"
+              " so it is taken to be tomorrow's")
+    if settings.get('bandwidth'):
+        bandwidth = Bandwidth(settings['bandwidth'], nodes, settings['jobs'])
+        for node in nodes.values():
+            node.bandwidth = bandwidth
+    running = {}
+    plugins = None
+    if any(asyncio.iscoroutinefunction(node.action) for node in pending):
+        plugins = PluginLoop(settings, debug)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(nodes), 1), thread_name_prefix='step') as pool:
+        while pending or running:
+            updating = any(node.kind == 'update' for node in pending + list(running.values()))
+            for node in list(pending):
+                if any(dep.status in ('failed', 'skipped') for dep in node.deps):
+                    node.status = 'skipped'
+                    node.late = any(dep.late for dep in node.deps)
+                    pending.remove(node)
+                    print("Skipped: " + repr(node))
+                elif settings.get('batch') and node.kind == 'aptly' and updating and node.priority <= 0:
+                    continue
+                elif deadline is not None and node.priority <= 0 and deadline < time.time() + node.remaining \
+                        and all(dep.status == 'done' for dep in node.deps):
+                    node.status = 'skipped'
+                    node.late = True
+                    pending.remove(node)
+                    print("Skipped: " + repr(node) + ", as it would not be done by the deadline")
+                elif all(dep.status == 'done' for dep in node.deps) and has_slot(node, running.values(), limits, settings):
+                    node.status = 'running'
+                    pending.remove(node)
+                    batch = getattr(getattr(node, 'backend', None), 'batch', None) if node.kind == 'aptly' else None
+                    if batch is not None:
+                        batch.join()
+                    if asyncio.iscoroutinefunction(node.action):
+                        running[plugins.submit(run_node_async(node, plugins))] = node
+                    else:
+                        running[pool.submit(run_node, node, batch)] = node
+            if not running:
+                break
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                node = running.pop(future)
+                try:
+                    future.result()
+                    node.status = 'done'
+                except Exception as err:
+                    node.status = 'failed'
+                    print("Error: " + repr(node) + " failed: " + str(err))
+    if plugins is not None:
+        plugins.close()
+    late = [node.key[1] for node in nodes.values() if node.key[0] == 'publish' and node.late]
+    if late:
+        print("Not published because of the deadline: " + ", ".join(late))
+
+def chain_lengths(nodes):
+# Sets each node's 'remaining' to the estimated seconds from its start to the
+# end of the longest chain of nodes that need it, its own 'estimate' included.
+# A node with no estimate counts as taking no time. 'nodes' is in order, every
+# node after its dependencies.
+    for node in nodes.values():
+        node.remaining = node.estimate or 0
+    for node in reversed(list(nodes.values())):
+        for dep in node.deps:
+            dep.remaining = max(dep.remaining, (dep.estimate or 0) + node.remaining)
+
+def valid_time(when):
+# Whether 'when' is a time of day that next_time() understands.
+    if isinstance(when, int) and not isinstance(when, bool):
+        return 0 <= when < 24 * 60
+    match = re.match(r'(\d\d?):(\d\d)$', str(when))
+    return match is not None and int(match.group(1)) < 24 and int(match.group(2)) < 60
+
+def next_time(when, now=None):
+# Returns the next time it will be 'when', 'HH:MM', in seconds since the epoch:
+# today if that is still to come, otherwise tomorrow. YAML reads an unquoted
+# 06:00 as the number 360, minutes past midnight, which is also understood.
+# For the deadline this means one that has already passed today is tomorrow's,
+# which is what a nightly run started before midnight wants, but also means a
+# run started after its deadline is not hurried at all; run_graph() warns.
+    now = datetime.datetime.now() if now is None else now
+    hour, minute = divmod(when, 60) if isinstance(when, int) else (int(part) for part in when.split(":"))
+    at = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if at <= now:
+        at += datetime.timedelta(days=1)
+    return at.timestamp()
+
+def estimate(history, step, name, runs=10):
+# The average number of seconds a step took over the last 'runs' runs in which
+# it was done, or None if it has not been done or there is no history.
+    if history is None:
+        return None
+    done = [duration for duration in history.durations(step, name, runs) if duration is not None]
+    return sum(done) / len(done) if done else None
+
+def run_node(node, batch):
+    node.started = time.time()
+    try:
+        with node.trace.span(repr(node), node.kind):
+            node.action(node)
+    finally:
+        node.ended = time.time()
+        if batch is not None:
+            batch.leave()
+
+async def run_node_async(node, plugins):
+    node.started = time.time()
+    try:
+        await node.action(node, plugins)
+    finally:
+        node.ended = time.time()
+
+def has_slot(node, running, limits, settings):
+    if limits.get(node.kind) is not None and limits[node.kind] <= sum(1 for other in running if other.kind == node.kind):
+        return False
+    if node.kind == 'update' and settings['jobs_per_host'] <= sum(1 for other in running if other.kind == 'update' and other.host == node.host):
+        return False
+    return True
+
+def update_mirror(node):
+# Updates a mirror, unless the upstream Release file is the same as last time
+# and there is a snapshot from then to reuse.
+    mirror = node.key[1]
+    with node.trace.span("fingerprint", node.kind):
+        node.fingerprint = fingerprint(node.info, node.debug)
+    last = node.state.mirror(mirror)
+    if node.fingerprint and node.fingerprint == last.get('fingerprint') and last.get('snapshot'):
+        node.unchanged = True
+        dbgprint(node.debug, "Unchanged:   ", mirror)
+        return
+    dbgprint(node.debug, "Updating:    ", mirror)
+    options = dict(node.options)
+    if options.get('download_concurrency') == 'auto':
+        tuning = last.get('tuning', {})
+        options['download_concurrency'] = tuning.get('concurrency', 4)
+        dbgprint(node.debug, "Concurrency: ", options['download_concurrency'])
+    bandwidth = getattr(node, 'bandwidth', None)
+    if bandwidth is not None:
+        options['download_limit'] = bandwidth.start_update(node, options.get('download_limit'))
+    started = time.monotonic()
+    try:
+        with node.trace.span("aptly mirror update", node.kind, download_limit=options.get('download_limit')):
+            result = node.backend.mirror_update(mirror, options)
+    finally:
+        if bandwidth is not None:
+            bandwidth.finish_update(node)
+    node.bytes = result.downloaded
+    node.exit = result.status
+    check(result)
+    if node.options.get('download_concurrency') == 'auto' and not node.debug:
+        node.state.set_tuning(mirror, tune_concurrency(tuning, result.downloaded, time.monotonic() - started,
+                                                       node.options.get('max_download_concurrency', 16)))
+
+def tune_concurrency(tuning, downloaded, seconds, most):
+# Works out the download concurrency for a mirror's next update from how fast
+# this one went, by hill climbing: the concurrency moves one step per run in
+# the same direction while that does not make the downloads slower, and turns
+# back when the rate falls by 5% or more. It stays between 1 and 'most'.
+# An update that downloaded less than 16 MiB says too little about the link
+# to go on, and leaves things as they were. aptly's own default is 4.
+#
+# 'tuning' is what is kept in the state file between runs:
+#
+#     {"concurrency": 5, "rate": 1234567.0, "direction": 1}
+    if downloaded is None or downloaded < 16 << 20 or seconds <= 0:
+        return tuning
+    concurrency = tuning.get('concurrency', 4)
+    direction = tuning.get('direction', 1)
+    rate = downloaded / seconds
+    if tuning.get('rate') is not None and rate <= tuning['rate'] * 0.95:
+        direction = -direction
+    if not 1 <= concurrency + direction <= most:
+        direction = -direction
+    return {'concurrency': max(1, min(most, concurrency + direction)), 'rate': rate, 'direction': direction}
+
+def create_snapshot(node):
+    mirror = node.key[1]
+    update = node.deps[0]
+    if update.unchanged:
+        node.unchanged = True
+        node.snapshot = node.state.mirror(mirror)['snapshot']
+        return
+    check(node.backend.snapshot_from_mirror(node.snapshot, mirror))
+    if update.fingerprint:
+        node.state.set_mirror(mirror, dict(node.state.mirror(mirror), fingerprint=update.fingerprint,
+                                           snapshot=node.snapshot))
+
+async def run_plugin(node, plugins):
+# Runs a plugin on the plugin loop. An async plugin is given a PluginContext
+# and awaited. A plain one is given its dictionary as it always has been, in
+# one of the loop's 'plugin_jobs' threads.
+#
+# A plugin that returns a 'snapshot' has made (or reused) that snapshot rather
+# than the one named after it and the timestamp, and one that returns 'changed'
+# as False has nothing new, so its entry need not be published again. The
+# 'inputs' it returns, the snapshots its own was made from, are kept in the
+# state file so that the retention settings leave them alone while in use.
+# A plugin that returns anything else, or nothing, as plugins always have,
+# has made the snapshot named after it and the timestamp. One that raises an
+# exception has failed: its step fails, so what depends on it is skipped, and
+# nothing is kept in the state.
+    bucket = node.bandwidth.bucket if getattr(node, 'bandwidth', None) is not None else None
+    store = getattr(node, 'store', None)
+    repo_index = getattr(node, 'repo_index', None)
+    if asyncio.iscoroutinefunction(node.mod.fetch_repo):
+        context = PluginContext(node.key[1], node.plugin_dict, node.debug, node.backend, plugins, bucket, store,
+                                repo_index, node.trace)
+        dbgprint(node.debug, "Dict:        ", context.args)
+        with context.span(repr(node)):
+            returned = await node.mod.fetch_repo(context)
     else:
-        with open(args.yaml[0]) as yaml_file:
-            config = yaml.safe_load(yaml_file)
-            dbgprint(args.debug, "Config:      ", config)
-            for hash in config:
-                publish = hash['name']
-                dbgprint(args.debug, "Publish:     ", publish)
-                count = 0
-                list = ""
-                snapshot = ""
-                for mirror in hash['mirrors']:
-                    snapshot = mirror
-                    count += 1
-                    list = list + mirror + "-" + get_timestamp() + " "
-                    dbgprint(args.debug, "Mirror:      ", mirror)
-                    xqt("aptly mirror update " + mirror + " >> " + get_logfile() + " 2>&1",
-                         args.debug)
-                    xqt("aptly snapshot create " + mirror + "-" + get_timestamp() + 
-                        " from mirror " + mirror +  " >> " + get_logfile() + " 2>&1", args.debug)
-                if 'plugins' in hash:
-                    sys.path.append(sys.path[0] + SEPARATOR + 'plugins')
-                    for plugin in hash['plugins']:
-                        count += 1
-                        plugin_name, plugin_dict = next(iter(plugin.items()))
-                        list = list + plugin_name + "-" + get_timestamp() + " "
-                        dbgprint(args.debug, "Plugin:      ", plugin_name)
-                        mod = import_module(plugin_name, args.debug)
-                        call_plugin(mod, plugin_dict, args.debug)
-                if 1 < count:
-                    xqt("aptly snapshot merge -latest " + publish + "-" + get_timestamp() + " " 
-                        + list + ">> " + get_logfile() + " 2>&1", args.debug)
-                    snapshot = publish
-                xqt("aptly publish drop " + publish + " >> " + get_logfile() + " 2>&1", args.debug)
-                xqt("aptly publish snapshot -distribution=" + publish + " " + snapshot + "-" + get_timestamp() + " >> " + get_logfile() + " 2>&1", args.debug)
-
-def call_plugin(mod, plugin_dict, debug):
+        def call():
+            with node.trace.span(repr(node), node.kind):
+                return call_plugin(node.mod, node.plugin_dict, node.debug, node.backend, bucket, store,
+                                   repo_index, node.trace)
+        returned = await plugins.loop.run_in_executor(plugins.executor, call)
+    inputs = []
+    if isinstance(returned, dict):
+        node.bytes = returned.get('bytes')
+        node.snapshot = returned.get('snapshot', node.snapshot)
+        node.unchanged = returned.get('changed', True) is False
+        inputs = returned.get('inputs', [])
+    node.state.set_plugin(node.key[1], {'snapshot': node.snapshot, 'inputs': inputs})
+
+def merge_snapshots(node):
+# Merges the snapshots of an entry. If none of them has changed since the last
+# time this entry was published, the merged snapshot from then is reused.
+    last = node.state.publish(node.key[1])
+    inputs = [dep.snapshot for dep in node.deps]
+    if all(dep.unchanged for dep in node.deps) and last.get('inputs') == inputs:
+        node.unchanged = True
+        node.snapshot = last['snapshot']
+        return
+    check(node.backend.snapshot_merge(node.snapshot, inputs))
+    node.inputs = inputs
+
+def publish_snapshot(node):
+# Publishes an entry, unless what would be published is what already is.
+# Either way, the time is recorded as the entry's last success.
+    publish = node.key[1]
+    snapshot = node.deps[0].snapshot
+    if node.deps[0].unchanged and node.state.publish(publish).get('snapshot') == snapshot:
+        node.unchanged = True
+        dbgprint(node.debug, "Unchanged:   ", publish)
+    else:
+        if not node.switch or not switch_snapshot(node, publish, snapshot):
+            if node.switch:
+                print("Warning: could not switch " + publish + ", dropping and publishing it again")
+            with node.trace.span("aptly publish drop", node.kind):
+                node.backend.publish_drop(publish)
+            with node.trace.span("aptly publish snapshot", node.kind):
+                check(node.backend.publish_snapshot(publish, snapshot))
+        node.state.set_publish(publish, {'snapshot': snapshot,
+                                         'inputs': getattr(node.deps[0], 'inputs', [snapshot])})
+    node.state.set_succeeded(publish, time.time())
+
+def switch_snapshot(node, publish, snapshot):
+    with node.trace.span("aptly publish switch", node.kind):
+        return node.backend.publish_switch(publish, snapshot).ok
+
+def collect_garbage(nodes, state, backend, retention, debug):
+# Drops the snapshots made by earlier runs that the 'retention' settings no
+# longer keep, then has aptly delete the packages no longer referred to, and
+# says how much was freed. Only snapshots named after a mirror, plugin or
+# publication of this configuration or of the state file, or after a snapshot
+# a plugin made its own from, followed by a timestamp, are considered. Published
+# snapshots, the snapshots the state file would reuse and those of this run are
+# never dropped.
+    bases = state.names() | set(node.key[1] for node in nodes.values())
+    bases.update(re.sub(r'-\d{8}T\d\d:\d\d:\d\d$', "", name) for name in state.snapshots())
+    protected = state.snapshots() | (backend.published_snapshots().data or set())
+    protected.update(node.snapshot for node in nodes.values() if node.snapshot)
+    expired = expired_snapshots(backend.snapshot_list().data or [], bases, retention, protected, time.time())
+    dbgprint(debug, "Expired:     ", expired)
+    if not expired:
+        print("Retention: no snapshots to drop")
+        return
+    dropped = 0
+    for snapshot, result in zip(expired, backend.snapshot_drop(expired)):
+        if result.ok:
+            dropped += 1
+        else:
+            print("Warning: could not drop snapshot " + snapshot + ": " + result.error())
+    cleanup = backend.db_cleanup()
+    if not cleanup.ok:
+        print("Warning: aptly db cleanup failed: " + cleanup.error())
+    freed = " and freed " + format_size(cleanup.data) if cleanup.data is not None else ""
+    print("Retention: dropped " + str(dropped) + " of " + str(len(expired)) + " snapshots" + freed)
+
+def expired_snapshots(names, bases, retention, protected, now):
+# Returns, sorted, the snapshots in 'names' that the retention settings do not
+# keep. For each base name the newest 'keep_last' are kept, and any made in
+# the last 'keep_days' days. A snapshot is dropped only if neither keeps it,
+# so with neither set nothing is.
+    keep_last = retention.get('keep_last')
+    keep_days = retention.get('keep_days')
+    if keep_last is None and keep_days is None:
+        return []
+    made = {}
+    for name in names:
+        match = re.match(r'(.+)-(\d{8}T\d\d:\d\d:\d\d)$', name)
+        if match and match.group(1) in bases:
+            made.setdefault(match.group(1), []).append((match.group(2), name))
+    expired = []
+    for snapshots in made.values():
+        # The timestamps sort as text, so this is newest first.
+        for index, (stamp, name) in enumerate(sorted(snapshots, reverse=True)):
+            age = now - datetime.datetime.strptime(stamp, "%Y%m%dT%H:%M:%S").timestamp()
+            if name in protected or stamp == get_timestamp():
+                continue
+            if keep_last is not None and index < keep_last:
+                continue
+            if keep_days is not None and age < keep_days * 86400:
+                continue
+            expired.append(name)
+    return sorted(expired)
+
+def published_distributions(backend):
+# Returns the distributions already published under the default prefix.
+    return set(backend.publish_list().data or [])
+
+METRICS = [('aptly_update_mirror_update_seconds', 'mirror', "How long the mirror update took."),
+           ('aptly_update_mirror_update_status', 'mirror', "0 if the mirror update worked, else what aptly returned."),
+           ('aptly_update_plugin_download_bytes', 'plugin', "How much the plugin downloaded."),
+           ('aptly_update_plugin_seconds', 'plugin', "How long the plugin took."),
+           ('aptly_update_publish_seconds', 'distribution', "How long the publish took."),
+           ('aptly_update_last_success_timestamp_seconds', 'distribution',
+            "When the distribution was last published or found up to date."),
+           ('aptly_update_run_seconds', None, "How long the run took."),
+           ('aptly_update_run_timestamp_seconds', None, "When the run ended."),
+           ('aptly_update_snapshots', None, "How many snapshots aptly has.")]
+
+def write_metrics(path, nodes, state, started, ended, snapshots):
+# Writes the run's METRICS to 'path' in the OpenMetrics text format, through a
+# temporary file renamed over it. Steps that were skipped have no samples, and
+# neither does the snapshot count if aptly could not be asked for it.
+    samples = dict((name, []) for name, _, _ in METRICS)
+    for node in nodes.values():
+        step, name = node.key
+        if node.status not in ('done', 'failed') or node.started is None or node.ended is None:
+            continue
+        seconds = node.ended - node.started
+        if step == 'update':
+            samples['aptly_update_mirror_update_seconds'].append((name, seconds))
+            status = 0 if node.status == 'done' else getattr(node, 'exit', None) or 1
+            samples['aptly_update_mirror_update_status'].append((name, status))
+        elif step == 'plugin':
+            samples['aptly_update_plugin_download_bytes'].append((name, node.bytes or 0))
+            samples['aptly_update_plugin_seconds'].append((name, seconds))
+        elif step == 'publish' and node.status == 'done':
+            samples['aptly_update_publish_seconds'].append((name, seconds))
+    for name, when in sorted(state.succeeded().items()):
+        samples['aptly_update_last_success_timestamp_seconds'].append((name, when))
+    samples['aptly_update_run_seconds'].append((None, ended - started))
+    samples['aptly_update_run_timestamp_seconds'].append((None, ended))
+    if snapshots is not None:
+        samples['aptly_update_snapshots'].append((None, len(snapshots)))
+    lines = []
+    for metric, label, text in METRICS:
+        lines.append("# HELP " + metric + " " + text)
+        lines.append("# TYPE " + metric + " gauge")
+        for value, sample in samples[metric]:
+            labels = '{' + label + '="' + metric_label(value) + '"}' if label else ""
+            lines.append(metric + labels + " " + str(sample))
+    lines.append("# EOF")
+    with open(path + ".tmp", "w") as metrics_file:
+        metrics_file.write("\n".join(lines) + "\n")
+    os.replace(path + ".tmp", path)
+
+def metric_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def check(result):
+    if not result.ok:
+        raise Exception(result.error())
+
+def mirror_info(mirror, backend):
+# Returns what aptly knows about a mirror as a dictionary, using the field
+# names of 'aptly mirror show', for example 'Archive Root URL' and
+# 'Distribution'. In debug mode nothing is known about the mirror.
+    return backend.mirror_show(mirror).data or {}
+
+def mirror_host(info):
+    return urllib.parse.urlparse(info.get('Archive Root URL', "")).netloc
+
+def fingerprint(info, debug):
+# Returns the SHA-256 of the upstream InRelease file of a mirror, or of its
+# Release file if there is no InRelease. Returns None if neither can be read,
+# in which case the mirror is treated as changed.
+    root = info.get('Archive Root URL')
+    dist = info.get('Distribution')
+    if debug or not root or not dist:
+        return None
+    if not root.endswith('/'):
+        root = root + '/'
+    base = root + dist if dist.endswith('/') else root + 'dists/' + dist + '/'
+    for name in ('InRelease', 'Release'):
+        try:
+            with urllib.request.urlopen(base + name, timeout=60) as response:
+                return hashlib.sha256(response.read()).hexdigest()
+        except OSError:
+            pass
+    return None
+
+class State:
+# What was done on previous runs, kept between runs in a JSON file:
+#
+#   {"mirrors": {"bookworm-main": {"fingerprint": "...", "snapshot": "...",
+#                                  "tuning": {...}}},
+#    "plugins": {"vscode": {"snapshot": "...", "inputs": [...]}},
+#    "publish": {"bookworm": {"snapshot": "...", "inputs": ["...", "..."],
+#                             "succeeded": 1719876543.2}}}
+#
+# A path of None starts from nothing, as if this were the first run.
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.data = {'mirrors': {}, 'publish': {}, 'plugins': {}}
+        if path is not None and os.path.exists(path):
+            with open(path) as state_file:
+                self.data.update(json.load(state_file))
+
+    def mirror(self, name):
+        with self.lock:
+            return dict(self.data['mirrors'].get(name, {}))
+
+    def set_mirror(self, name, value):
+        with self.lock:
+            self.data['mirrors'][name] = value
+
+    def set_tuning(self, name, value):
+        with self.lock:
+            self.data['mirrors'].setdefault(name, {})['tuning'] = value
+
+    def set_plugin(self, name, value):
+        with self.lock:
+            self.data['plugins'][name] = value
+
+    def publish(self, name):
+        with self.lock:
+            return dict(self.data['publish'].get(name, {}))
+
+    def set_publish(self, name, value):
+        with self.lock:
+            succeeded = self.data['publish'].get(name, {}).get('succeeded')
+            self.data['publish'][name] = dict(value, succeeded=succeeded) if succeeded else value
+
+    def set_succeeded(self, name, when):
+        with self.lock:
+            self.data['publish'].setdefault(name, {})['succeeded'] = when
+
+    def succeeded(self):
+        # When each publication was last published or found up to date.
+        with self.lock:
+            return dict((name, value['succeeded']) for name, value in self.data['publish'].items()
+                        if value.get('succeeded') is not None)
+
+    def names(self):
+        # Every mirror, plugin and publication the state knows of.
+        with self.lock:
+            return set(name for kind in self.data.values() for name in kind)
+
+    def snapshots(self):
+        # Every snapshot the state refers to, which a later run may reuse.
+        with self.lock:
+            found = set()
+            for kind in self.data.values():
+                for value in kind.values():
+                    found.add(value.get('snapshot'))
+                    found.update(value.get('inputs', []))
+            found.discard(None)
+            return found
+
+    def save(self, path):
+        # Written to a temporary file and renamed, so that a crash cannot
+        # leave a half-written state file behind.
+        with self.lock:
+            with open(path + ".tmp", "w") as state_file:
+                json.dump(self.data, state_file, indent=2)
+            os.replace(path + ".tmp", path)
+
+class Result:
+# What came back from aptly. 'status' is the exit code for the command line or
+# the HTTP status for the API, 'output' is what aptly said, if we have it, and
+# 'data' holds anything parsed out of it. Commands run by run_command() also
+# record 'wall' and 'cpu' seconds, bytes 'logged', 'attempts' and 'timed_out'.
+# 'downloaded' is the size of a mirror update's download queue, if aptly said.
+    def __init__(self, ok, status, output="", data=None):
+        self.ok = ok
+        self.status = status
+        self.output = output
+        self.data = data
+        self.wall = None
+        self.cpu = None
+        self.logged = 0
+        self.attempts = 1
+        self.timed_out = False
+        self.downloaded = None
+
+    def error(self):
+        return "aptly returned " + str(self.status) + (": " + self.output.strip() if self.output.strip() else "")
+
+def make_backend(settings, debug):
+    if settings['backend'] == 'api':
+        return ApiBackend(settings['api_url'], debug, settings['jobs'] + 2)
+    return CliBackend(debug, settings['batch'], settings)
+
+class CliBackend:
+# Runs the aptly command line, one process per operation, with the output
+# going to the log file. This is how the script has always worked. In batch
+# mode, everything except mirror updates is handed to a TaskBatch instead.
+#
+# Everything except mirror updates is run holding 'lock', so that a plugin
+# adding to its repo cannot collide with a snapshot or publish over the aptly
+# database lock. Mirror updates are left to run alongside each other and
+# everything else, which is only safe because of what command() does: aptly
+# closes its database while a mirror update downloads packages, but holds it
+# while the update reads the indexes and while it records what it got, and
+# another aptly process that wants it then fails once its -db-open-attempts
+# are used up. The api backend does not have this problem, as the server
+# keeps the database open itself.
+    def __init__(self, debug, batch=False, settings=DEFAULT_SETTINGS):
+        self.debug = debug
+        self.lock = threading.Lock()
+        self.batch = TaskBatch(debug, self.lock) if batch else None
+        self.settings = settings
+
+    def run(self, argv, batch=True, kind='command'):
+        if batch and self.batch is not None:
+            return self.batch.run(argv)
+        # A command that failed because another aptly process had the
+        # database is run again, without counting against its retries, and
+        # waits without holding 'lock', so that the other aptly steps go on.
+        tries = 0
+        while True:
+            if kind == 'update':
+                result = self.command(argv, kind)
+            else:
+                with self.lock:
+                    result = self.command(argv, kind)
+            if result.ok or not database_locked(result.output) or tries >= self.settings['locked_retries']:
+                return result
+            tries += 1
+            with open(get_logfile(), "a") as log:
+                log.write("aptly's database is locked, trying again in " + str(self.settings['locked_wait']) + "s\n")
+            time.sleep(self.settings['locked_wait'])
+
+    def command(self, argv, kind):
+        return run_command(argv, self.debug, self.settings[kind + '_timeout'],
+                           self.settings[kind + '_retries'], self.settings['retry_backoff'])
+
+    def mirror_show(self, mirror):
+        info = {}
+        for line in query(["aptly", "mirror", "show", mirror], self.debug).splitlines():
+            if ":" in line and not line.startswith(" "):
+                field, value = line.split(":", 1)
+                info[field.strip()] = value.strip()
+        return Result(True, 0, data=info)
+
+    def mirror_list(self):
+        # Lines of 'aptly mirror list' look like
+        # ' * [bookworm-main]: http://deb.debian.org/debian/ bookworm [src]'.
+        # If aptly could not be run, or failed, that is what is returned,
+        # rather than no mirrors at all.
+        result = query_result(["aptly", "mirror", "list"], self.debug)
+        if not result.ok:
+            return result
+        mirrors = {}
+        for line in result.output.splitlines():
+            match = re.match(r'\s*\* \[(.+?)\]: (\S+) (\S+)', line)
+            if match:
+                mirrors[match.group(1)] = {'Archive Root URL': match.group(2),
+                                           'Distribution': match.group(3)}
+        return Result(True, 0, data=mirrors)
+
+    def publish_list(self):
+        # Lines of 'aptly publish list -raw' look like '. bookworm'.
+        published = []
+        for line in query(["aptly", "publish", "list", "-raw"], self.debug).splitlines():
+            fields = line.split()
+            if len(fields) == 2 and fields[0] == '.':
+                published.append(fields[1])
+        return Result(True, 0, data=published)
+
+    def mirror_update(self, mirror, options=None):
+        # Updates take a long time and run in parallel, so are never batched.
+        # The download concurrency and retries can only be set in aptly's
+        # configuration file, so the update is given a copy with them changed.
+        options = options or {}
+        argv = ["aptly"]
+        config = None
+        if 'download_concurrency' in options or 'download_retries' in options:
+            config = aptly_config(self.settings.get('aptly_config'), options)
+            argv.append("-config=" + config)
+        try:
+            return self.run(argv + ["mirror", "update"] + update_flags(options) + [mirror],
+                            batch=False, kind='update')
+        finally:
+            if config is not None:
+                os.remove(config)
+
+    def snapshot_from_mirror(self, snapshot, mirror):
+        return self.run(["aptly", "snapshot", "create", snapshot, "from", "mirror", mirror])
+
+    def snapshot_from_repo(self, snapshot, repo):
+        return self.run(["aptly", "snapshot", "create", snapshot, "from", "repo", repo])
+
+    def snapshot_merge(self, snapshot, sources):
+        return self.run(["aptly", "snapshot", "merge", "-latest", snapshot] + sources)
+
+    def publish_drop(self, distribution):
+        return self.run(["aptly", "publish", "drop", distribution])
+
+    def publish_snapshot(self, distribution, snapshot):
+        return self.run(["aptly", "publish", "snapshot", "-distribution=" + distribution, snapshot])
+
+    def publish_switch(self, distribution, snapshot):
+        return self.run(["aptly", "publish", "switch", distribution, snapshot])
+
+    def repo_add(self, repo, files):
+        return self.run(["aptly", "repo", "add", repo] + files)
+
+    def repo_packages(self, repo):
+        # 'aptly repo show -with-packages' ends with 'Packages:' and then a
+        # line for each package like '  code_1.90.0-1717531825_amd64'.
+        packages = set()
+        listing = False
+        for line in query(["aptly", "repo", "show", "-with-packages", repo], self.debug).splitlines():
+            if listing and line.strip():
+                packages.add(line.strip())
+            listing = listing or line.startswith("Packages:")
+        return Result(True, 0, data=packages)
+
+    def snapshot_list(self):
+        return Result(True, 0, data=query(["aptly", "snapshot", "list", "-raw"], self.debug).split())
+
+    def published_snapshots(self):
+        # 'aptly publish list -raw' gives the prefix and distribution of every
+        # publication and 'aptly publish show' its sources, as lines like
+        # '  main: bookworm-20240101T03:00:00 [snapshot]'.
+        snapshots = set()
+        for line in query(["aptly", "publish", "list", "-raw"], self.debug).splitlines():
+            fields = line.split()
+            if len(fields) != 2:
+                continue
+            for source in query(["aptly", "publish", "show", fields[1], fields[0]], self.debug).splitlines():
+                match = re.match(r'\s+\S+: (\S+) \[snapshot\]', source)
+                if match:
+                    snapshots.add(match.group(1))
+        return Result(True, 0, data=snapshots)
+
+    def snapshot_drop(self, snapshots):
+        # Returns a Result for each snapshot. They are all dropped in one
+        # 'aptly task run', however the backend is set up.
+        cmds = [["aptly", "snapshot", "drop", "-force", snapshot] for snapshot in snapshots]
+        if not cmds:
+            return []
+        with self.lock:
+            return task_run_all(cmds, self.debug)
+
+    def db_cleanup(self):
+        result = self.run(["aptly", "db", "cleanup"], batch=False)
+        result.data = freed_size(result.output)
+        return result
+
+def database_locked(output):
+# Whether aptly failed because it could not open its database, which LevelDB
+# only lets one process have at a time.
+    return re.search(r"can't open database|/LOCK: resource temporarily unavailable", output) is not None
+
+def update_flags(options):
+# The 'aptly mirror update' flags for a mirror's options.
+    flags = []
+    if options.get('download_limit'):
+        flags.append("-download-limit=" + str(options['download_limit']))
+    if options.get('max_tries'):
+        flags.append("-max-tries=" + str(options['max_tries']))
+    if options.get('skip_existing_packages'):
+        flags.append("-skip-existing-packages")
+    return flags
+
+def aptly_config(path, options):
+# Writes a copy of aptly's configuration file with the download concurrency
+# and retries of a mirror's options, and returns its name. The file copied is
+# 'path', or else the one aptly would read: ~/.aptly.conf, or /etc/aptly.conf.
+# With neither, aptly's defaults are used for everything else.
+    config = {}
+    for candidate in [path] if path else [os.path.expanduser("~/.aptly.conf"), "/etc/aptly.conf"]:
+        if os.path.exists(candidate):
+            with open(candidate) as config_file:
+                config = json.load(config_file)
+            break
+    if 'download_concurrency' in options:
+        config['downloadConcurrency'] = options['download_concurrency']
+    if 'download_retries' in options:
+        config['downloadRetries'] = options['download_retries']
+    with tempfile.NamedTemporaryFile("w", suffix=".conf", prefix="aptly-", delete=False) as config_file:
+        json.dump(config, config_file, indent=2)
+    return config_file.name
+
+class TaskBatch:
+# Collects the aptly commands of the steps that are running at the same time
+# and runs them with a single 'aptly task run', so that aptly is started and
+# its database opened once per batch rather than once per command.
+#
+# The scheduler join()s each step before starting it and it leave()s when it
+# has finished. A step that runs a command waits until every step in the batch
+# is either waiting too or has finished, then the whole lot is run. A step that
+# needs two commands in turn, like drop and publish, gets them into two
+# batches. Usually this means one batch for all the snapshots, one for the
+# merges and one or two for the publishing.
+    def __init__(self, debug, lock=None):
+        self.debug = debug
+        self.lock = lock if lock is not None else threading.Lock()
+        self.cond = threading.Condition()
+        self.members = 0
+        self.queue = []
+
+    def join(self):
+        with self.cond:
+            self.members += 1
+
+    def leave(self):
+        with self.cond:
+            self.members -= 1
+            self.flush()
+
+    def run(self, cmd):
+        entry = {'cmd': cmd, 'result': None}
+        with self.cond:
+            self.queue.append(entry)
+            self.flush()
+            while entry['result'] is None:
+                self.cond.wait()
+        return entry['result']
+
+    def flush(self):
+        # Called with the condition held.
+        if not self.queue or len(self.queue) < self.members:
+            return
+        batch, self.queue = self.queue, []
+        with self.lock:
+            results = task_run_all([entry['cmd'] for entry in batch], self.debug)
+        for entry, result in zip(batch, results):
+            entry['result'] = result
+        self.cond.notify_all()
+
+def task_run_all(cmds, debug):
+# Runs aptly commands with task_run() and returns a Result for each. aptly
+# stops a task at the first failing command and skips the rest, so skipped
+# commands are run again in another task without the one that failed.
+    results = [None] * len(cmds)
+    todo = list(range(len(cmds)))
+    while todo:
+        ran = task_run([cmds[i] for i in todo], debug)
+        for i, result in zip(todo, ran):
+            results[i] = result
+        todo = [i for i, result in zip(todo, ran) if result is None]
+    return results
+
+def task_run(cmds, debug):
+# Runs aptly commands in one 'aptly task run' and returns a Result for each,
+# or None for a command that aptly skipped because an earlier one failed.
+#
+# For each command aptly prints '1) [Running]: snapshot create ...' followed
+# by the output between 'Begin command output' and 'End command output' lines,
+# or '1) [Skipping]: ...' once a command has failed. It does not say which one
+# failed, but it is always the last one that ran.
+    if debug:
+        print("aptly task run >> " + get_logfile() + " 2>&1")
+        for cmd in cmds:
+            print("    " + " ".join(cmd))
+        return [Result(True, 0) for cmd in cmds]
+    with tempfile.NamedTemporaryFile("w", suffix=".aptly", delete=False) as task_file:
+        for cmd in cmds:
+            task_file.write(" ".join(cmd[1:]) + "\n")
+    try:
+        run = subprocess.run(["aptly", "task", "run", "-filename=" + task_file.name],
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    except OSError as err:
+        return [Result(False, 127, str(err)) for cmd in cmds]
+    finally:
+        os.remove(task_file.name)
+    return parse_task_run(run.stdout, run.returncode, len(cmds))
+
+def parse_task_run(output, returncode, count):
+    outputs = [None] * count
+    current = None
+    for line in output.splitlines():
+        match = re.match(r'(\d+)\) \[(Running|Skipping)\]', line)
+        if match:
+            current = int(match.group(1)) - 1 if match.group(2) == 'Running' else None
+            if current is not None and current < count:
+                outputs[current] = ""
+        elif current is not None and current < count and not re.match(r'(Begin|End) command output', line):
+            outputs[current] += line + "\n"
+    ran = [i for i in range(count) if outputs[i] is not None]
+    if not ran:
+        with open(get_logfile(), "a") as log:
+            log.write(output)
+        return [Result(False, returncode, output) for i in range(count)]
+    failed = ran[-1] if returncode != 0 else None
+    results = []
+    with open(get_logfile(), "a") as log:
+        log.write(output)
+        for i in range(count):
+            if outputs[i] is None:
+                results.append(None)
+                status = "skipped"
+            else:
+                results.append(Result(i != failed, 1 if i == failed else 0, outputs[i]))
+                status = "failed" if i == failed else "ok"
+            log.write("Task " + str(i + 1) + " " + status + "\n")
+    return results
+
+class ApiBackend:
+# Talks to 'aptly api serve' over HTTP. One keep-alive session is shared by
+# every thread, so there is no process to start and no database to open per
+# operation, and aptly serialises access to its database itself. Slow
+# operations are started as asynchronous tasks, which are polled until they
+# finish. In debug mode the requests are printed instead of being sent.
+#
+# The API writes publications with the prefix '.' as ':.'.
+    def __init__(self, url, debug, connections=10, poll=1.0):
+        self.url = url.rstrip('/')
+        self.debug = debug
+        self.poll = poll
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=connections)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.components = {}
+
+    def request(self, method, path, body=None, files=None, wait=False):
+        url = self.url + path
+        if self.debug:
+            print(method + " " + url + ("" if body is None else " " + json.dumps(body)))
+            return Result(True, 200, data={})
+        params = {'_async': 'true'} if wait else None
+        try:
+            response = self.session.request(method, url, json=body, files=files, params=params)
+        except requests.RequestException as err:
+            return Result(False, 0, str(err))
+        data = response.json() if response.content and 'json' in response.headers.get('Content-Type', '') else None
+        if wait and response.ok and data and 'ID' in data:
+            return self.wait(data['ID'])
+        output = response.text if not response.ok else ""
+        return Result(response.ok, response.status_code, output, data)
+
+    def wait(self, task):
+        # Task states: 0 idle, 1 running, 2 succeeded, 3 failed.
+        while True:
+            response = self.session.get(self.url + "/api/tasks/" + str(task))
+            state = response.json().get('State') if response.ok else 3
+            if state in (2, 3):
+                break
+            time.sleep(self.poll)
+        output = self.session.get(self.url + "/api/tasks/" + str(task) + "/output")
+        text = output.json() if output.ok else ""
+        with open(get_logfile(), "a") as log:
+            log.write(str(text))
+        result = Result(state == 2, 200 if state == 2 else 500, str(text))
+        result.downloaded = download_size(str(text))
+        return result
+
+    def mirror_show(self, mirror):
+        result = self.request('GET', "/api/mirrors/" + mirror)
+        mirror = result.data or {}
+        result.data = {'Archive Root URL': mirror.get('ArchiveRoot', ""),
+                       'Distribution': mirror.get('Distribution', "")} if mirror else {}
+        return result
+
+    def mirror_list(self):
+        result = self.request('GET', "/api/mirrors")
+        result.data = dict((mirror['Name'], {'Archive Root URL': mirror.get('ArchiveRoot', ""),
+                                             'Distribution': mirror.get('Distribution', "")})
+                           for mirror in result.data or [])
+        return result
+
+    def publish_list(self):
+        if self.debug:
+            return Result(True, 200, data=[])
+        result = self.request('GET', "/api/publish")
+        published = []
+        for publication in result.data or []:
+            if publication.get('Prefix') == '.':
+                published.append(publication['Distribution'])
+                sources = publication.get('Sources') or [{}]
+                self.components[publication['Distribution']] = sources[0].get('Component', 'main')
+        result.data = published
+        return result
+
+    def mirror_update(self, mirror, options=None):
+        # The download concurrency and retries are set in the server's own
+        # configuration, so only the other options can be passed on.
+        options = options or {}
+        body = {}
+        if options.get('download_limit'):
+            body['DownloadLimit'] = options['download_limit']
+        if options.get('max_tries'):
+            body['MaxTries'] = options['max_tries']
+        if options.get('skip_existing_packages'):
+            body['SkipExistingPackages'] = True
+        return self.request('PUT', "/api/mirrors/" + mirror, body, wait=True)
+
+    def snapshot_from_mirror(self, snapshot, mirror):
+        return self.request('POST', "/api/mirrors/" + mirror + "/snapshots", {'Name': snapshot}, wait=True)
+
+    def snapshot_from_repo(self, snapshot, repo):
+        return self.request('POST', "/api/repos/" + repo + "/snapshots", {'Name': snapshot}, wait=True)
+
+    def snapshot_merge(self, snapshot, sources):
+        return self.request('POST', "/api/snapshots/merge?latest=1",
+                            {'Destination': snapshot, 'Sources': sources}, wait=True)
+
+    def publish_drop(self, distribution):
+        return self.request('DELETE', "/api/publish/:./" + distribution, wait=True)
+
+    def publish_snapshot(self, distribution, snapshot):
+        return self.request('POST', "/api/publish/:.", {'SourceKind': 'snapshot',
+                                                        'Sources': [{'Name': snapshot}],
+                                                        'Distribution': distribution}, wait=True)
+
+    def publish_switch(self, distribution, snapshot):
+        component = self.components.get(distribution, 'main')
+        return self.request('PUT', "/api/publish/:./" + distribution,
+                            {'Snapshots': [{'Component': component, 'Name': snapshot}]}, wait=True)
+
+    def repo_add(self, repo, files):
+        # Files are uploaded to a directory named after the run, then added.
+        directory = repo + "-" + get_timestamp().replace(":", "")
+        for name in files:
+            if self.debug:
+                print("POST " + self.url + "/api/files/" + directory + " " + name)
+                continue
+            with open(name, "rb") as upload:
+                result = self.request('POST', "/api/files/" + directory,
+                                      files={'file': (os.path.basename(name), upload)})
+            if not result.ok:
+                return result
+        return self.request('POST', "/api/repos/" + repo + "/file/" + directory, wait=True)
+
+    def snapshot_list(self):
+        result = self.request('GET', "/api/snapshots")
+        result.data = [snapshot['Name'] for snapshot in result.data or []]
+        return result
+
+    def repo_packages(self, repo):
+        # The API lists packages by key, 'Pamd64 code 1.90.0-1717531825 <hash>',
+        # which is turned into the name the command line shows.
+        result = self.request('GET', "/api/repos/" + repo + "/packages")
+        packages = set()
+        for key in result.data or []:
+            fields = key.split()
+            if len(fields) >= 3:
+                packages.add(fields[1] + "_" + fields[2] + "_" + fields[0][1:])
+        result.data = packages
+        return result
+
+    def published_snapshots(self):
+        if self.debug:
+            return Result(True, 200, data=set())
+        result = self.request('GET', "/api/publish")
+        result.data = set(source['Name'] for publication in result.data or []
+                          if publication.get('SourceKind') == 'snapshot'
+                          for source in publication.get('Sources') or [])
+        return result
+
+    def snapshot_drop(self, snapshots):
+        return [self.request('DELETE', "/api/snapshots/" + snapshot + "?force=1", wait=True)
+                for snapshot in snapshots]
+
+    def db_cleanup(self):
+        result = self.request('POST', "/api/db/cleanup", wait=True)
+        result.data = freed_size(result.output)
+        return result
+
+class History:
+# Every step of every run, kept in a SQLite database so that we can see which
+# mirrors are eating the cron window. Durations are in seconds and times are
+# seconds since the epoch. 'status' is 'done', 'unchanged', 'failed' or
+# 'skipped'. 'bytes' is how much a mirror update or plugin downloaded, if known.
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, timestamp TEXT,
+                                             started REAL, ended REAL);
+            CREATE TABLE IF NOT EXISTS steps (run INTEGER, step TEXT, name TEXT,
+                                              started REAL, ended REAL, duration REAL,
+                                              status TEXT, bytes INTEGER);
+            CREATE INDEX IF NOT EXISTS steps_by_name ON steps (step, name);
+            """)
+
+    def record(self, timestamp, started, ended, nodes):
+        with self.db:
+            run = self.db.execute("INSERT INTO runs (timestamp, started, ended) VALUES (?, ?, ?)",
+                                  (timestamp, started, ended)).lastrowid
+            for node in nodes.values():
+                status = 'unchanged' if node.status == 'done' and node.unchanged else node.status
+                duration = node.ended - node.started if node.started and node.ended else None
+                self.db.execute("INSERT INTO steps VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                (run, node.key[0], node.key[1], node.started, node.ended,
+                                 duration, status, node.bytes))
+        return run
+
+    def runs(self, count):
+        # The ids of the last 'count' runs, oldest first.
+        rows = self.db.execute("SELECT id FROM runs ORDER BY id DESC LIMIT ?", (count,)).fetchall()
+        return [row[0] for row in reversed(rows)]
+
+    def durations(self, step, name, count):
+        # Durations of a step over the last 'count' runs, oldest first, with
+        # None for runs where it was not done.
+        runs = self.runs(count)
+        found = dict(self.db.execute("SELECT run, duration FROM steps WHERE step = ? AND name = ?"
+                                     " AND status = 'done' AND run >= ?",
+                                     (step, name, runs[0] if runs else 0)).fetchall())
+        return [found.get(run) for run in runs]
+
+    def slowest(self, count, limit=10):
+        runs = self.runs(count)
+        return self.db.execute("SELECT steps.step, steps.name, steps.duration, steps.status, runs.timestamp"
+                               " FROM steps JOIN runs ON steps.run = runs.id"
+                               " WHERE run >= ? AND duration IS NOT NULL"
+                               " ORDER BY duration DESC LIMIT ?",
+                               (runs[0] if runs else 0, limit)).fetchall()
+
+    def names(self, step):
+        return [row[0] for row in self.db.execute("SELECT DISTINCT name FROM steps WHERE step = ?"
+                                                   " ORDER BY name", (step,))]
+
+def print_report(history, count):
+# Prints how long each mirror update took over the last 'count' runs, oldest
+# first, with '-' for runs where it was unchanged or did not happen, and the
+# slowest steps of those runs.
+    runs = history.runs(count)
+    print("Mirror update durations in seconds over the last " + str(len(runs)) + " runs, oldest first:")
+    for name in history.names('update'):
+        durations = history.durations('update', name, count)
+        done = [duration for duration in durations if duration is not None]
+        trend = " ".join("-" if duration is None else "%.0f" % duration for duration in durations)
+        average = "%.0f" % (sum(done) / len(done)) if done else "-"
+        print("  " + name.ljust(30) + " average " + average.rjust(6) + "   " + trend)
+    print("Slowest steps:")
+    for step, name, duration, status, timestamp in history.slowest(count):
+        print("  " + ("%.0f" % duration).rjust(6) + "s  " + step.ljust(8) + " " + name.ljust(30)
+              + " " + status.ljust(9) + " " + timestamp)
+
+class Trace:
+# The spans of a run, for --trace, written as Chrome Trace Event JSON. Each
+# span is a complete event on the lane of the thread it ran in, so spans
+# within a span nest under it and a worker with nothing to do shows as a gap
+# in its lane. Async plugins share the plugin loop's thread, so each is given
+# a lane of its own by name. With a path of None nothing is recorded, so the
+# code being traced need not check.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.events = []
+        self.lanes = {}
+        self.origin = time.perf_counter()
+
+    def lane(self, name):
+        # The number of the lane called 'name', or of the current thread's.
+        key = name if name is not None else (threading.get_ident(), threading.current_thread().name)
+        with self.lock:
+            if key not in self.lanes:
+                self.lanes[key] = len(self.lanes) + 1
+                self.events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': self.lanes[key],
+                                    'args': {'name': name if name is not None else key[1]}})
+            return self.lanes[key]
+
+    @contextlib.contextmanager
+    def span(self, name, category='run', lane=None, **args):
+        # 'with trace.span(name):' records how long the block took, with any
+        # keyword arguments and, if it raised, the error.
+        if self.path is None:
+            yield
+            return
+        tid = self.lane(lane)
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as err:
+            args['error'] = repr(err)
+            raise
+        finally:
+            ended = time.perf_counter()
+            with self.lock:
+                self.events.append({'name': name, 'cat': category, 'ph': 'X', 'pid': 1, 'tid': tid,
+                                    'ts': round((started - self.origin) * 1e6, 1),
+                                    'dur': round((ended - started) * 1e6, 1), 'args': args})
+
+    def save(self):
+        # Written to a temporary file and renamed, as the state file is.
+        if self.path is None:
+            return
+        with self.lock:
+            events = [{'name': 'process_name', 'ph': 'M', 'pid': 1,
+                       'args': {'name': "aptly_update " + get_timestamp()}}] + self.events
+            with open(self.path + ".tmp", "w") as trace_file:
+                json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file)
+            os.replace(self.path + ".tmp", self.path)
+
+NO_TRACE = Trace(None)
+
+class Bandwidth:
+# Shares 'total' KiB/s between the mirror updates and the plugins' downloads.
+# A mirror update's share is fixed when it starts, as its download limit. It
+# is an equal share of the total between the updates that can run at once and,
+# while there are plugins still to run, the plugins, but never more than the
+# updates already running have left. As updates finish, those that start after
+# them are given what they leave, and bigger shares once fewer are left to run.
+# The plugins share a TokenBucket, which gets whatever the running updates are
+# not using and is changed every time one starts or finishes. While there are
+# plugins still to run, an equal share is always kept back for them.
+#
+# The limits never add up to more than the total. As aptly takes a limit of 0
+# to mean none, an update that would get less than 1 KiB/s is not given 0 but
+# waits for one of those running to finish.
+    def __init__(self, total, nodes, jobs):
+        self.total = total
+        self.nodes = nodes
+        self.jobs = jobs
+        self.lock = threading.Condition()
+        self.limits = {}
+        self.bucket = TokenBucket(total * 1024)
+
+    def start_update(self, node, limit=None):
+        # Returns the update's download limit in KiB/s, which is no more than
+        # 'limit', the mirror's own, if it has one.
+        with self.lock:
+            while True:
+                updates = sum(1 for other in self.nodes.values()
+                              if other.kind == 'update' and other.status in ('pending', 'running'))
+                plugins = any(other.kind == 'plugin' and other.status in ('pending', 'running')
+                              for other in self.nodes.values())
+                parts = max(1, min(self.jobs, updates)) + (1 if plugins else 0)
+                left = self.total - (self.total / parts if plugins else 0) - sum(self.limits.values())
+                if left >= 1 or not self.limits:
+                    break
+                self.lock.wait()
+            share = max(1, int(min(self.total / parts, left)))
+            self.limits[node.key] = min(limit, share) if limit else share
+            self.bucket.set_rate(max(0, self.total - sum(self.limits.values())) * 1024)
+            return self.limits[node.key]
+
+    def finish_update(self, node):
+        with self.lock:
+            self.limits.pop(node.key, None)
+            self.bucket.set_rate(max(0, self.total - sum(self.limits.values())) * 1024)
+            self.lock.notify_all()
+
+class TokenBucket:
+# Lets 'rate' bytes a second through, between all the threads and coroutines
+# that take from it, with bursts of up to a second's worth. A download takes
+# the size of each chunk it has read, and is made to wait until the bucket has
+# refilled enough to pay for it. While the rate is 0 nothing gets through.
+    def __init__(self, rate):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.tokens = 0
+        self.stamp = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.refill()
+            self.rate = rate
+
+    def delay(self, size):
+        # Takes 'size' bytes and returns how many seconds to wait before using
+        # them, or None, without taking them, if the rate is 0.
+        with self.lock:
+            self.refill()
+            if self.rate <= 0:
+                return None
+            self.tokens -= size
+            return max(0, -self.tokens / self.rate)
+
+    def take(self, size):
+        while True:
+            wait = self.delay(size)
+            time.sleep(0.1 if wait is None else wait)
+            if wait is not None:
+                return
+
+    async def take_async(self, size):
+        while True:
+            wait = self.delay(size)
+            await asyncio.sleep(0.1 if wait is None else wait)
+            if wait is not None:
+                return
+
+class DownloadStore:
+# The files plugins download, kept in one directory under their SHA-256 and
+# hardlinked to wherever the plugins want them. 'index.json' in the directory
+# says, for each file, its size, the package it is a version of ('key', such
+# as the URL it came from), when a run last used it, the links made to it and
+# the repos it has been added to. Plugins may use it from several threads.
+#
+#     link(sha256, filename, key)   links a stored file to filename, if there
+#                                   is one, and returns whether there was
+#     add(filename, key)            moves a downloaded file into the store, or
+#                                   drops it if the same is already there, and
+#                                   links it back; returns its SHA-256
+#     in_repo(sha256, repo), set_in_repo(sha256, repo)
+#                                   whether the file has been added to a repo
+    def __init__(self, settings, debug):
+        self.path = settings['path']
+        self.keep_last = settings.get('keep_last')
+        self.max_size = settings.get('max_size')
+        self.debug = debug
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.files = {}
+        index = os.path.join(self.path, "index.json")
+        if os.path.exists(index):
+            with open(index) as index_file:
+                self.files = json.load(index_file)
+
+    def blob(self, digest):
+        return os.path.join(self.path, digest)
+
+    def link(self, sha256, filename, key):
+        digest = sha256.lower()
+        with self.lock:
+            if digest not in self.files or not os.path.exists(self.blob(digest)):
+                return False
+            self.place(digest, filename, key)
+            return True
+
+    def add(self, filename, key):
+        digest = file_sha256(filename)
+        with self.lock:
+            if digest not in self.files or not os.path.exists(self.blob(digest)):
+                os.makedirs(self.path, exist_ok=True)
+                shutil.move(filename, self.blob(digest))
+                self.files[digest] = {'size': os.path.getsize(self.blob(digest)), 'links': [], 'repos': []}
+            self.place(digest, filename, key)
+        return digest
+
+    def place(self, digest, filename, key):
+        # Links the stored file to filename, if it is not already, and notes
+        # that this run has used it. The lock is held.
+        blob = self.blob(digest)
+        if not (os.path.exists(filename) and os.path.samefile(filename, blob)):
+            try:
+                os.link(blob, filename + ".link")
+            except OSError:
+                shutil.copyfile(blob, filename + ".link")
+            os.replace(filename + ".link", filename)
+        entry = self.files[digest]
+        entry['key'] = key
+        entry['used'] = time.time()
+        if os.path.abspath(filename) not in entry['links']:
+            entry['links'].append(os.path.abspath(filename))
+
+    def in_repo(self, sha256, repo):
+        with self.lock:
+            return repo in self.files.get(sha256.lower(), {}).get('repos', [])
+
+    def set_in_repo(self, sha256, repo):
+        with self.lock:
+            repos = self.files[sha256.lower()]['repos']
+            if repo not in repos:
+                repos.append(repo)
+
+    def expired(self):
+        # The files the settings no longer keep: for each key all but the
+        # 'keep_last' most recently used, then the least recently used until
+        # what is left is no more than 'max_size' MiB. Never one used in this run.
+        newest = sorted(self.files, key=lambda digest: self.files[digest].get('used', 0), reverse=True)
+        expired = set()
+        if self.keep_last is not None:
+            seen = collections.Counter()
+            for digest in newest:
+                seen[self.files[digest].get('key')] += 1
+                if self.keep_last < seen[self.files[digest].get('key')]:
+                    expired.add(digest)
+        if self.max_size is not None:
+            size = sum(self.files[digest]['size'] for digest in newest if digest not in expired)
+            for digest in reversed(newest):
+                if size <= self.max_size * SIZE_UNITS['MiB']:
+                    break
+                if digest not in expired:
+                    expired.add(digest)
+                    size -= self.files[digest]['size']
+        return [digest for digest in newest
+                if digest in expired and self.files[digest].get('used', 0) < self.started]
+
+    def prune(self):
+        # Removes the expired files, with the links to them that are still
+        # theirs, and says how much was freed.
+        with self.lock:
+            expired = self.expired()
+            freed = 0
+            for digest in expired:
+                blob = self.blob(digest)
+                for link in self.files[digest]['links']:
+                    if os.path.exists(link) and (not os.path.exists(blob) or os.path.samefile(link, blob)
+                                                 or file_sha256(link) == digest):
+                        os.remove(link)
+                if os.path.exists(blob):
+                    os.remove(blob)
+                freed += self.files.pop(digest)['size']
+        dbgprint(self.debug, "Pruned:      ", expired)
+        if expired:
+            print("Download store: removed " + str(len(expired)) + " files and freed " + format_size(freed))
+
+    def save(self):
+        os.makedirs(self.path, exist_ok=True)
+        index = os.path.join(self.path, "index.json")
+        with self.lock:
+            with open(index + ".tmp", "w") as index_file:
+                json.dump(self.files, index_file, indent=2)
+        os.replace(index + ".tmp", index)
+
+def file_sha256(filename):
+    digest = hashlib.sha256()
+    with open(filename, "rb") as source:
+        for chunk in iter(lambda: source.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class RepoIndex:
+# What the local repos hold, by aptly's 'name_version_architecture' name for
+# each package, so that plugins need not add what is already there. A repo is
+# read from the backend the first time it is asked about, with one 'aptly repo
+# show -with-packages' or API call, and kept for the rest of the run, with
+# whatever plugins add through add() added to it. Safe to use from several
+# plugins at once.
+    def __init__(self, backend):
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.repos = {}
+
+    def packages(self, repo):
+        with self.lock:
+            if repo not in self.repos:
+                self.repos[repo] = set(self.backend.repo_packages(repo).data or [])
+            return set(self.repos[repo])
+
+    def add(self, repo, files):
+        # Adds to the repo, in one go, those of the files that are not in it
+        # already, going by their control files. A file that cannot be read
+        # is added anyway. Returns the backend's Result with the files added
+        # as its 'data', none if the repo has not changed.
+        have = self.packages(repo)
+        names = dict((name, deb_package(name)) for name in files)
+        new = [name for name in files if names[name] is None or names[name] not in have]
+        if not new:
+            return Result(True, 0, data=[])
+        result = self.backend.repo_add(repo, new)
+        if result.ok:
+            with self.lock:
+                self.repos[repo].update(names[name] for name in new if names[name] is not None)
+        result.data = new
+        return result
+
+def deb_package(filename):
+# Returns aptly's name for a .deb, 'name_version_architecture' from its control
+# file, or None if it cannot be read. A .deb is an ar archive holding a
+# control.tar, which Python can read unless it is compressed with zstd, in
+# which case dpkg-deb is asked instead.
+    try:
+        with open(filename, "rb") as deb:
+            if deb.read(8) != b"!<arch>\n":
+                return None
+            while True:
+                header = deb.read(60)
+                if len(header) < 60:
+                    return None
+                size = int(header[48:58])
+                if header[:16].strip().startswith(b"control.tar"):
+                    member = deb.read(size)
+                    break
+                deb.seek(size + size % 2, os.SEEK_CUR)
+        try:
+            with tarfile.open(fileobj=io.BytesIO(member)) as control_tar:
+                control = control_tar.extractfile("./control").read().decode()
+        except (tarfile.TarError, KeyError):
+            control = subprocess.run(["dpkg-deb", "--field", filename], stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL, text=True).stdout
+    except (OSError, ValueError):
+        return None
+    fields = dict(re.findall(r'^(Package|Version|Architecture): *(\S+)', control, re.MULTILINE))
+    if len(fields) != 3:
+        return None
+    return fields['Package'] + "_" + fields['Version'] + "_" + fields['Architecture']
+
+class PluginRegistry:
+# Finds the plugins once per run: the modules in the 'plugins' directory next
+# to the script, and the entry points of installed packages in the
+# 'aptly_update.plugins' group, named after the plugin. One in the directory
+# wins over an installed one of the same name. Each plugin is loaded the first
+# time it is asked for, kept, and must have a 'fetch_repo'.
+#
+# A plugin may say what its dictionary should hold, which validate() checks
+# before anything is run. SCHEMA gives the type, or a tuple of types, of every
+# parameter, and REQUIRED those that must be given:
+#
+#     SCHEMA = {'url': str, 'path': str, 'timeout': (int, float)}
+#     REQUIRED = ('url', 'path')
+#
+# A parameter not in SCHEMA is an error, as it is most likely a typing mistake.
+# For anything SCHEMA cannot describe, such as what is inside a list, a plugin
+# may also have check(args), which is given the dictionary once its types are
+# right and returns a list of what is wrong with it.
+#
+# The script's own directory is put on the path as well, so that plugins can
+# import downloads.py, the download helpers they share, wherever they are.
+    def __init__(self, debug, directory=None):
+        self.debug = debug
+        self.directory = directory if directory is not None else sys.path[0] + SEPARATOR + 'plugins'
+        for path in (self.directory, os.path.dirname(os.path.abspath(__file__))):
+            if path not in sys.path:
+                sys.path.append(path)
+        self.local = set()
+        if os.path.isdir(self.directory):
+            self.local = set(name[:-3] for name in os.listdir(self.directory) if name.endswith('.py'))
+        self.installed = installed_plugins()
+        self.modules = {}
+
+    def names(self):
+        return sorted(self.local | set(self.installed))
+
+    def get(self, name):
+        if name not in self.modules:
+            try:
+                if name in self.installed and name not in self.local:
+                    mod = self.installed[name].load()
+                else:
+                    mod = import_module(name, self.debug)
+            except Exception as err:
+                raise Exception("plugin " + name + " could not be loaded: " + repr(err))
+            if not callable(getattr(mod, 'fetch_repo', None)):
+                raise Exception("plugin " + name + " has no fetch_repo")
+            self.modules[name] = mod
+        return self.modules[name]
+
+    def validate(self, name, plugin_dict):
+        # Returns what is wrong with a plugin's dictionary, as a list of
+        # messages. The keys the script adds itself are always allowed.
+        mod = self.get(name)
+        if not isinstance(plugin_dict, dict):
+            return ["plugin " + name + " needs a dictionary of parameters"]
+        problems = ["plugin " + name + ": '" + key + "' is required"
+                    for key in getattr(mod, 'REQUIRED', ()) if key not in plugin_dict]
+        schema = getattr(mod, 'SCHEMA', None)
+        if schema is not None:
+            for key, value in plugin_dict.items():
+                if key in ('timestamp', 'logfile', 'debug', 'backend', 'bandwidth', 'store', 'repo_index', 'trace'):
+                    continue
+                if key not in schema:
+                    problems.append("plugin " + name + ": unknown parameter '" + key + "'")
+                elif not isinstance(value, schema[key]):
+                    types = schema[key] if isinstance(schema[key], tuple) else (schema[key],)
+                    problems.append("plugin " + name + ": '" + key + "' should be "
+                                    + " or ".join(kind.__name__ for kind in types))
+        if not problems and callable(getattr(mod, 'check', None)):
+            problems = ["plugin " + name + ": " + problem for problem in mod.check(plugin_dict)]
+        return problems
+
+def installed_plugins():
+# The entry points in the 'aptly_update.plugins' group, by name. Finding them
+# needs importlib.metadata, which is new in Python 3.8.
+    try:
+        from importlib import metadata
+    except ImportError:
+        return {}
+    found = metadata.entry_points()
+    found = found.select(group=PLUGIN_GROUP) if hasattr(found, 'select') else found.get(PLUGIN_GROUP, [])
+    return {entry.name: entry for entry in found}
+
+def check_plugins(entries, registry):
+# Loads every plugin the entries name and checks its dictionary, and returns
+# everything that is wrong, so that a missing or broken plugin is found before
+# the mirror updates rather than after them. As in build_graph(), a plugin is
+# configured by the first entry that names it.
+    problems = []
+    seen = set()
+    for hash in entries:
+        for plugin in hash.get('plugins') or []:
+            plugin_name, plugin_dict = next(iter(plugin.items()))
+            if plugin_name in seen:
+                continue
+            seen.add(plugin_name)
+            try:
+                problems.extend(registry.validate(plugin_name, plugin_dict if plugin_dict is not None else {}))
+            except Exception as err:
+                problems.append(str(err))
+    return problems
+
+def call_plugin(mod, plugin_dict, debug, backend=None, bandwidth=None, store=None, repo_index=None, trace=None):
 # Calls a plugin with the given module, plugin name, plugin dictionary, and debug mode.
 #
 # Args:
@@ -166,20 +2529,141 @@ def call_plugin(mod, plugin_dict, debug):
 #     plugin_name (str): The name of the plugin to call.
 #     plugin_dict (dict): The dictionary containing the plugin's configuration.
 #     debug (bool): Whether to enable debug mode.
+#     backend: What the plugin should use to talk to aptly. Defaults to the
+#              command line.
+#     bandwidth: The TokenBucket the plugin's downloads should take from, if
+#              the run has a bandwidth budget.
+#     store: The DownloadStore to keep downloads in, if the run has one.
+#     repo_index: The RepoIndex of what the local repos hold. Defaults to a
+#              new one.
+#     trace: The Trace the plugin's spans go in, if the run has one.
 #
 # Returns:
-#     None
+#     Whatever the plugin returns: a dictionary of what it did, or None if it
+#     made its snapshot the usual way.
 #
 # Raises:
-#     None
+#     Whatever the plugin raises when it fails.
 #
 # Side Effects:
 #     - Calls the 'fetch_repo' method of the plugin module with the plugin dictionary.
+    plugin_args(plugin_dict, debug, backend, bandwidth, store, repo_index, trace)
+    dbgprint(debug, "Dict:        ", plugin_dict)
+    return mod.fetch_repo(plugin_dict)
+
+def plugin_args(plugin_dict, debug, backend, bandwidth=None, store=None, repo_index=None, trace=None):
     plugin_dict['timestamp'] = get_timestamp()
     plugin_dict['logfile'] = get_logfile()
     plugin_dict['debug'] = debug
-    dbgprint(debug, "Dict:        ", plugin_dict)
-    mod.fetch_repo(plugin_dict)
+    plugin_dict['backend'] = backend if backend is not None else CliBackend(debug)
+    plugin_dict['bandwidth'] = bandwidth
+    plugin_dict['store'] = store
+    plugin_dict['repo_index'] = repo_index if repo_index is not None else RepoIndex(plugin_dict['backend'])
+    plugin_dict['trace'] = trace if trace is not None else NO_TRACE
+    return plugin_dict
+
+class PluginLoop:
+# One event loop, in a thread of its own, on which every plugin of a run is
+# started. Async plugins share one pooled HTTP client and a limit on
+# connections per host, so dozens of them can check and download at once
+# without a thread each. Plain plugins are run in a pool of 'plugin_jobs'
+# threads.
+    def __init__(self, settings, debug):
+        self.debug = debug
+        self.per_host = settings['jobs_per_host']
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=settings['plugin_jobs'],
+                                                              thread_name_prefix='plugin')
+        self.session = None
+        self.hosts = {}
+
+    def submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def http(self):
+        # aiohttp is only needed if an async plugin uses HTTP.
+        if self.session is None:
+            try:
+                import aiohttp
+            except ImportError:
+                raise Exception("async plugins need aiohttp: pip install aiohttp")
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit_per_host=self.per_host))
+        return self.session
+
+    def limit(self, url):
+        host = urllib.parse.urlparse(url).netloc
+        if host not in self.hosts:
+            self.hosts[host] = asyncio.Semaphore(self.per_host)
+        return self.hosts[host]
+
+    def close(self):
+        if self.session is not None:
+            self.submit(self.session.close()).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.executor.shutdown()
+
+class PluginContext:
+# What an async plugin is given instead of a dictionary:
+#
+#     name      the plugin's name, which is also the name of its repo and snapshot
+#     args      the plugin's dictionary from the yaml, with 'timestamp', 'logfile',
+#               'debug', 'backend', 'bandwidth', 'store', 'repo_index' and 'trace'
+#               added as for other plugins
+#     timestamp, debug, backend, bandwidth, store, repo_index, trace   the same, for
+#               convenience
+#     http      an aiohttp.ClientSession shared by all plugins
+#     limit(url)  an asyncio semaphore for the url's host: 'async with ctx.limit(url):'
+#     await run(argv)   runs a command with run_command()
+#     await aptly(operation, *args)   calls the backend, e.g.
+#               await ctx.aptly('repo_add', 'vscode', [filename])
+#     log(text)  writes a line to the log file, and prints it in debug mode
+#     await throttle(size)   waits until 'size' more bytes may be downloaded
+#               within the bandwidth budget, if there is one
+#     span(name)  'with ctx.span(name):' adds a span to the plugin's lane of the
+#               --trace timeline, if there is one
+    def __init__(self, name, plugin_dict, debug, backend, plugins, bandwidth=None, store=None, repo_index=None,
+                 trace=None):
+        self.name = name
+        self.args = plugin_args(plugin_dict, debug, backend, bandwidth, store, repo_index, trace)
+        self.timestamp = self.args['timestamp']
+        self.debug = debug
+        self.backend = self.args['backend']
+        self.bandwidth = bandwidth
+        self.store = store
+        self.repo_index = self.args['repo_index']
+        self.trace = self.args['trace']
+        self.plugins = plugins
+
+    @property
+    def http(self):
+        return self.plugins.http()
+
+    def limit(self, url):
+        return self.plugins.limit(url)
+
+    async def run(self, argv, timeout=None, retries=0):
+        return await self.plugins.loop.run_in_executor(self.plugins.executor, run_command,
+                                                       argv, self.debug, timeout, retries)
+
+    async def aptly(self, operation, *args):
+        return await self.plugins.loop.run_in_executor(self.plugins.executor,
+                                                       getattr(self.backend, operation), *args)
+
+    async def throttle(self, size):
+        if self.bandwidth is not None:
+            await self.bandwidth.take_async(size)
+
+    def span(self, name, **args):
+        return self.trace.span(name, 'plugin', "plugin:" + self.name, **args)
+
+    def log(self, text):
+        dbgprint(self.debug, self.name + ":", text)
+        with open(get_logfile(), "a") as log:
+            log.write(self.name + ": " + text + "\n")
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -189,6 +2673,30 @@ def parse_args():
     parser.add_argument('-y', '--yaml', '-f', '--file',
                         nargs=1,
                         help='YAML file name')
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        help='number of mirrors to update at once')
+    parser.add_argument('--deadline',
+                        metavar='HH:MM',
+                        help='skip what cannot be published by then, least important first')
+    parser.add_argument('--force',
+                        help='ignore what was done on previous runs',
+                        action='store_true')
+    parser.add_argument('--plan',
+                        help='print what would be done, as JSON, and exit',
+                        action='store_true')
+    parser.add_argument('--daemon',
+                        help='keep running, polling entries with a poll interval and running the rest nightly',
+                        action='store_true')
+    parser.add_argument('--metrics',
+                        metavar='FILE',
+                        help='write OpenMetrics for node_exporter to FILE at the end of each run')
+    parser.add_argument('--trace',
+                        metavar='FILE',
+                        help='write a timeline of the run to FILE as Chrome Trace Event JSON')
+    parser.add_argument('--report',
+                        nargs='?', type=int, const=10, metavar='RUNS',
+                        help='report on the last RUNS runs (default 10) and exit')
     args = parser.parse_args()
     if args.debug:
         print("Debug mode")
@@ -198,17 +2706,136 @@ def parse_args():
         print("Logfile:     ", get_logfile())
     return args
 
-def xqt(cmd, debug):
+def run_command(argv, debug, timeout=None, retries=0, backoff=30):
+# Runs a command, given as a list of arguments rather than through a shell,
+# and returns a Result with its exit code, how long it took on the clock and
+# in CPU, and how many bytes of output went to the log file. The output is
+# copied to the log as it arrives rather than being kept in memory; only the
+# last few lines are kept, for the error message. A command that runs for
+# longer than 'timeout' seconds is killed. A command that fails is tried again
+# up to 'retries' more times, waiting 'backoff' seconds the first time and
+# twice as long each time after that.
+#
+# In debug mode nothing is run and the command is printed as it would be typed.
     if debug:
-        print(cmd)
-    else:
-        subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, 
-                                        stderr=subprocess.STDOUT,
-                                          text=True).stdout
+        print(" ".join(argv) + " >> " + get_logfile() + " 2>&1")
+        return Result(True, 0)
+    attempt = 0
+    while True:
+        result = run_once(argv, timeout)
+        attempt += 1
+        result.attempts = attempt
+        if result.ok or retries < attempt:
+            return result
+        with open(get_logfile(), "a") as log:
+            log.write("Retrying " + " ".join(argv) + " in " + str(backoff) + "s\n")
+        time.sleep(backoff)
+        backoff *= 2
+
+def run_once(argv, timeout):
+    start = time.monotonic()
+    tail = collections.deque(maxlen=20)
+    logged = 0
+    downloaded = None
+    try:
+        process = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except OSError as err:
+        return Result(False, 127, str(err))
+    timer = threading.Timer(timeout, process.kill) if timeout else None
+    if timer is not None:
+        timer.start()
+    with open(get_logfile(), "ab") as log:
+        log.write(("==> " + " ".join(argv) + "\n").encode())
+        for line in process.stdout:
+            log.write(line)
+            log.flush()
+            logged += len(line)
+            tail.append(line)
+            downloaded = download_size(line.decode(errors="replace"), downloaded)
+    process.stdout.close()
+    status, cpu = wait_for(process)
+    wall = time.monotonic() - start
+    timed_out = timer is not None and not timer.is_alive() and status != 0
+    if timer is not None:
+        timer.cancel()
+    output = b"".join(tail).decode(errors="replace")
+    if timed_out:
+        output = output + "killed after " + str(timeout) + "s\n"
+    with open(get_logfile(), "a") as log:
+        log.write("<== exit " + str(status) + " after " + "%.1f" % wall + "s\n")
+    result = Result(status == 0, status, output)
+    result.wall = wall
+    result.cpu = cpu
+    result.logged = logged
+    result.timed_out = timed_out
+    result.downloaded = downloaded
+    return result
+
+def download_size(text, default=None):
+# Returns the number of bytes in an aptly 'Download queue: 25 items (30.12 MiB)'
+# line in the text, or the default if there is none.
+    match = re.search(r'Download queue: \d+ items \(([\d.]+) (B|KiB|MiB|GiB|TiB)\)', text)
+    if not match:
+        return default
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+def freed_size(text):
+# Returns the number of bytes in the 'Disk space freed: 1.23 GiB...' line of
+# 'aptly db cleanup', or None if there is none.
+    match = re.search(r'Disk space freed: ([\d.]+) (B|KiB|MiB|GiB|TiB)', text)
+    if not match:
+        return None
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+def format_size(size):
+    for unit in ('TiB', 'GiB', 'MiB', 'KiB'):
+        if SIZE_UNITS[unit] <= size:
+            return "%.2f %s" % (size / SIZE_UNITS[unit], unit)
+    return str(size) + " B"
+
+def wait_for(process):
+# Waits for a process and returns its exit code and the CPU seconds it used.
+# The CPU time needs wait4(), so it is None on Windows.
+    if not hasattr(os, 'wait4'):
+        return process.wait(), None
+    pid, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    return process.returncode, usage.ru_utime + usage.ru_stime
+
+def query(argv, debug):
+# Runs a read-only aptly command and returns its output. Debug mode promises
+# not to touch aptly, so nothing is run and the output is empty.
+    if debug:
+        return ""
+    try:
+        return subprocess.run(argv, stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL,
+                                      text=True).stdout
+    except OSError:
+        return ""
+
+def query_result(argv, debug):
+# The same as query(), but returning a Result, so that a command that could not
+# be run or failed is not taken for one that found nothing. The output is what
+# the command printed if it worked, and its errors if not.
+    if debug:
+        return Result(True, 0)
+    try:
+        done = subprocess.run(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    except OSError as err:
+        return Result(False, 127, str(err))
+    return Result(done.returncode == 0, done.returncode, done.stdout if done.returncode == 0 else done.stderr)
 
 def get_timestamp():
     return TIMESTAMP
 
+def new_run():
+# Gives each run in daemon mode a timestamp, and so snapshots and a log file,
+# of its own.
+    global TIMESTAMP, LOGFILE
+    TIMESTAMP = datetime.datetime.now().strftime("%Y%m%dT%H:%M:%S")
+    LOGFILE = sys.argv[0] + "-run-" + TIMESTAMP
+
 def get_logfile():
     return LOGFILE
 
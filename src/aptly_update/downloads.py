@@ -0,0 +1,164 @@
+"""
+downloads.py
+
+What the plugins that come with aptly-update.py share for downloading .deb
+packages: resumable, checked downloads that keep to the bandwidth budget,
+conditional requests, the download store and --trace spans. It lives next to
+aptly_update.py rather than in the plugins directory, so that it is not taken
+for a plugin and a plugin installed as a package can import it too:
+
+    from downloads import get_file, qualify_filename
+
+Its tests are with those of vscode.py, which imports these under their old
+names.
+"""
+
+import requests
+import re
+import os
+import hashlib
+import time
+import contextlib
+from os.path import exists, getsize
+
+SESSION = requests.Session() # One keep-alive connection for a HEAD and its download
+CHUNK = 1 << 16
+
+def check_status(req: requests.models.Response):
+    if req.status_code == 200:
+        return True
+    else:
+        return False
+
+def qualify_filename(path, filename):
+    if path[-1] != '/':
+        path = path + '/'
+    return path + filename
+
+def check_file(filename):
+    if exists(filename):
+        return True
+    else:
+        return False
+
+class Stalled(Exception):
+    pass
+
+def get_file(url, fqfile, timeout, debug, size=None, sha256=None,
+             min_rate=10240, stall_time=60, tries=5, bandwidth=None, session=None):
+# Downloads url to fqfile. Returns "" on success or what went wrong.
+#
+# The download goes to fqfile + ".part" in chunks and is only renamed to fqfile
+# once it is complete and checked, so fqfile never exists half written. If the
+# connection drops or stalls, the download carries on from where it got to with
+# an HTTP Range request, up to 'tries' times. 'timeout' is how many seconds to
+# wait for any data at all; a download that averages less than 'min_rate'
+# bytes a second over 'stall_time' seconds counts as stalled. The result must
+# be 'size' bytes long and have the SHA-256 'sha256', where these are known,
+# and must look like a .deb. 'bandwidth' is the token bucket that keeps the
+# run within its bandwidth budget, if it has one; time spent waiting on it does
+# not count towards a stall. 'session' is the requests.Session to download with,
+# SESSION if it is not given.
+    part = fqfile + ".part"
+    if debug:
+        return "GET " + url + " -> " + fqfile
+    error = ""
+    for attempt in range(tries):
+        error = get_part(url, part, timeout, min_rate, stall_time, bandwidth, session)
+        if error == "":
+            break
+    if error != "":
+        return error
+    error = verify_file(part, size, sha256)
+    if error != "":
+        os.remove(part)
+        return error
+    os.replace(part, fqfile)
+    return ""
+
+def get_part(url, part, timeout, min_rate, stall_time, bandwidth=None, session=None):
+    have = getsize(part) if exists(part) else 0
+    headers = {'Range': 'bytes=' + str(have) + '-'} if have else {}
+    try:
+        with (session or SESSION).get(url, headers=headers, stream=True, timeout=timeout) as req:
+            if req.status_code == 416:
+                return ""                   # We already have all of it
+            if req.status_code not in (200, 206):
+                return "HTTP " + str(req.status_code) + " from " + url
+            mode = "ab" if req.status_code == 206 else "wb" # 200: the server ignored the range
+            with open(part, mode) as part_file:
+                window_start = time.monotonic()
+                window_bytes = 0
+                for chunk in req.iter_content(CHUNK):
+                    part_file.write(chunk)
+                    if bandwidth is not None:
+                        waited = time.monotonic()
+                        bandwidth.take(len(chunk))
+                        window_start += time.monotonic() - waited
+                    window_bytes += len(chunk)
+                    elapsed = time.monotonic() - window_start
+                    if stall_time <= elapsed:
+                        if window_bytes < min_rate * elapsed:
+                            raise Stalled(str(int(window_bytes / elapsed)) + " bytes/s from " + url)
+                        window_start = time.monotonic()
+                        window_bytes = 0
+    except (requests.RequestException, Stalled) as err:
+        return str(err)
+    return ""
+
+def verify_file(fqfile, size, sha256):
+    if size is not None and getsize(fqfile) != size:
+        return "Expected " + str(size) + " bytes but got " + str(getsize(fqfile))
+    digest = hashlib.sha256()
+    with open(fqfile, "rb") as deb:
+        if deb.read(8) != b"!<arch>\n":
+            return fqfile + " is not a .deb"
+        deb.seek(0)
+        for chunk in iter(lambda: deb.read(CHUNK), b""):
+            digest.update(chunk)
+    if sha256 is not None and digest.hexdigest() != sha256.lower():
+        return "Checksum mismatch: expected " + sha256 + " but got " + digest.hexdigest()
+    return ""
+
+def get_checksum(args, session=None):
+# The expected SHA-256 of the download, from 'sha256' in the yaml or from
+# 'checksum_url', which may be JSON with a 'sha256hash' (as Microsoft's update
+# API is) or text containing the hash. None if neither is given.
+    if 'sha256' in args:
+        return args['sha256']
+    if 'checksum_url' not in args or args['debug']:
+        return None
+    req = (session or SESSION).get(args['checksum_url'], timeout=args['timeout'])
+    if not check_status(req):
+        return None
+    if 'json' in req.headers.get('Content-Type', ''):
+        return req.json().get('sha256hash')
+    found = re.search(r'\b[0-9a-fA-F]{64}\b', req.text)
+    return found.group(0) if found else None
+
+
+def keep_stored(store, cache, fqfile, key):
+# Tells the download store, if there is one, that the file found last time is
+# still in use, so that it is not pruned.
+    if store is not None and cache.get('sha256'):
+        store.link(cache['sha256'], fqfile, key)
+
+def span(args, name, **fields):
+# 'with span(args, name):' records a span for aptly-update.py's --trace, if the
+# plugin was given a trace.
+    if args.get('trace') is None:
+        return contextlib.nullcontext()
+    return args['trace'].span(name, 'plugin', **fields)
+
+def conditional_headers(cache):
+    headers = {}
+    if cache.get('etag'):
+        headers['If-None-Match'] = cache['etag']
+    if cache.get('last_modified'):
+        headers['If-Modified-Since'] = cache['last_modified']
+    return headers
+
+
+def dbgprint(dbg, text, obj):
+    if dbg:
+        print(text, obj)
@@ -0,0 +1,284 @@
+"""
+http_deb.py
+
+This is a plugin for aptly-update.py. It downloads .deb packages that vendors
+publish at a fixed URL, such as Chrome, Zoom or Slack, adds each to a local
+repo and makes a snapshot that can be published or merged with other snapshots.
+Any number of packages can be given, and they are all fetched in one pass over
+a shared keep-alive session, several at a time, so adding another costs no more
+connections or processes than adding the first.
+
+-
+  name: vendor
+  mirrors: []
+  plugins:
+    - http_deb:
+        path: /media/thumb/aptly/vendor
+        timeout: 600
+        packages:
+          - url: https://dl.google.com/linux/direct/google-chrome-stable_current_amd64.deb
+            repo: chrome
+          - url: https://zoom.us/client/latest/zoom_amd64.deb
+            repo: zoom
+            filename: '[0-9.]+/zoom_amd64\\.deb'
+
+Parameters:
+
+    path        the directory to download to
+    packages    the packages, each with:
+        url           where to download it from
+        repo          the aptly repo to add it to, which must already exist
+        filename      a regular expression for the file name (optional)
+        sha256        the expected SHA-256 of the download (optional)
+        checksum_url  where to get the expected SHA-256 from (optional)
+    timeout     seconds to wait for a server to send anything (default 600)
+    jobs        how many packages to download at once (default 4)
+    min_rate    bytes a second below which a download counts as stalled
+                (default 10240)
+    stall_time  seconds over which min_rate is averaged (default 60)
+
+A package's file name is the one the server gives in its Content-Disposition
+header, or else the last part of the URL its download redirects to. Where that
+does not change from one version to the next, as with Zoom, 'filename' is
+searched for in the header and then in that URL, and what it matches, with any
+"/" changed to "_", is the file name.
+
+Downloads are resumed and checked as vscode.py's are, with the helpers the
+two share in downloads.py. What was found is
+remembered in '.http_deb-cache.json' in 'path', and a package the server says
+has not changed (If-None-Match and If-Modified-Since), or that still has the
+same file name, is not downloaded again. The packages of each repo that are
+not in it already are added in one 'aptly repo add', and only repos with
+something new get a new snapshot.
+With more than one repo, their snapshots are merged into the plugin's.
+
+If aptly-update.py has a download store, downloads are kept in it and linked
+into 'path'. A package whose checksum is known and that the store already has
+is not downloaded, and one that has been renamed but has already been added to
+its repo is not added again.
+
+With --trace, each package's HEAD request and download, each repo add and each
+snapshot has a span in the timeline, in the lane of the thread it ran in.
+
+Its tests are in the parent directory, along with aptly-update.py itself.
+"""
+
+import requests
+import re
+import os
+import posixpath
+import json
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from os.path import exists, getsize
+try:
+    from downloads import (get_file, get_checksum, conditional_headers, keep_stored, qualify_filename,
+                           check_status, span, dbgprint)
+except ImportError:
+    # Imported from the source tree, as the tests do
+    from ..downloads import (get_file, get_checksum, conditional_headers, keep_stored, qualify_filename,
+                             check_status, span, dbgprint)
+
+CACHE = ".http_deb-cache.json" # Kept in 'path'
+
+# The parameters above, checked by aptly_update.py before the run starts, as
+# the packages are by check().
+SCHEMA = {'path': str, 'packages': list, 'timeout': (int, float), 'jobs': int,
+          'min_rate': (int, float), 'stall_time': (int, float)}
+REQUIRED = ('path', 'packages')
+PACKAGE = {'url': str, 'repo': str, 'filename': str, 'sha256': str, 'checksum_url': str}
+
+def check(args):
+# What aptly_update.py's check of the parameters cannot see for itself, called
+# by it before the run starts.
+    return check_packages(args['packages']) if 'packages' in args else []
+
+def check_packages(packages):
+# Returns what is wrong with the list of packages, as SCHEMA cannot look inside it.
+    problems = []
+    for number, package in enumerate(packages, 1):
+        if not isinstance(package, dict):
+            problems.append("package " + str(number) + " should be a dictionary")
+            continue
+        for key in ('url', 'repo'):
+            if key not in package:
+                problems.append("package " + str(number) + " has no " + key)
+        for key, value in package.items():
+            if key not in PACKAGE:
+                problems.append("package " + str(number) + ": unknown parameter '" + key + "'")
+            elif not isinstance(value, PACKAGE[key]):
+                problems.append("package " + str(number) + ": '" + key + "' should be text")
+    return problems
+
+def make_session(jobs):
+# One session for every package, with a connection kept open for each download
+# that can run at once.
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=jobs, pool_maxsize=jobs)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def package_filename(req, package):
+# The name to save a package as, or None if it cannot be worked out.
+    disposition = re.findall(r'filename="?([^";]+)', req.headers.get('Content-Disposition', ''))
+    path = urlparse(req.url).path
+    if 'filename' in package:
+        for text in disposition + [path]:
+            found = re.search(package['filename'], text)
+            if found:
+                return found.group(0).replace("/", "_")
+        return None
+    if disposition:
+        return disposition[0]
+    return posixpath.basename(path) or None
+
+def load_cache(path):
+# What the last run found: for each package URL, the URL it redirected to,
+# its ETag, Last-Modified, file name and SHA-256 in the download store, if
+# there is one; the snapshot made of each repo; and the snapshot returned,
+# with the repo snapshots it was made from.
+    fqfile = qualify_filename(path, CACHE)
+    if not exists(fqfile):
+        return {'packages': {}, 'repos': {}}
+    with open(fqfile) as cache_file:
+        return json.load(cache_file)
+
+def save_cache(path, cache):
+    fqfile = qualify_filename(path, CACHE)
+    with open(fqfile + ".tmp", "w") as cache_file:
+        json.dump(cache, cache_file, indent=2)
+    os.replace(fqfile + ".tmp", fqfile)
+
+def fetch_package(session, package, args, cached):
+# Finds out whether a package has changed and downloads it if it has. Returns
+# a dictionary with the package's 'repo', its 'file', whether it 'changed',
+# the 'bytes' downloaded, what to remember of it in the cache as 'cache', any
+# 'error' and, with a download store, its 'sha256'.
+    done = {'repo': package['repo'], 'file': None, 'changed': False, 'bytes': 0, 'cache': cached, 'error': "",
+            'sha256': None}
+    timeout = args.get('timeout', 600)
+    try:
+        with span(args, "HEAD", url=package['url']):
+            req = session.head(package['url'], allow_redirects=True, timeout=timeout,
+                               headers=conditional_headers(cached))
+    except requests.RequestException as err:
+        done['error'] = str(err)
+        return done
+    if req.status_code == 304 and cached.get('filename'):
+        filename = cached['filename']
+    elif check_status(req):
+        filename = package_filename(req, package)
+        if filename is None:
+            done['error'] = "no file name for " + package['url']
+            return done
+    else:
+        done['error'] = package['url'] + " is not a valid URL"
+        return done
+    fqfile = qualify_filename(args['path'], filename)
+    done['file'] = fqfile
+    store = args.get('store')
+    if filename == cached.get('filename') and exists(fqfile):
+        dbgprint(args['debug'], "Unchanged:   ", filename)
+        keep_stored(store, cached, fqfile, package['url'])
+        return done
+    done['changed'] = True
+    if not exists(fqfile):
+        size = int(req.headers['Content-Length']) if 'Content-Length' in req.headers else None
+        checksum = get_checksum(dict(package, timeout=timeout, debug=args['debug']), session)
+        if store is not None and checksum is not None and store.link(checksum, fqfile, package['url']):
+            dbgprint(args['debug'], "Stored:      ", fqfile)
+        else:
+            # req.url is where the redirects led, so resuming does not redirect again
+            with span(args, "download", url=req.url, size=size):
+                error = get_file(req.url, fqfile, timeout, args['debug'], size, checksum,
+                                 args.get('min_rate', 10240), args.get('stall_time', 60),
+                                 bandwidth=args.get('bandwidth'), session=session)
+            dbgprint(args['debug'], "Download:    ", error)
+            if not exists(fqfile) and not args['debug']:
+                done['error'] = "failed to download " + fqfile + " from " + package['url'] + ": " + error
+                return done
+            done['bytes'] = getsize(fqfile) if exists(fqfile) else 0
+    if store is not None and exists(fqfile):
+        done['sha256'] = store.add(fqfile, package['url'])
+        # Renamed, but what is in the repo already
+        done['changed'] = not store.in_repo(done['sha256'], package['repo'])
+    done['cache'] = {'url': req.url,
+                     'etag': req.headers.get('ETag'),
+                     'last_modified': req.headers.get('Last-Modified'),
+                     'filename': filename,
+                     'sha256': done['sha256']}
+    return done
+
+def fetch_repo(args):
+# Fetches every package, then adds the new ones to their repos and snapshots
+# the repos that changed. Nothing is added to aptly and the snapshot from last
+# time is returned if no package has changed, or if the repo index says the
+# ones that have are in their repos already. A package that cannot be fetched
+# is reported and left for the next run; the others are still added, and its
+# repo's snapshot from last time is used. A repo that has never had a snapshot
+# fails the plugin, rather than the others being published without it, as
+# does anything aptly will not do; either raises an exception.
+    dbgprint(args['debug'], "Args:        ", args)
+    problems = check_packages(args['packages'])
+    if problems:
+        raise Exception("; ".join(problems))
+    cache = load_cache(args['path'])
+    jobs = args.get('jobs', 4)
+    session = make_session(jobs)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        fetched = list(executor.map(lambda package: fetch_package(session, package, args,
+                                                                  cache['packages'].get(package['url'], {})),
+                                    args['packages']))
+    session.close()
+    repos = {}
+    for package, done in zip(args['packages'], fetched):
+        if done['error']:
+            print("Error: http_deb: " + done['error'])
+            continue
+        cache['packages'][package['url']] = done['cache']
+        repos.setdefault(done['repo'], []).append(done)
+    total = sum(done['bytes'] for done in fetched)
+    changed = [repo for repo, packages in repos.items()
+               if any(done['changed'] for done in packages) or repo not in cache['repos']]
+    backend = args['backend']
+    index = args.get('repo_index')
+    renewed = []
+    for repo in changed:
+        added = [done for done in repos[repo] if done['changed'] or repo not in cache['repos']]
+        files = [done['file'] for done in added]
+        with span(args, "repo add", repo=repo, files=len(files)):
+            rtn = index.add(repo, files) if index is not None else backend.repo_add(repo, files)
+        if rtn.ok and (index is None or rtn.data or repo not in cache['repos']):
+            with span(args, "snapshot", repo=repo):
+                rtn = backend.snapshot_from_repo(repo + "-" + args['timestamp'], repo)
+            cache['repos'][repo] = repo + "-" + args['timestamp']
+            renewed.append(repo)
+        if not rtn.ok:
+            raise Exception(rtn.error())
+        if not args['debug']:
+            for done in added:
+                if done['sha256'] is not None:
+                    args['store'].set_in_repo(done['sha256'], repo)
+    named = sorted(set(package['repo'] for package in args['packages']))
+    missing = [repo for repo in named if repo not in cache['repos']]
+    if missing:
+        raise Exception("no snapshot of " + ", ".join(missing) + " to publish")
+    inputs = [cache['repos'][repo] for repo in named]
+    if not renewed and cache.get('snapshot') and cache.get('inputs') == inputs:
+        dbgprint(args['debug'], "Unchanged:   ", named)
+        if not args['debug']:
+            save_cache(args['path'], cache)
+        return {'bytes': total, 'snapshot': cache['snapshot'], 'inputs': inputs, 'changed': False}
+    snapshot = inputs[0]
+    if len(inputs) > 1:
+        snapshot = "http_deb-" + args['timestamp']
+        with span(args, "merge"):
+            rtn = backend.snapshot_merge(snapshot, inputs)
+        if not rtn.ok:
+            raise Exception(rtn.error())
+    if not args['debug']:
+        cache['snapshot'] = snapshot
+        cache['inputs'] = inputs
+        save_cache(args['path'], cache)
+    return {'bytes': total, 'snapshot': snapshot, 'inputs': inputs, 'changed': True}
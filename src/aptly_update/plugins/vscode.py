@@ -8,73 +8,155 @@ Its tests are in the parent directory, along with aptly-update.py itself.
 One test will fail without internet access. Parameters are passed in from
 aptly-update.py, which reads them from a yaml file. See the aptly_update.py
 documentation for more information about plugins.
+
+Parameters:
+
+    url         where to download from
+    path        the directory to download to
+    timeout     seconds to wait for the server to send anything
+    min_rate    bytes a second below which a download counts as stalled
+                (default 10240)
+    stall_time  seconds over which min_rate is averaged (default 60)
+    sha256      the expected SHA-256 of the download (optional)
+    checksum_url where to get the expected SHA-256 from (optional), e.g.
+                https://update.code.visualstudio.com/api/update/linux-deb-x64/stable/latest
+
+Downloads are resumed if the connection drops or stalls, and a file only
+appears in 'path' once it has been downloaded completely and checked.
+If aptly-update.py has been given a 'bandwidth' budget, downloads keep to the
+plugins' share of it.
+
+What was found is remembered in '.vscode-cache.json' in 'path'. The next run
+asks the server whether the download has changed since (If-None-Match and
+If-Modified-Since), and if it has not, or if it still has the same file name,
+nothing is added to aptly and the snapshot from last time is used again.
+
+If aptly-update.py has a download store, downloads are kept in it and linked
+into 'path', and old versions are removed from both as the store is pruned.
+
+With --trace, the HEAD request, the download, the repo add and the snapshot
+each have a span in the timeline.
 """
 
 import requests
 import re
-from os.path import exists
-import subprocess
+from os.path import exists, getsize
+import os
+import json
+try:
+    from downloads import (SESSION, check_status, qualify_filename, check_file, get_file, verify_file,
+                           get_checksum, keep_stored, span, conditional_headers, dbgprint)
+except ImportError:
+    # Imported from the source tree, as the tests do
+    from ..downloads import (SESSION, check_status, qualify_filename, check_file, get_file, verify_file,
+                             get_checksum, keep_stored, span, conditional_headers, dbgprint)
 
-def check_status(req: requests.models.Response):
-    if req.status_code == 200:
-        return True
-    else:
-        return False
+CACHE = ".vscode-cache.json" # Kept in 'path'
+
+# The parameters above, checked by aptly_update.py before the run starts.
+SCHEMA = {'url': str, 'path': str, 'timeout': (int, float), 'min_rate': (int, float),
+          'stall_time': (int, float), 'sha256': str, 'checksum_url': str}
+REQUIRED = ('url', 'path', 'timeout')
 
 def redirect_header(req: requests.models.Response):
     return re.findall("filename=(.+);", req.headers['Content-Disposition'])[0]
 
-def qualify_filename(path, filename):
-    if path[-1] != '/':
-        path = path + '/'
-    return path + filename
-
-def check_file(filename):
-    if exists(filename):
-        return True
-    else:
-        return False
+def load_cache(path):
+# What the last run found, kept in the download directory: the URL the
+# download redirected to, its ETag and Last-Modified, the file name, its
+# SHA-256 if it is in a download store, and the snapshot that was made from it.
+    fqfile = qualify_filename(path, CACHE)
+    if not exists(fqfile):
+        return {}
+    with open(fqfile) as cache_file:
+        return json.load(cache_file)
 
-def get_file(url, fqfile, timeout, debug):
-    cmd = "curl --no-progress-meter --max-time " + str(timeout) + " --write-out %{exitcode} --output " + fqfile + " '" + url + "' 2>&1"
-    if debug:
-        return cmd
-    else:
-        return subprocess.run(cmd, shell=True,
-                                  stdout=subprocess.PIPE, 
-                                  stderr=subprocess.STDOUT,
-                                    text=True).stdout
+def save_cache(path, cache):
+    fqfile = qualify_filename(path, CACHE)
+    with open(fqfile + ".tmp", "w") as cache_file:
+        json.dump(cache, cache_file, indent=2)
+    os.replace(fqfile + ".tmp", fqfile)
 
 def fetch_repo(args):
+# Nothing is added to aptly and no snapshot is made if the server says the
+# download has not changed since last time (304), or if it has the same file
+# name as last time; the snapshot from last time is returned instead. With a
+# download store, the same goes for a file that has been renamed but is
+# otherwise what was added last time, and a file the store already has is
+# linked rather than downloaded. A package already in the repo, going by the
+# run's repo index, is not added again and gets no new snapshot either.
+# Anything that goes wrong raises an exception, which fails the plugin's step.
     dbgprint(args['debug'], "Args:        ",  args)
-    req = requests.head(args['url'], allow_redirects=True)
-    if check_status(req):
-        filename = redirect_header(req)
+    cache = load_cache(args['path'])
+    with span(args, "HEAD", url=args['url']):
+        req = SESSION.head(args['url'], allow_redirects=True, timeout=args['timeout'],
+                           headers=conditional_headers(cache))
+    if req.status_code == 304 and cache.get('snapshot') and check_file(qualify_filename(args['path'], cache['filename'])):
+        dbgprint(args['debug'], "Unchanged:   ",  cache['filename'])
+        keep_stored(args.get('store'), cache, qualify_filename(args['path'], cache['filename']), args['url'])
+        return {'bytes': 0, 'snapshot': cache['snapshot'], 'changed': False}
+    # Unchanged, but the file has gone, so it is downloaded again from where it was
+    missing = req.status_code == 304 and bool(cache.get('filename')) and bool(cache.get('url'))
+    if missing or check_status(req):
+        filename = cache['filename'] if missing else redirect_header(req)
         dbgprint(args['debug'], "Filename:    ",  filename)
         fqfile = qualify_filename(args['path'], filename)
+        if filename == cache.get('filename') and cache.get('snapshot') and check_file(fqfile):
+            dbgprint(args['debug'], "Unchanged:   ",  filename)
+            keep_stored(args.get('store'), cache, fqfile, args['url'])
+            return {'bytes': 0, 'snapshot': cache['snapshot'], 'changed': False}
         rtn = ""
+        snapshot = "vscode-" + args['timestamp']
+        done = {'bytes': 0, 'snapshot': snapshot, 'changed': True}
+        found = {'url': cache['url'] if missing else req.url,
+                 'etag': cache.get('etag') if missing else req.headers.get('ETag'),
+                 'last_modified': cache.get('last_modified') if missing else req.headers.get('Last-Modified'),
+                 'filename': filename}
+        store = args.get('store')
         if not check_file(fqfile):
-            rtn = get_file(args['url'], fqfile, args['timeout'], args['debug'])
-            dbgprint(args['debug'], "Curl:        ",  rtn)
+            size = int(req.headers['Content-Length']) if 'Content-Length' in req.headers else None
+            checksum = get_checksum(args)
+            if store is not None and checksum is not None and store.link(checksum, fqfile, args['url']):
+                dbgprint(args['debug'], "Stored:      ",  fqfile)
+            else:
+                # found['url'] is where the redirects led, so resuming does not redirect again
+                with span(args, "download", url=found['url'], size=size):
+                    rtn = get_file(found['url'], fqfile, args['timeout'], args['debug'], size, checksum,
+                                   args.get('min_rate', 10240), args.get('stall_time', 60),
+                                   bandwidth=args.get('bandwidth'))
+                dbgprint(args['debug'], "Download:    ",  rtn)
+                if check_file(fqfile):
+                    done['bytes'] = getsize(fqfile)
+        digest = None
+        if store is not None and check_file(fqfile):
+            digest = store.add(fqfile, args['url'])
+            found['sha256'] = digest
+            if store.in_repo(digest, "vscode") and cache.get('snapshot'):
+                dbgprint(args['debug'], "Unchanged:   ",  digest)
+                if not args['debug']:
+                    save_cache(args['path'], dict(found, snapshot=cache['snapshot']))
+                return {'bytes': done['bytes'], 'snapshot': cache['snapshot'], 'changed': False}
         if check_file(fqfile) or args['debug']:
-            cmd = "aptly repo add vscode " + fqfile + " >> " + args['logfile'] + " 2>&1" # type: ignore
-            xqt(cmd, args['debug'])
-            cmd = "aptly snapshot create vscode-" + args['timestamp'] + " from repo vscode >> " + args['logfile'] + " 2>&1" # type: ignore
-            xqt(cmd, args['debug'])
+            with span(args, "repo add"):
+                if args.get('repo_index') is not None:
+                    rtn = args['repo_index'].add("vscode", [fqfile])
+                    if rtn.ok and not rtn.data and cache.get('snapshot'):
+                        # Already in the repo, so last time's snapshot will do
+                        snapshot = cache['snapshot']
+                        done.update(snapshot=snapshot, changed=False)
+                else:
+                    rtn = args['backend'].repo_add("vscode", [fqfile])
+            if rtn.ok and done['changed']:
+                with span(args, "snapshot"):
+                    rtn = args['backend'].snapshot_from_repo(snapshot, "vscode")
+            if not rtn.ok:
+                raise Exception(rtn.error())
+            if not args['debug']:
+                if digest is not None:
+                    store.set_in_repo(digest, "vscode")
+                save_cache(args['path'], dict(found, snapshot=snapshot))
+            return done
         else:
-            print("Error: Failed to download " + fqfile + " from " + args['url'])
-            print('Result:' + rtn) # type: ignore
-    else:
-        print("Error: " + args['url'] + " is not a valid URL")
-
-def dbgprint(dbg, text, obj):
-    if dbg:
-        print(text, obj)
-
-def xqt(cmd, debug):
-    if debug:
-        print(cmd)
+            raise Exception("failed to download " + fqfile + " from " + args['url'] + ": " + rtn)
     else:
-        subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, 
-                                        stderr=subprocess.STDOUT,
-                                          text=True).stdout
+        raise Exception(args['url'] + " is not a valid URL")
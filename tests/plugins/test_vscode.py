@@ -84,7 +84,7 @@ class TestCheckFile(unittest.TestCase):
 class TestGetFile(unittest.TestCase):
     def test_get_file(self):
         rtn = plugins.vscode.get_file("http://www.example.com", "test.file", 600, True)
-        self.assertEqual(rtn, "curl --no-progress-meter --max-time 600 --write-out %{exitcode} --output test.file 'http://www.example.com' 2>&1")
+        self.assertEqual(rtn, "GET http://www.example.com -> test.file")
 
 yaml_vscode = """
 - 
@@ -0,0 +1,112 @@
+import unittest
+import threading
+import json
+import tempfile
+import os
+from unittest.mock import patch
+from http.server import HTTPServer, BaseHTTPRequestHandler
+import src.aptly_update.aptly_update as aptly_update
+from src.aptly_update.aptly_update import ApiBackend
+
+class StubAptly(BaseHTTPRequestHandler):
+# Just enough of 'aptly api serve' for the tests. Every async request becomes
+# task 1, which is finished the second time it is polled.
+    requests = []
+    polls = 0
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_any(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'null') if length else None
+        path = self.path.split('?')[0]
+        StubAptly.requests.append((method, self.path, body))
+        if path == '/api/tasks/1':
+            StubAptly.polls += 1
+            self.reply(200, {'ID': 1, 'State': 2 if StubAptly.polls > 1 else 1})
+        elif path == '/api/tasks/1/output':
+            self.reply(200, "Mirror updated\n")
+        elif path == '/api/mirrors/bookworm-main' and method == 'GET':
+            self.reply(200, {'Name': 'bookworm-main',
+                             'ArchiveRoot': 'http://deb.debian.org/debian/',
+                             'Distribution': 'bookworm'})
+        elif path == '/api/mirrors/missing':
+            self.reply(404, {'error': 'mirror with name missing not found'})
+        elif path == '/api/publish' and method == 'GET':
+            self.reply(200, [{'Prefix': '.', 'Distribution': 'bookworm',
+                              'Sources': [{'Component': 'contrib', 'Name': 'old'}]}])
+        else:
+            self.reply(202, {'ID': 1})
+
+    def do_GET(self):
+        self.handle_any('GET')
+
+    def do_PUT(self):
+        self.handle_any('PUT')
+
+    def do_POST(self):
+        self.handle_any('POST')
+
+    def do_DELETE(self):
+        self.handle_any('DELETE')
+
+class TestApiBackend(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), StubAptly)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = "http://127.0.0.1:" + str(cls.server.server_port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        StubAptly.requests = []
+        StubAptly.polls = 0
+        self.backend = ApiBackend(self.url, False, poll=0)
+        self.directory = tempfile.TemporaryDirectory()
+        logfile = os.path.join(self.directory.name, "log")
+        self.patch = patch.object(aptly_update, 'get_logfile', lambda: logfile)
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        self.directory.cleanup()
+
+    def test_mirror_show(self):
+        result = self.backend.mirror_show('bookworm-main')
+        self.assertEqual(result.data['Archive Root URL'], 'http://deb.debian.org/debian/')
+        self.assertEqual(result.data['Distribution'], 'bookworm')
+
+    def test_error(self):
+        result = self.backend.mirror_show('missing')
+        self.assertFalse(result.ok)
+        self.assertEqual(result.status, 404)
+        self.assertIn('not found', result.error())
+
+    def test_task(self):
+        result = self.backend.mirror_update('bookworm-main')
+        self.assertTrue(result.ok)
+        self.assertIn("Mirror updated", result.output)
+        self.assertEqual(StubAptly.polls, 2)
+        self.assertEqual(StubAptly.requests[0][:2], ('PUT', '/api/mirrors/bookworm-main?_async=true'))
+
+    def test_switch(self):
+        self.assertEqual(self.backend.publish_list().data, ['bookworm'])
+        self.backend.publish_switch('bookworm', 'bookworm-new')
+        method, path, body = StubAptly.requests[1]
+        self.assertEqual((method, path.split('?')[0]), ('PUT', '/api/publish/:./bookworm'))
+        self.assertEqual(body, {'Snapshots': [{'Component': 'contrib', 'Name': 'bookworm-new'}]})
+
+if __name__ == '__main__':
+    unittest.main()
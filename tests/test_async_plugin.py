@@ -0,0 +1,107 @@
+import unittest
+import types
+import tempfile
+import os
+from unittest.mock import Mock, patch
+from src.aptly_update.aptly_update import build_graph, run_graph, Result, State, DEFAULT_SETTINGS
+import src.aptly_update.aptly_update as aptly_update
+
+def async_plugin(calls):
+    mod = types.ModuleType("async_plugin")
+    async def fetch_repo(ctx):
+        calls.append(ctx.args['url'])
+        result = await ctx.aptly('snapshot_from_repo', ctx.name + "-" + ctx.timestamp, ctx.name)
+        ctx.log("made " + ctx.name + "-" + ctx.timestamp)
+        return {'bytes': 42, 'changed': result.ok}
+    mod.fetch_repo = fetch_repo
+    return mod
+
+def sync_plugin(calls):
+    mod = types.ModuleType("sync_plugin")
+    def fetch_repo(args):
+        calls.append(args['url'])
+        return {'snapshot': "sync_plugin-old", 'changed': False}
+    mod.fetch_repo = fetch_repo
+    return mod
+
+entries = [{'name': 'vendor', 'mirrors': [],
+            'plugins': [{'async_plugin': {'url': 'https://example.com/a.deb'}},
+                        {'sync_plugin': {'url': 'https://example.com/b.deb'}}]}]
+
+class TestAsyncPlugin(unittest.TestCase):
+    def test_async_and_sync(self):
+        calls = []
+        modules = {'async_plugin': async_plugin(calls), 'sync_plugin': sync_plugin(calls)}
+        backend = Mock()
+        backend.snapshot_from_repo.return_value = Result(True, 0)
+        backend.publish_list.return_value = Result(True, 0, data=[])
+        with tempfile.TemporaryDirectory() as directory, \
+             patch.object(aptly_update, 'get_logfile', lambda: os.path.join(directory, "log")), \
+             patch.object(aptly_update, 'import_module', lambda name, debug: modules[name]):
+            nodes = build_graph(entries, True, None, DEFAULT_SETTINGS, backend)
+            run_graph(nodes, DEFAULT_SETTINGS, True)
+        self.assertEqual(sorted(calls), ['https://example.com/a.deb', 'https://example.com/b.deb'])
+        self.assertEqual(nodes[('plugin', 'async_plugin')].status, 'done')
+        self.assertEqual(nodes[('plugin', 'async_plugin')].bytes, 42)
+        self.assertEqual(nodes[('plugin', 'sync_plugin')].snapshot, "sync_plugin-old")
+        self.assertTrue(nodes[('plugin', 'sync_plugin')].unchanged)
+        self.assertEqual(backend.snapshot_from_repo.call_count, 1)
+        self.assertIn("sync_plugin-old", backend.snapshot_merge.call_args[0][1])
+
+class TestFailedPlugin(unittest.TestCase):
+    def test_failed(self):
+        # An async and a plain plugin that raise both fail and neither is kept.
+        failing = types.ModuleType("async_plugin")
+        async def fetch_repo(ctx):
+            raise Exception("failed to check")
+        failing.fetch_repo = fetch_repo
+        raising = types.ModuleType("sync_plugin")
+        def fetch_raises(args):
+            raise Exception("failed to download")
+        raising.fetch_repo = fetch_raises
+        modules = {'async_plugin': failing, 'sync_plugin': raising}
+        state = State(None)
+        backend = Mock()
+        backend.publish_list.return_value = Result(True, 0, data=[])
+        with tempfile.TemporaryDirectory() as directory, \
+             patch('builtins.print'), \
+             patch.object(aptly_update, 'get_logfile', lambda: os.path.join(directory, "log")), \
+             patch.object(aptly_update, 'import_module', lambda name, debug: modules[name]):
+            nodes = build_graph(entries, True, state, DEFAULT_SETTINGS, backend)
+            run_graph(nodes, DEFAULT_SETTINGS, True)
+        self.assertEqual(nodes[('plugin', 'async_plugin')].status, 'failed')
+        self.assertEqual(nodes[('plugin', 'sync_plugin')].status, 'failed')
+        self.assertEqual(nodes[('publish', 'vendor')].status, 'skipped')
+        self.assertEqual(state.data['plugins'], {})
+
+    def test_returns_none(self):
+        # Plain plugins that return nothing, as they always have, have worked.
+        def legacy(name):
+            mod = types.ModuleType(name)
+            def fetch_repo(args):
+                args['backend'].snapshot_from_repo(name + "-" + args['timestamp'], name)
+            mod.fetch_repo = fetch_repo
+            return mod
+        modules = {'legacy_a': legacy('legacy_a'), 'legacy_b': legacy('legacy_b')}
+        entry = [{'name': 'bookworm', 'mirrors': [], 'plugins': [{'legacy_a': {}}, {'legacy_b': {}}]}]
+        state = State(None)
+        backend = Mock()
+        backend.snapshot_from_repo.return_value = Result(True, 0)
+        backend.snapshot_merge.return_value = Result(True, 0)
+        backend.publish_list.return_value = Result(True, 0, data=[])
+        with tempfile.TemporaryDirectory() as directory, \
+             patch('builtins.print'), \
+             patch.object(aptly_update, 'get_logfile', lambda: os.path.join(directory, "log")), \
+             patch.object(aptly_update, 'import_module', lambda name, debug: modules[name]):
+            nodes = build_graph(entry, True, state, DEFAULT_SETTINGS, backend)
+            run_graph(nodes, DEFAULT_SETTINGS, True)
+        plugins = [nodes[('plugin', 'legacy_a')], nodes[('plugin', 'legacy_b')]]
+        self.assertEqual([plugin.status for plugin in plugins], ['done', 'done'])
+        self.assertFalse(any(plugin.unchanged for plugin in plugins))
+        self.assertEqual(nodes[('merge', 'bookworm')].status, 'done')
+        self.assertEqual(nodes[('publish', 'bookworm')].status, 'done')
+        self.assertEqual(sorted(backend.snapshot_merge.call_args[0][1]), sorted(plugin.snapshot for plugin in plugins))
+        self.assertEqual(state.data['plugins']['legacy_a']['snapshot'], plugins[0].snapshot)
+
+if __name__ == '__main__':
+    unittest.main()
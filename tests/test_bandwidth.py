@@ -0,0 +1,131 @@
+import unittest
+import asyncio
+import threading
+import time
+from unittest.mock import patch
+import src.aptly_update.aptly_update as aptly_update
+from src.aptly_update.aptly_update import Bandwidth, TokenBucket, Node
+
+def graph(updates, plugins=0):
+    nodes = {}
+    for number in range(updates):
+        node = Node(('update', 'mirror' + str(number)), 'update', lambda node: None)
+        nodes[node.key] = node
+    for number in range(plugins):
+        node = Node(('plugin', 'plugin' + str(number)), 'plugin', lambda node: None)
+        nodes[node.key] = node
+    return nodes
+
+class TestShares(unittest.TestCase):
+    def test_equal(self):
+        nodes = graph(4)
+        bandwidth = Bandwidth(1000, nodes, 2)
+        first, second = list(nodes.values())[:2]
+        self.assertEqual(bandwidth.start_update(first), 500)
+        self.assertEqual(bandwidth.start_update(second), 500)
+        self.assertEqual(bandwidth.bucket.rate, 0)
+
+    def test_plugins(self):
+        nodes = graph(2, plugins=1)
+        bandwidth = Bandwidth(900, nodes, 4)
+        self.assertEqual(bandwidth.start_update(nodes[('update', 'mirror0')]), 300)
+        self.assertEqual(bandwidth.start_update(nodes[('update', 'mirror1')]), 300)
+        self.assertEqual(bandwidth.bucket.rate, 300 * 1024)
+
+    def test_never_over(self):
+        nodes = graph(3)
+        bandwidth = Bandwidth(1000, nodes, 2)
+        first, second, third = nodes.values()
+        bandwidth.start_update(first)
+        first.status = 'running'
+        bandwidth.start_update(second)
+        second.status = 'done'
+        bandwidth.finish_update(second)
+        # Two left to run, so half, however many have finished.
+        self.assertEqual(bandwidth.start_update(third), 500)
+        self.assertLessEqual(sum(bandwidth.limits.values()), 1000)
+
+    def test_freed(self):
+        nodes = graph(3)
+        bandwidth = Bandwidth(900, nodes, 3)
+        first, second, third = nodes.values()
+        for node in nodes.values():
+            bandwidth.start_update(node)
+        for node in (first, second):
+            node.status = 'done'
+            bandwidth.finish_update(node)
+        self.assertEqual(bandwidth.bucket.rate, 600 * 1024)
+        third.status = 'done'
+        bandwidth.finish_update(third)
+        self.assertEqual(bandwidth.bucket.rate, 900 * 1024)
+
+    def test_own_limit(self):
+        nodes = graph(2)
+        bandwidth = Bandwidth(1000, nodes, 2)
+        self.assertEqual(bandwidth.start_update(nodes[('update', 'mirror0')], 100), 100)
+        self.assertEqual(bandwidth.start_update(nodes[('update', 'mirror1')], 4000), 500)
+        self.assertEqual(bandwidth.bucket.rate, 400 * 1024)
+
+    def test_many(self):
+        # Twenty updates at once on 10 KiB/s: each is given 1 KiB/s, the
+        # plugins keep some, and the rest wait for the first to finish.
+        nodes = graph(20, plugins=1)
+        bandwidth = Bandwidth(10, nodes, 20)
+        updates = [node for node in nodes.values() if node.kind == 'update']
+        limits = []
+        def start(node):
+            limits.append(bandwidth.start_update(node))
+        threads = [threading.Thread(target=start, args=(node,), daemon=True) for node in updates]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.2)
+        self.assertEqual(len(limits), 9)
+        self.assertLessEqual(sum(bandwidth.limits.values()), 10)
+        self.assertGreater(bandwidth.bucket.rate, 0)
+        finish = time.monotonic() + 5
+        while any(thread.is_alive() for thread in threads) and time.monotonic() < finish:
+            with bandwidth.lock:
+                running = [node for node in updates if node.key in bandwidth.limits]
+                self.assertLessEqual(sum(bandwidth.limits.values()), 10)
+            for node in running:
+                node.status = 'done'
+                bandwidth.finish_update(node)
+            time.sleep(0.01)
+        self.assertEqual(len(limits), 20)
+        self.assertTrue(all(limit >= 1 for limit in limits))
+        self.assertLessEqual(sum(bandwidth.limits.values()), 10)
+
+class TestBucket(unittest.TestCase):
+    def test_delay(self):
+        bucket = TokenBucket(1000)
+        self.assertAlmostEqual(bucket.delay(2000), 2, places=2)
+        self.assertAlmostEqual(bucket.delay(1000), 3, places=2)
+
+    def test_burst(self):
+        bucket = TokenBucket(1000)
+        bucket.stamp -= 60
+        self.assertEqual(bucket.delay(1000), 0)
+        self.assertGreater(bucket.delay(500), 0.4)
+
+    def test_stopped(self):
+        bucket = TokenBucket(0)
+        self.assertIsNone(bucket.delay(1))
+        slept = []
+        def sleep(seconds):
+            slept.append(seconds)
+            if len(slept) == 3:
+                bucket.set_rate(1000)
+        with patch.object(aptly_update.time, 'sleep', sleep):
+            bucket.take(500)
+        self.assertEqual(slept[:3], [0.1, 0.1, 0.1])
+        self.assertAlmostEqual(slept[3], 0.5, places=2)
+
+    def test_async(self):
+        bucket = TokenBucket(100000)
+        started = time.monotonic()
+        asyncio.run(bucket.take_async(10000))
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertAlmostEqual(bucket.tokens, -10000, delta=1000)
+
+if __name__ == '__main__':
+    unittest.main()
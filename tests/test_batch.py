@@ -0,0 +1,65 @@
+import unittest
+import tempfile
+import os
+from unittest.mock import patch
+import src.aptly_update.aptly_update as aptly_update
+from src.aptly_update.aptly_update import parse_task_run, build_graph, run_graph, CliBackend, DEFAULT_SETTINGS
+
+output = """1) [Running]: snapshot create a-1 from mirror a
+Begin command output: ----------------------------
+
+Snapshot a-1 successfully created.
+
+End command output: ------------------------------
+2) [Running]: snapshot create b-1 from mirror b
+Begin command output: ----------------------------
+ERROR: unable to create snapshot: mirror b not found
+End command output: ------------------------------
+3) [Skipping]: snapshot create c-1 from mirror c
+ERROR: at least one command has reported an error
+"""
+
+class TestParseTaskRun(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        logfile = os.path.join(self.directory.name, "log")
+        self.patch = patch.object(aptly_update, 'get_logfile', lambda: logfile)
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        self.directory.cleanup()
+
+    def test_parse(self):
+        results = parse_task_run(output, 1, 3)
+        self.assertTrue(results[0].ok)
+        self.assertIn("successfully created", results[0].output)
+        self.assertFalse(results[1].ok)
+        self.assertIn("mirror b not found", results[1].error())
+        self.assertIsNone(results[2])
+
+    def test_not_run(self):
+        results = parse_task_run("aptly: not found\n", 127, 2)
+        self.assertFalse(any(result.ok for result in results))
+
+entries = [{'name': 'bookworm', 'mirrors': ['bookworm-main', 'bookworm-security']},
+           {'name': 'raspbian', 'mirrors': ['raspbian-main']}]
+
+class TestBatches(unittest.TestCase):
+    def test_batches(self):
+        batches = []
+        def task_run(cmds, debug):
+            batches.append(cmds)
+            return [aptly_update.Result(True, 0) for cmd in cmds]
+        settings = dict(DEFAULT_SETTINGS, batch=True, publish_mode='drop')
+        with patch.object(aptly_update, 'task_run', task_run), \
+             patch.object(aptly_update, 'run_command', lambda argv, debug, *args: aptly_update.Result(True, 0)):
+            nodes = build_graph(entries, True, None, settings, CliBackend(True, True))
+            run_graph(nodes, settings, True)
+        cmds = [cmd for batch in batches for cmd in batch]
+        self.assertEqual(len(cmds), 3 + 1 + 2 + 2)
+        self.assertLess(len(batches), len(cmds))
+        self.assertTrue(all(node.status == 'done' for node in nodes.values()))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import unittest
+import tempfile
+import datetime
+import argparse
+import os
+from unittest.mock import patch
+import src.aptly_update.aptly_update as aptly_update
+from src.aptly_update.aptly_update import Daemon, compile_plan, select_plan, CliBackend
+
+config = """
+- settings:
+    nightly: "03:00"
+    history: null
+    plan_file: null
+- name: bookworm
+  mirrors:
+    - bookworm-main
+    - bookworm-security
+- name: security
+  poll: 10
+  mirrors:
+    - bookworm-security
+"""
+
+def at(hour, minute, day=1):
+    return datetime.datetime(2024, 7, day, hour, minute).timestamp()
+
+class TestSelect(unittest.TestCase):
+    def test_select(self):
+        entries = [{'name': 'bookworm', 'mirrors': ['bookworm-main', 'bookworm-security']},
+                   {'name': 'security', 'mirrors': ['bookworm-security']}]
+        plan = compile_plan(entries, False, CliBackend(False), {'bookworm-main': {}, 'bookworm-security': {}})
+        steps = [(step['step'], step['name']) for step in select_plan(plan, ['security']).steps]
+        self.assertEqual(steps, [('update', 'bookworm-security'), ('snapshot', 'bookworm-security'),
+                                 ('publish', 'security')])
+        self.assertEqual(select_plan(plan, ['bookworm', 'security']).steps, plan.steps)
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.yaml = os.path.join(self.directory.name, "test.yaml")
+        self.write(config)
+        args = argparse.Namespace(yaml=[self.yaml], debug=True, force=False, jobs=None, deadline=None,
+                                  metrics=None, trace=None)
+        self.runs = []
+        def run_plan(plan, entries, settings, state, backend, registry, debug, cleanup=True, trace=None):
+            self.runs.append(([step['name'] for step in plan.steps if step['step'] == 'publish'], cleanup))
+        self.patches = [patch.object(aptly_update, 'run_plan', run_plan), patch('builtins.print')]
+        for started in self.patches:
+            started.start()
+        self.daemon = Daemon(args)
+
+    def tearDown(self):
+        for started in self.patches:
+            started.stop()
+        self.directory.cleanup()
+
+    def write(self, text, modified=1000):
+        with open(self.yaml, "w") as yaml_file:
+            yaml_file.write(text)
+        os.utime(self.yaml, (modified, modified))
+
+    def test_schedule(self):
+        self.assertLessEqual(self.daemon.step(at(12, 0)), 60)
+        self.assertEqual(self.runs, [(['security'], False)])
+        self.daemon.step(at(12, 5))
+        self.assertEqual(len(self.runs), 1)
+        self.daemon.step(at(12, 10))
+        self.assertEqual(self.runs[-1], (['security'], False))
+        self.daemon.step(at(3, 0, day=2))
+        self.assertEqual(self.runs[-1], (['bookworm', 'security'], True))
+        self.daemon.step(at(3, 1, day=2))
+        self.assertEqual(len(self.runs), 3)
+        self.assertEqual(self.daemon.schedule['bookworm'], at(3, 0, day=3))
+
+    def test_reload(self):
+        self.daemon.step(at(12, 0))
+        plan = self.daemon.plan
+        self.daemon.step(at(12, 1))
+        self.assertIs(self.daemon.plan, plan)
+        # Polling bookworm too brings it forward; security keeps its place.
+        self.write(config.replace("- name: bookworm\n", "- name: bookworm\n  poll: 60\n"), 2000)
+        self.daemon.step(at(12, 2))
+        self.assertEqual(self.runs[-1], (['bookworm'], False))
+        self.assertEqual(self.daemon.schedule['security'], at(12, 10))
+
+    def test_mistake(self):
+        self.daemon.step(at(12, 0))
+        plan = self.daemon.plan
+        self.write(config.replace("poll: 10", "poll: often"), 2000)
+        self.daemon.step(at(12, 1))
+        self.assertIs(self.daemon.plan, plan)
+        self.assertEqual(self.daemon.polls['security'], 10)
+
+    def test_broken(self):
+        self.daemon.step(at(12, 0))
+        plan = self.daemon.plan
+        for broken in ("- name: [bookworm\n", ""):
+            self.write(broken, 2000 + len(broken))
+            self.daemon.step(at(12, 1))
+            self.assertIs(self.daemon.plan, plan)
+        os.remove(self.yaml)
+        self.daemon.step(at(12, 2))
+        self.assertIs(self.daemon.plan, plan)
+        self.write(config.replace("poll: 10", "poll: 5"), 3000)
+        self.daemon.step(at(12, 3))
+        self.assertEqual(self.daemon.polls['security'], 5)
+
+    def test_new_run(self):
+        with patch.object(aptly_update, 'new_run') as new_run:
+            self.daemon.step(at(12, 0))
+            self.daemon.step(at(12, 1))
+        self.assertEqual(new_run.call_count, 1)
+        aptly_update.new_run()
+        self.assertRegex(aptly_update.get_timestamp(), r'^\d{8}T\d\d:\d\d:\d\d$')
+        self.assertTrue(aptly_update.get_logfile().endswith("-run-" + aptly_update.get_timestamp()))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+import threading
+import time
+from unittest.mock import patch
+import src.aptly_update.aptly_update as aptly_update
+from src.aptly_update.aptly_update import build_graph, run_graph, Node, CliBackend, Result, DEFAULT_SETTINGS
+
+entries = [{'name': 'bookworm',
+            'mirrors': ['bookworm-main', 'bookworm-security']},
+           {'name': 'bookworm-security',
+            'mirrors': ['bookworm-security']}]
+
+class TestSharedMirror(unittest.TestCase):
+    def test_shared_mirror(self):
+        nodes = build_graph(entries, True)
+        keys = list(nodes)
+        self.assertEqual(keys.count(('update', 'bookworm-security')), 1)
+        self.assertEqual(keys.count(('snapshot', 'bookworm-security')), 1)
+        self.assertIn(('merge', 'bookworm'), nodes)
+        self.assertNotIn(('merge', 'bookworm-security'), nodes)
+        self.assertIs(nodes[('publish', 'bookworm-security')].deps[0],
+                      nodes[('snapshot', 'bookworm-security')])
+
+class TestRunOrder(unittest.TestCase):
+    def test_run_order(self):
+        order = []
+        def action(node):
+            order.append(node.key[1])
+        a = Node(('update', 'a'), 'update', action)
+        b = Node(('snapshot', 'b'), 'aptly', action, [a])
+        c = Node(('publish', 'c'), 'aptly', action, [b])
+        run_graph({n.key: n for n in (c, b, a)}, DEFAULT_SETTINGS, False)
+        self.assertEqual(order, ['a', 'b', 'c'])
+
+class TestFailureSkips(unittest.TestCase):
+    def test_failure_skips(self):
+        def fail(node):
+            raise Exception("no network")
+        a = Node(('update', 'a'), 'update', fail)
+        b = Node(('snapshot', 'a'), 'aptly', lambda node: None, [a])
+        run_graph({n.key: n for n in (a, b)}, DEFAULT_SETTINGS, False)
+        self.assertEqual(a.status, 'failed')
+        self.assertEqual(b.status, 'skipped')
+
+class TestPluginsOverlap(unittest.TestCase):
+    def test_plugins_overlap(self):
+        # A plugin and a mirror update must be running at the same time.
+        barrier = threading.Barrier(2, timeout=5)
+        def action(node):
+            barrier.wait()
+        a = Node(('update', 'a'), 'update', action)
+        b = Node(('plugin', 'b'), 'plugin', action)
+        run_graph({n.key: n for n in (a, b)}, DEFAULT_SETTINGS, False)
+        self.assertEqual((a.status, b.status), ('done', 'done'))
+
+class TestAptlyLock(unittest.TestCase):
+    def test_aptly_lock(self):
+        backend = CliBackend(False)
+        running = []
+        overlaps = []
+        def run_command(argv, *args):
+            running.append(argv)
+            overlaps.append(len(running))
+            time.sleep(0.05)
+            running.remove(argv)
+            return Result(True, 0)
+        with patch.object(aptly_update, 'run_command', run_command):
+            threads = [threading.Thread(target=backend.repo_add, args=("r" + str(i), ["f.deb"])) for i in range(3)]
+            threads.append(threading.Thread(target=backend.snapshot_from_mirror, args=("s", "m")))
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(max(overlaps), 1)
+
+if __name__ == '__main__':
+    unittest.main()
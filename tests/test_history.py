@@ -0,0 +1,35 @@
+import unittest
+import tempfile
+import os
+from src.aptly_update.aptly_update import History, Node, download_size
+
+def node(step, name, started, ended, status='done', bytes=None):
+    node = Node((step, name), step, None)
+    node.started = started
+    node.ended = ended
+    node.status = status
+    node.bytes = bytes
+    return node
+
+class TestHistory(unittest.TestCase):
+    def test_history(self):
+        with tempfile.TemporaryDirectory() as directory:
+            history = History(os.path.join(directory, "history.db"))
+            for run in range(3):
+                nodes = [node('update', 'bookworm-main', 100, 110 + run, bytes=1024),
+                         node('update', 'raspbian-main', 100, 400, 'failed'),
+                         node('publish', 'bookworm', 120, 125)]
+                history.record("2024060" + str(run), 100, 130, {n.key: n for n in nodes})
+            self.assertEqual(len(history.runs(2)), 2)
+            self.assertEqual(history.durations('update', 'bookworm-main', 2), [11, 12])
+            self.assertEqual(history.durations('update', 'raspbian-main', 2), [None, None])
+            slowest = history.slowest(10, 1)
+            self.assertEqual(slowest[0][:3], ('update', 'raspbian-main', 300))
+
+class TestDownloadSize(unittest.TestCase):
+    def test_download_size(self):
+        self.assertEqual(download_size("Download queue: 25 items (1.50 MiB)\n"), 1572864)
+        self.assertIsNone(download_size("Mirror `bookworm-main` has been successfully updated.\n"))
+
+if __name__ == '__main__':
+    unittest.main()
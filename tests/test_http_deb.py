@@ -0,0 +1,176 @@
+import unittest
+import tempfile
+import threading
+import os
+from unittest.mock import Mock, patch
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from src.aptly_update.aptly_update import PluginRegistry, DownloadStore, Result, Trace
+
+registry = PluginRegistry(False, os.path.join("src", "aptly_update", "plugins"))
+http_deb = registry.get('http_deb')
+
+DEB = b"!<arch>\n" + bytes(range(256)) * 64
+
+class VendorServer(BaseHTTPRequestHandler):
+# Serves three vendors' packages the ways vendors do: Chrome redirects to a
+# file named after its version, Slack names it in Content-Disposition and
+# Zoom redirects to a directory named after its version.
+    protocol_version = "HTTP/1.1"
+    versions = {'chrome': "1", 'slack': "1", 'zoom': "1.0"}
+    broken = set()
+    clients = set()
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, headers, body=b""):
+        VendorServer.clients.add(self.client_address)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        return body
+
+    def respond(self):
+        versions = VendorServer.versions
+        if self.path in VendorServer.broken:
+            return self.reply(500, {})
+        if self.path == "/chrome":
+            return self.reply(302, {'Location': "/files/chrome_" + versions['chrome'] + ".deb"})
+        if self.path == "/zoom":
+            return self.reply(302, {'Location': "/" + versions['zoom'] + "/zoom_amd64.deb"})
+        etag = '"' + self.path + "-" + versions['slack'] + '"'
+        if self.path == "/slack" and self.headers.get('If-None-Match') == etag:
+            return self.reply(304, {'ETag': etag})
+        if self.path == "/slack":
+            return self.reply(200, {'ETag': etag, 'Content-Disposition':
+                                    "attachment; filename=slack_" + versions['slack'] + ".deb"}, DEB)
+        return self.reply(200, {}, DEB)
+
+    def do_HEAD(self):
+        self.respond()
+
+    def do_GET(self):
+        self.wfile.write(self.respond())
+
+class TestHttpDeb(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), VendorServer)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.directory = tempfile.TemporaryDirectory()
+        url = "http://127.0.0.1:" + str(self.server.server_port)
+        self.backend = Mock()
+        self.backend.repo_add.return_value = Result(True, 0)
+        self.backend.snapshot_from_repo.return_value = Result(True, 0)
+        self.backend.snapshot_merge.return_value = Result(True, 0)
+        self.args = {'path': self.directory.name, 'timeout': 10, 'jobs': 2, 'debug': False,
+                     'logfile': "log", 'backend': self.backend,
+                     'packages': [{'url': url + "/chrome", 'repo': "vendor"},
+                                  {'url': url + "/slack", 'repo': "vendor"},
+                                  {'url': url + "/zoom", 'repo': "zoom", 'filename': r"[0-9.]+/zoom_amd64\.deb"}]}
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.directory.cleanup()
+
+    def fetch(self, timestamp):
+        return http_deb.fetch_repo(dict(self.args, timestamp=timestamp))
+
+    def test_fetch(self):
+        VendorServer.clients.clear()
+        rtn = self.fetch("20240601T23:25:00")
+        self.assertEqual(sorted(os.listdir(self.directory.name)),
+                         [".http_deb-cache.json", "1.0_zoom_amd64.deb", "chrome_1.deb", "slack_1.deb"])
+        self.assertEqual(rtn['snapshot'], "http_deb-20240601T23:25:00")
+        self.assertEqual(rtn['inputs'], ["vendor-20240601T23:25:00", "zoom-20240601T23:25:00"])
+        self.assertEqual(rtn['bytes'], 3 * len(DEB))
+        self.assertTrue(rtn['changed'])
+        added = dict((call.args[0], [os.path.basename(name) for name in call.args[1]])
+                     for call in self.backend.repo_add.call_args_list)
+        self.assertEqual(added, {'vendor': ["chrome_1.deb", "slack_1.deb"], 'zoom': ["1.0_zoom_amd64.deb"]})
+        self.backend.snapshot_merge.assert_called_once_with("http_deb-20240601T23:25:00", rtn['inputs'])
+        # Every request went over the session's connections, one for each job.
+        self.assertLessEqual(len(VendorServer.clients), 2)
+
+    def test_unchanged(self):
+        first = self.fetch("20240601T23:25:00")
+        rtn = self.fetch("20240602T23:25:00")
+        self.assertEqual(rtn['snapshot'], first['snapshot'])
+        self.assertEqual(rtn['inputs'], first['inputs'])
+        self.assertFalse(rtn['changed'])
+        self.assertEqual(self.backend.repo_add.call_count, 2)
+
+    def test_one_changed(self):
+        self.fetch("20240601T23:25:00")
+        VendorServer.versions = dict(VendorServer.versions, zoom="1.1")
+        try:
+            rtn = self.fetch("20240602T23:25:00")
+        finally:
+            VendorServer.versions = dict(VendorServer.versions, zoom="1.0")
+        self.assertEqual(rtn['inputs'], ["vendor-20240601T23:25:00", "zoom-20240602T23:25:00"])
+        self.assertEqual(self.backend.repo_add.call_args.args[0], "zoom")
+        self.assertEqual(self.backend.repo_add.call_count, 3)
+
+    def test_one_failed(self):
+        self.fetch("20240601T23:25:00")
+        VendorServer.versions = dict(VendorServer.versions, zoom="1.1")
+        VendorServer.broken = {"/chrome"}
+        try:
+            with patch('builtins.print'):
+                rtn = self.fetch("20240602T23:25:00")
+        finally:
+            VendorServer.versions = dict(VendorServer.versions, zoom="1.0")
+            VendorServer.broken = set()
+        # Chrome is still published, from last time's snapshot of its repo.
+        self.assertEqual(rtn['inputs'], ["vendor-20240601T23:25:00", "zoom-20240602T23:25:00"])
+        self.assertEqual(rtn['snapshot'], "http_deb-20240602T23:25:00")
+
+    def test_failed_first(self):
+        VendorServer.broken = {"/chrome", "/slack"}
+        try:
+            with patch('builtins.print'), self.assertRaisesRegex(Exception, "no snapshot of vendor"):
+                self.fetch("20240601T23:25:00")
+        finally:
+            VendorServer.broken = set()
+        self.backend.snapshot_merge.assert_not_called()
+
+    def test_store(self):
+        store = DownloadStore({'path': os.path.join(self.directory.name, "store")}, False)
+        self.args['path'] = os.path.join(self.directory.name, "debs")
+        os.mkdir(self.args['path'])
+        self.args['store'] = store
+        first = self.fetch("20240601T23:25:00")
+        # Every package is the same file, so it is stored once.
+        self.assertEqual(len(store.files), 1)
+        VendorServer.versions = dict(VendorServer.versions, chrome="2")
+        try:
+            rtn = self.fetch("20240602T23:25:00")
+        finally:
+            VendorServer.versions = dict(VendorServer.versions, chrome="1")
+        # Renamed, but already in the repo.
+        self.assertTrue(os.path.samefile(os.path.join(self.args['path'], "chrome_2.deb"),
+                                         os.path.join(self.args['path'], "chrome_1.deb")))
+        self.assertEqual(rtn['snapshot'], first['snapshot'])
+        self.assertFalse(rtn['changed'])
+        self.assertEqual(self.backend.repo_add.call_count, 2)
+
+    def test_trace(self):
+        self.args['trace'] = Trace("unused")
+        self.fetch("20240601T23:25:00")
+        names = [event['name'] for event in self.args['trace'].events if event['ph'] == 'X']
+        self.assertEqual(sorted(set(names)), ["HEAD", "download", "merge", "repo add", "snapshot"])
+        self.assertEqual(names.count("HEAD"), 3)
+
+    def test_check_packages(self):
+        self.assertEqual(http_deb.check_packages(self.args['packages']), [])
+        self.assertEqual(http_deb.check_packages([{'url': "u"}, {'url': "u", 'repo': "r", 'fielname': "x"}, "u"]),
+                         ["package 1 has no repo", "package 2: unknown parameter 'fielname'",
+                          "package 3 should be a dictionary"])
+        # Before the run starts, through the plugin's check().
+        self.assertEqual(registry.validate('http_deb', {'path': "p", 'packages': [{'url': "u"}]}),
+                         ["plugin http_deb: package 1 has no repo"])
+
+if __name__ == '__main__':
+    unittest.main()
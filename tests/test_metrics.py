@@ -0,0 +1,70 @@
+import unittest
+import tempfile
+import os
+from src.aptly_update.aptly_update import Node, State, write_metrics, publish_snapshot
+
+def node(step, name, status, started=100, ended=110, **fields):
+    made = Node((step, name), 'aptly', lambda node: None)
+    made.status = status
+    made.started = started
+    made.ended = ended
+    made.__dict__.update(fields)
+    return made
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "aptly.prom")
+        self.state = State(None)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, nodes, snapshots=None):
+        write_metrics(self.path, dict((made.key, made) for made in nodes), self.state, 100, 200, snapshots)
+        with open(self.path) as metrics_file:
+            return [line for line in metrics_file.read().splitlines() if not line.startswith(("# HELP", "# TYPE"))]
+
+    def test_steps(self):
+        self.state.set_succeeded('bookworm', 150.5)
+        lines = self.write([node('update', 'bookworm-main', 'done', bytes=1000),
+                            node('update', 'bookworm-security', 'failed', exit=2),
+                            node('update', 'trixie-main', 'skipped', started=None, ended=None),
+                            node('plugin', 'vscode', 'done', 100, 130, bytes=4096),
+                            node('publish', 'bookworm', 'done', 190, 195)],
+                           ["a-20240601T23:25:00", "b-20240601T23:25:00"])
+        self.assertEqual(lines, ['aptly_update_mirror_update_seconds{mirror="bookworm-main"} 10',
+                                 'aptly_update_mirror_update_seconds{mirror="bookworm-security"} 10',
+                                 'aptly_update_mirror_update_status{mirror="bookworm-main"} 0',
+                                 'aptly_update_mirror_update_status{mirror="bookworm-security"} 2',
+                                 'aptly_update_plugin_download_bytes{plugin="vscode"} 4096',
+                                 'aptly_update_plugin_seconds{plugin="vscode"} 30',
+                                 'aptly_update_publish_seconds{distribution="bookworm"} 5',
+                                 'aptly_update_last_success_timestamp_seconds{distribution="bookworm"} 150.5',
+                                 'aptly_update_run_seconds 100',
+                                 'aptly_update_run_timestamp_seconds 200',
+                                 'aptly_update_snapshots 2',
+                                 '# EOF'])
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+
+    def test_label(self):
+        lines = self.write([node('plugin', 'odd "name"\\', 'done')])
+        self.assertIn('aptly_update_plugin_seconds{plugin="odd \\"name\\"\\\\"} 10', lines)
+        self.assertNotIn('aptly_update_snapshots', " ".join(lines))
+
+    def test_succeeded(self):
+        # Found up to date counts as a success, and publishing keeps the time.
+        publish = node('publish', 'bookworm', 'running', deps=[node('snapshot', 'bookworm-main', 'done')])
+        publish.deps[0].snapshot = "bookworm-main-20240601T23:25:00"
+        publish.deps[0].unchanged = True
+        publish.state = self.state
+        publish.debug = False
+        self.state.set_publish('bookworm', {'snapshot': "bookworm-main-20240601T23:25:00"})
+        publish_snapshot(publish)
+        self.assertTrue(publish.unchanged)
+        succeeded = self.state.succeeded()['bookworm']
+        self.state.set_publish('bookworm', {'snapshot': "other"})
+        self.assertEqual(self.state.succeeded(), {'bookworm': succeeded})
+
+if __name__ == '__main__':
+    unittest.main()
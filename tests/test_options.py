@@ -0,0 +1,90 @@
+import unittest
+import tempfile
+import os
+import json
+from unittest.mock import patch
+import src.aptly_update.aptly_update as aptly_update
+from src.aptly_update.aptly_update import (update_flags, compile_plan, check_entries, check_options,
+                                           tune_concurrency, CliBackend, Result, DEFAULT_SETTINGS)
+
+MiB = 1 << 20
+
+class TestFlags(unittest.TestCase):
+    def test_flags(self):
+        self.assertEqual(update_flags({'download_limit': 2048, 'max_tries': 3, 'skip_existing_packages': True,
+                                       'download_concurrency': 8}),
+                         ["-download-limit=2048", "-max-tries=3", "-skip-existing-packages"])
+        self.assertEqual(update_flags({}), [])
+
+    def test_config(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "aptly.conf")
+            with open(path, "w") as config_file:
+                json.dump({'rootDir': "/srv/aptly", 'downloadConcurrency': 4}, config_file)
+            seen = []
+            def run_command(argv, *args):
+                with open(argv[1][len("-config="):]) as config_file:
+                    seen.append((argv, json.load(config_file)))
+                return Result(True, 0)
+            backend = CliBackend(False, settings=dict(DEFAULT_SETTINGS, aptly_config=path))
+            with patch.object(aptly_update, 'run_command', run_command):
+                backend.mirror_update('bookworm-main', {'download_concurrency': 8, 'max_tries': 2})
+        argv, config = seen[0]
+        self.assertEqual(argv[2:], ["mirror", "update", "-max-tries=2", "bookworm-main"])
+        self.assertEqual(config, {'rootDir': "/srv/aptly", 'downloadConcurrency': 8})
+        self.assertFalse(os.path.exists(argv[1][len("-config="):]))
+
+    def test_no_config(self):
+        cmds = []
+        def run_command(argv, *args):
+            cmds.append(argv)
+            return Result(True, 0)
+        with patch.object(aptly_update, 'run_command', run_command):
+            CliBackend(False).mirror_update('bookworm-main')
+        self.assertEqual(cmds, [["aptly", "mirror", "update", "bookworm-main"]])
+
+class TestYaml(unittest.TestCase):
+    entries = [{'name': 'bookworm', 'mirrors': [{'bookworm-main': {'download_limit': 2048}},
+                                                'bookworm-security']},
+               {'name': 'main', 'mirrors': [{'bookworm-main': {'download_limit': 1}}]}]
+
+    def test_merged(self):
+        settings = dict(DEFAULT_SETTINGS, mirror_options={'max_tries': 3, 'download_limit': 100})
+        plan = compile_plan(self.entries, False, CliBackend(False), {'bookworm-main': {}, 'bookworm-security': {}},
+                            settings=settings)
+        options = dict((step['name'], step['options']) for step in plan.steps if step['step'] == 'update')
+        self.assertEqual(options, {'bookworm-main': {'max_tries': 3, 'download_limit': 2048},
+                                   'bookworm-security': {'max_tries': 3, 'download_limit': 100}})
+
+    def test_check(self):
+        self.assertEqual(check_entries(self.entries, {'bookworm-main': {}, 'bookworm-security': {}}), [])
+        problems = check_entries([{'name': 'b', 'mirrors': [{'bookworm-main': {'download_limt': 1,
+                                                                               'max_tries': "3"}}]}], None)
+        self.assertEqual(problems, ["entry b, mirror bookworm-main: unknown option 'download_limt'",
+                                    "entry b, mirror bookworm-main: 'max_tries' cannot be '3'"])
+        self.assertEqual(check_options("settings", {'download_concurrency': 'auto'}), [])
+        self.assertEqual(len(check_options("settings", {'download_concurrency': 'lots'})), 1)
+
+class TestTuning(unittest.TestCase):
+    def test_climbs(self):
+        tuning = tune_concurrency({}, 100 * MiB, 10, 16)
+        self.assertEqual(tuning['concurrency'], 5)
+        tuning = tune_concurrency(tuning, 120 * MiB, 10, 16)
+        self.assertEqual(tuning['concurrency'], 6)
+
+    def test_turns_back(self):
+        tuning = {'concurrency': 6, 'rate': 12 * MiB, 'direction': 1}
+        tuning = tune_concurrency(tuning, 90 * MiB, 10, 16)
+        self.assertEqual((tuning['concurrency'], tuning['direction']), (5, -1))
+
+    def test_bounds(self):
+        self.assertEqual(tune_concurrency({'concurrency': 16, 'rate': 1, 'direction': 1}, 100 * MiB, 10, 16)['concurrency'], 15)
+        self.assertEqual(tune_concurrency({'concurrency': 1, 'rate': 1, 'direction': -1}, 100 * MiB, 10, 16)['concurrency'], 2)
+
+    def test_small(self):
+        tuning = {'concurrency': 6, 'rate': 12 * MiB, 'direction': 1}
+        self.assertIs(tune_concurrency(tuning, MiB, 10, 16), tuning)
+        self.assertIs(tune_concurrency(tuning, None, 10, 16), tuning)
+
+if __name__ == '__main__':
+    unittest.main()
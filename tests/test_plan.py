@@ -0,0 +1,115 @@
+import unittest
+import tempfile
+import os
+import io
+import json
+from unittest.mock import patch
+import src.aptly_update.aptly_update as aptly_update
+from src.aptly_update.aptly_update import (compile_plan, check_entries, get_plan, print_plan, build_graph,
+                                           list_mirrors, CliBackend, ApiBackend, History, Plan, Result,
+                                           DEFAULT_SETTINGS)
+
+entries = [{'name': 'bookworm', 'mirrors': ['bookworm-main', 'bookworm-security']},
+           {'name': 'bookworm-security', 'mirrors': ['bookworm-security']}]
+
+mirror_list = """List of mirrors:
+ * [bookworm-main]: http://deb.debian.org/debian/ bookworm [src]
+ * [bookworm-security]: http://security.debian.org/debian-security/ bookworm-security
+"""
+
+mirrors = {'bookworm-main': {'Archive Root URL': "http://deb.debian.org/debian/", 'Distribution': "bookworm"},
+           'bookworm-security': {'Archive Root URL': "http://security.debian.org/debian-security/",
+                                 'Distribution': "bookworm-security"}}
+
+class TestMirrorList(unittest.TestCase):
+    def test_mirror_list(self):
+        with patch.object(aptly_update, 'query_result', lambda argv, debug: Result(True, 0, mirror_list)):
+            self.assertEqual(CliBackend(False).mirror_list().data, mirrors)
+
+    def test_no_aptly(self):
+        # Not being able to ask aptly is one problem, not a missing mirror each.
+        with patch.object(aptly_update.subprocess, 'run', side_effect=FileNotFoundError("No such file: 'aptly'")):
+            listed, problems = list_mirrors(CliBackend(False), False)
+        self.assertIsNone(listed)
+        self.assertEqual(problems, ["could not list aptly's mirrors: aptly returned 127: No such file: 'aptly'"])
+
+    def test_no_server(self):
+        listed, problems = list_mirrors(ApiBackend("http://127.0.0.1:9", False), False)
+        self.assertIsNone(listed)
+        self.assertEqual(len(problems), 1)
+        self.assertTrue(problems[0].startswith("could not list aptly's mirrors: "))
+
+    def test_debug(self):
+        self.assertEqual(list_mirrors(CliBackend(True), True), (None, []))
+
+class TestCheck(unittest.TestCase):
+    def test_good(self):
+        self.assertEqual(check_entries(entries, mirrors), [])
+
+    def test_bad(self):
+        problems = check_entries([{'mirrors': ['bookworm-main']},
+                                  {'name': 'a'},
+                                  {'name': 'b', 'mirrors': ['bookworm-main', 'bookwrom-updates']},
+                                  {'name': 'b', 'mirrors': [], 'plugins': {'vscode': {}}},
+                                  {'name': 'c', 'mirrors': []},
+                                  {'name': 'd', 'mirrors': [], 'plugins': []}], mirrors)
+        self.assertEqual(problems, ["entry 1 has no name",
+                                    "entry a has no list of mirrors",
+                                    "entry b: aptly has no mirror called bookwrom-updates",
+                                    "entry b appears more than once",
+                                    "entry b: plugins should be a list of plugins, each with its parameters",
+                                    "entry c has no mirrors or plugins to publish",
+                                    "entry d has no mirrors or plugins to publish"])
+
+    def test_debug(self):
+        self.assertEqual(check_entries([{'name': 'b', 'mirrors': ['anything']}], None), [])
+
+class TestCompile(unittest.TestCase):
+    def test_compile(self):
+        with patch.object(aptly_update, 'query', lambda argv, debug: self.fail("aptly asked")):
+            plan = compile_plan(entries, False, CliBackend(False), mirrors)
+        steps = [(step['step'], step['name']) for step in plan.steps]
+        self.assertEqual(steps, [('update', 'bookworm-main'), ('snapshot', 'bookworm-main'),
+                                 ('update', 'bookworm-security'), ('snapshot', 'bookworm-security'),
+                                 ('merge', 'bookworm'), ('publish', 'bookworm'),
+                                 ('publish', 'bookworm-security')])
+        self.assertEqual(plan.steps[2]['host'], "security.debian.org")
+        self.assertEqual(plan.steps[6]['deps'], [['snapshot', 'bookworm-security']])
+        nodes = build_graph(entries, True, plan=plan)
+        self.assertEqual(list(nodes), steps)
+        self.assertEqual(nodes[('merge', 'bookworm')].snapshot, "bookworm-" + aptly_update.get_timestamp())
+
+class TestCache(unittest.TestCase):
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            settings = dict(DEFAULT_SETTINGS, plan_file=os.path.join(directory, "plan.json"))
+            first = get_plan("yaml", entries, mirrors, settings, False, CliBackend(False))
+            self.assertTrue(os.path.exists(settings['plan_file']))
+            with patch.object(aptly_update, 'compile_plan', lambda *args: self.fail("compiled again")):
+                again = get_plan("yaml", entries, mirrors, settings, False, CliBackend(False))
+            self.assertEqual(again.steps, first.steps)
+            changed = dict(mirrors, extra={'Archive Root URL': "http://x/", 'Distribution': "x"})
+            self.assertNotEqual(get_plan("yaml", entries, changed, settings, False, CliBackend(False)).key, first.key)
+            self.assertIsNone(Plan.load(settings['plan_file'], first.key))
+            self.assertNotEqual(get_plan("yaml2", entries, mirrors, settings, False, CliBackend(False)).key, first.key)
+
+class TestEstimate(unittest.TestCase):
+    def test_estimate(self):
+        with tempfile.TemporaryDirectory() as directory:
+            history = History(os.path.join(directory, "history.db"))
+            with patch('sys.stdout', new_callable=io.StringIO):
+                nodes = build_graph(entries[:1], True)
+            for node in nodes.values():
+                node.status = 'done'
+                node.started = 100
+                node.ended = 110 if node.kind == 'update' else 101
+            history.record("t", 100, 120, nodes)
+            plan = compile_plan(entries[:1], False, CliBackend(True), mirrors)
+            with patch('sys.stdout', new_callable=io.StringIO) as out:
+                print_plan(plan, history)
+            printed = json.loads(out.getvalue())
+        self.assertEqual(printed['steps'][0]['estimate'], 10)
+        self.assertEqual(printed['estimate'], 10 + 1 + 1 + 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import unittest
+import datetime
+import io
+from unittest.mock import patch
+from src.aptly_update.aptly_update import (compile_plan, run_graph, chain_lengths, next_time, valid_time,
+                                           Node, CliBackend, DEFAULT_SETTINGS)
+
+DAY = 24 * 60 * 60
+
+class TestPlanPriority(unittest.TestCase):
+    def test_inherited(self):
+        entries = [{'name': 'bookworm', 'mirrors': ['bookworm-main', 'bookworm-security']},
+                   {'name': 'security', 'priority': 10, 'mirrors': ['bookworm-security']}]
+        plan = compile_plan(entries, False, CliBackend(False), {'bookworm-main': {}, 'bookworm-security': {}})
+        priority = dict(((step['step'], step['name']), step['priority']) for step in plan.steps)
+        self.assertEqual(priority[('update', 'bookworm-main')], 0)
+        self.assertEqual(priority[('update', 'bookworm-security')], 10)
+        self.assertEqual(priority[('snapshot', 'bookworm-security')], 10)
+        self.assertEqual(priority[('merge', 'bookworm')], 0)
+        self.assertEqual(priority[('publish', 'security')], 10)
+
+def updates(*specs):
+    # Mirror update nodes, each followed by a publish, in the given order, with
+    # (name, priority, estimate) for each.
+    order = []
+    nodes = {}
+    for name, priority, estimate in specs:
+        update = Node(('update', name), 'update', lambda node: order.append(node.key[1]))
+        update.priority = priority
+        update.estimate = estimate
+        publish = Node(('publish', name), 'aptly', lambda node: None, [update])
+        publish.priority = priority
+        nodes[update.key] = update
+        nodes[publish.key] = publish
+    return nodes, order
+
+class TestOrder(unittest.TestCase):
+    def test_priority_first(self):
+        nodes, order = updates(('a', 0, None), ('b', 0, None), ('security', 10, None))
+        run_graph(nodes, dict(DEFAULT_SETTINGS, jobs=1), False)
+        self.assertEqual(order, ['security', 'a', 'b'])
+
+    def test_longest_first(self):
+        nodes, order = updates(('short', 0, 10), ('long', 0, 600), ('unknown', 0, None))
+        run_graph(nodes, dict(DEFAULT_SETTINGS, jobs=1), False)
+        self.assertEqual(order, ['long', 'short', 'unknown'])
+
+    def test_chain_lengths(self):
+        nodes, order = updates(('a', 0, 100))
+        nodes[('publish', 'a')].estimate = 5
+        chain_lengths(nodes)
+        self.assertEqual(nodes[('update', 'a')].remaining, 105)
+
+class TestDeadline(unittest.TestCase):
+    def test_skipped(self):
+        nodes, order = updates(('slow', 0, 2 * DAY), ('important', 1, 2 * DAY), ('quick', 0, 1))
+        with patch('sys.stdout', new_callable=io.StringIO) as out:
+            run_graph(nodes, dict(DEFAULT_SETTINGS, deadline="06:00"), False)
+        self.assertEqual(sorted(order), ['important', 'quick'])
+        self.assertEqual(nodes[('update', 'slow')].status, 'skipped')
+        self.assertEqual(nodes[('publish', 'slow')].status, 'skipped')
+        self.assertEqual(nodes[('publish', 'quick')].status, 'done')
+        self.assertIn("Not published because of the deadline: slow", out.getvalue())
+
+    def test_next_time(self):
+        now = datetime.datetime(2024, 6, 30, 23, 0)
+        self.assertEqual(next_time("06:00", now), datetime.datetime(2024, 7, 1, 6, 0).timestamp())
+        self.assertEqual(next_time("23:30", now), datetime.datetime(2024, 6, 30, 23, 30).timestamp())
+        self.assertEqual(next_time(360, now), datetime.datetime(2024, 7, 1, 6, 0).timestamp())
+
+    def test_valid_time(self):
+        for when in ("06:00", "6:00", "23:59", "0:00", 0, 1439):
+            self.assertTrue(valid_time(when), when)
+        for when in ("24:00", "7:99", "6", "06:00:00", "noon", 1440, -1, True):
+            self.assertFalse(valid_time(when), when)
+
+    def test_passed(self):
+        # An hour ago is taken to be tomorrow, so nothing is skipped, but the run says so.
+        passed = (datetime.datetime.now() - datetime.timedelta(hours=1)).strftime("%H:%M")
+        nodes, order = updates(('slow', 0, 60), ('quick', 0, 1))
+        with patch('sys.stdout', new_callable=io.StringIO) as out:
+            run_graph(nodes, dict(DEFAULT_SETTINGS, deadline=passed), False)
+        self.assertEqual(sorted(order), ['quick', 'slow'])
+        self.assertIn("the deadline " + passed + " has already passed today", out.getvalue())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import unittest
+import tempfile
+import os
+import sys
+from unittest.mock import patch
+import src.aptly_update.aptly_update as aptly_update
+from src.aptly_update.aptly_update import PluginRegistry, check_plugins
+
+plugins = {
+    'regtest_good': "SCHEMA = {'url': str, 'timeout': (int, float)}\nREQUIRED = ('url',)\n"
+                    "def fetch_repo(args):\n    return None\n",
+    'regtest_plain': "def fetch_repo(args):\n    return None\n",
+    'regtest_checked': "SCHEMA = {'items': list}\n"
+                       "def check(args):\n    return ['item ' + str(n) + ' is empty' for n, item in "
+                       "enumerate(args['items'], 1) if not item]\n"
+                       "def fetch_repo(args):\n    return None\n",
+    'regtest_nofetch': "FETCH = None\n",
+    'regtest_broken': "def fetch_repo(args)\n",
+}
+
+class Installed:
+    # Stands in for an importlib.metadata entry point.
+    def __init__(self, mod):
+        self.mod = mod
+        self.loaded = 0
+
+    def load(self):
+        self.loaded += 1
+        return self.mod
+
+class TestRegistry(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        for name, source in plugins.items():
+            with open(os.path.join(self.directory.name, name + ".py"), "w") as plugin:
+                plugin.write(source)
+        self.installed = Installed(type(sys)('regtest_installed'))
+        self.installed.mod.fetch_repo = lambda args: None
+        self.patch = patch.object(aptly_update, 'installed_plugins', lambda: {'regtest_installed': self.installed})
+        self.patch.start()
+        self.registry = PluginRegistry(False, self.directory.name)
+
+    def tearDown(self):
+        self.patch.stop()
+        sys.path.remove(self.directory.name)
+        for name in plugins:
+            sys.modules.pop(name, None)
+        self.directory.cleanup()
+
+    def test_discover(self):
+        self.assertEqual(self.registry.names(), sorted(list(plugins) + ['regtest_installed']))
+
+    def test_cached(self):
+        self.assertIs(self.registry.get('regtest_good'), self.registry.get('regtest_good'))
+        self.registry.get('regtest_installed')
+        self.registry.get('regtest_installed')
+        self.assertEqual(self.installed.loaded, 1)
+
+    def test_valid(self):
+        self.assertEqual(self.registry.validate('regtest_good', {'url': "https://example.com", 'timeout': 60}), [])
+        self.assertEqual(self.registry.validate('regtest_plain', {'anything': [1, 2]}), [])
+
+    def test_invalid(self):
+        problems = self.registry.validate('regtest_good', {'timeout': "60", 'tiemout': 60})
+        self.assertEqual(len(problems), 3)
+        self.assertIn("'url' is required", problems[0])
+        self.assertIn("should be int or float", " ".join(problems))
+        self.assertIn("unknown parameter 'tiemout'", " ".join(problems))
+
+    def test_check(self):
+        self.assertEqual(self.registry.validate('regtest_checked', {'items': ["a", ""]}),
+                         ["plugin regtest_checked: item 2 is empty"])
+        # Not called until the types are right.
+        self.assertEqual(self.registry.validate('regtest_checked', {'items': "a"}),
+                         ["plugin regtest_checked: 'items' should be list"])
+
+    def test_check_plugins(self):
+        entries = [{'name': 'a', 'mirrors': [], 'plugins': [{'regtest_good': {'url': "u"}},
+                                                           {'regtest_nofetch': {}},
+                                                           {'regtest_broken': {}},
+                                                           {'regtest_missing': {}}]},
+                   {'name': 'b', 'mirrors': [], 'plugins': [{'regtest_good': {'other': 1}}]}]
+        problems = check_plugins(entries, self.registry)
+        self.assertEqual(len(problems), 3)
+        self.assertIn("regtest_nofetch has no fetch_repo", problems[0])
+        self.assertIn("regtest_broken could not be loaded", problems[1])
+        self.assertIn("regtest_missing could not be loaded", problems[2])
+
+if __name__ == '__main__':
+    unittest.main()
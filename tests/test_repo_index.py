@@ -0,0 +1,104 @@
+import unittest
+import tempfile
+import tarfile
+import io
+import os
+from unittest.mock import patch
+import src.aptly_update.aptly_update as aptly_update
+from src.aptly_update.aptly_update import RepoIndex, CliBackend, ApiBackend, Result, deb_package
+
+def ar_member(name, data):
+    header = name.ljust(16) + "0".ljust(12) + "0".ljust(6) + "0".ljust(6) + "100644".ljust(8) + str(len(data)).ljust(10) + "`\n"
+    return header.encode() + data + (b"\n" if len(data) % 2 else b"")
+
+def make_deb(filename, package, version, arch="amd64", compression="gz"):
+    control = ("Package: " + package + "\nVersion: " + version + "\nArchitecture: " + arch +
+               "\nDescription: a test\n").encode()
+    tar_bytes = io.BytesIO()
+    with tarfile.open(fileobj=tar_bytes, mode="w:" + compression) as control_tar:
+        info = tarfile.TarInfo("./control")
+        info.size = len(control)
+        control_tar.addfile(info, io.BytesIO(control))
+    with open(filename, "wb") as deb:
+        deb.write(b"!<arch>\n" + ar_member("debian-binary", b"2.0\n") +
+                  ar_member("control.tar." + compression, tar_bytes.getvalue()) +
+                  ar_member("data.tar.gz", b""))
+
+repo_show = """Name: vscode
+Comment: 
+Default Distribution: 
+Default Component: main
+Number of packages: 2
+Packages:
+  code_1.89.0-1714530869_amd64
+  code_1.90.0-1717531825_amd64
+"""
+
+class Backend:
+    def __init__(self):
+        self.shown = []
+        self.added = []
+
+    def repo_packages(self, repo):
+        self.shown.append(repo)
+        return Result(True, 0, data={"code_1.89.0-1714530869_amd64"} if repo == "vscode" else set())
+
+    def repo_add(self, repo, files):
+        self.added.append((repo, [os.path.basename(name) for name in files]))
+        return Result(True, 0)
+
+class TestDebPackage(unittest.TestCase):
+    def test_read(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for compression in ("gz", "xz"):
+                filename = os.path.join(directory, "code." + compression + ".deb")
+                make_deb(filename, "code", "1:1.90.0-1717531825", compression=compression)
+                self.assertEqual(deb_package(filename), "code_1:1.90.0-1717531825_amd64")
+            with open(os.path.join(directory, "bad.deb"), "wb") as bad:
+                bad.write(b"not a deb")
+            self.assertIsNone(deb_package(os.path.join(directory, "bad.deb")))
+            self.assertIsNone(deb_package(os.path.join(directory, "missing.deb")))
+
+class TestRepoPackages(unittest.TestCase):
+    def test_cli(self):
+        with patch.object(aptly_update, 'query', lambda argv, debug: repo_show):
+            self.assertEqual(CliBackend(False).repo_packages("vscode").data,
+                             {"code_1.89.0-1714530869_amd64", "code_1.90.0-1717531825_amd64"})
+
+    def test_api(self):
+        backend = ApiBackend("http://localhost:8080", False)
+        with patch.object(backend, 'request',
+                          lambda *args, **kwargs: Result(True, 200, data=["Pamd64 code 1.90.0-1717531825 abc"])):
+            self.assertEqual(backend.repo_packages("vscode").data, {"code_1.90.0-1717531825_amd64"})
+
+class TestRepoIndex(unittest.TestCase):
+    def test_add(self):
+        backend = Backend()
+        index = RepoIndex(backend)
+        with tempfile.TemporaryDirectory() as directory:
+            old = os.path.join(directory, "code_1.89.deb")
+            new = os.path.join(directory, "code_1.90.deb")
+            make_deb(old, "code", "1.89.0-1714530869")
+            make_deb(new, "code", "1.90.0-1717531825")
+            result = index.add("vscode", [old, new])
+            self.assertEqual(result.data, [new])
+            self.assertEqual(backend.added, [("vscode", ["code_1.90.deb"])])
+            # The repo is not read again, and knows what was added.
+            self.assertEqual(index.add("vscode", [old, new]).data, [])
+            self.assertEqual(backend.shown, ["vscode"])
+            self.assertEqual(len(backend.added), 1)
+            index.add("other", [old])
+            self.assertEqual(backend.shown, ["vscode", "other"])
+
+    def test_failed(self):
+        backend = Backend()
+        backend.repo_add = lambda repo, files: Result(False, 1, "no such repo")
+        index = RepoIndex(backend)
+        with tempfile.TemporaryDirectory() as directory:
+            new = os.path.join(directory, "code_1.90.deb")
+            make_deb(new, "code", "1.90.0-1717531825")
+            self.assertFalse(index.add("vscode", [new]).ok)
+            self.assertNotIn("code_1.90.0-1717531825_amd64", index.packages("vscode"))
+
+if __name__ == '__main__':
+    unittest.main()
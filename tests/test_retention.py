@@ -0,0 +1,113 @@
+import unittest
+import datetime
+import tempfile
+import os
+from unittest.mock import patch
+import src.aptly_update.aptly_update as aptly_update
+from src.aptly_update.aptly_update import expired_snapshots, collect_garbage, freed_size, CliBackend, State, Result
+
+def stamp(days_ago):
+    return (datetime.datetime(2024, 6, 30, 3, 0, 0) - datetime.timedelta(days=days_ago)).strftime("%Y%m%dT%H:%M:%S")
+
+now = datetime.datetime(2024, 6, 30, 3, 0, 0).timestamp()
+names = ["bookworm-main-" + stamp(days) for days in range(10)] + \
+        ["bookworm-" + stamp(days) for days in range(10)] + \
+        ["handmade", "other-" + stamp(9)]
+bases = {'bookworm-main', 'bookworm'}
+
+class TestExpired(unittest.TestCase):
+    def test_keep_last(self):
+        expired = expired_snapshots(names, bases, {'keep_last': 3}, set(), now)
+        self.assertEqual(len(expired), 14)
+        self.assertNotIn("bookworm-main-" + stamp(2), expired)
+        self.assertIn("bookworm-main-" + stamp(3), expired)
+        self.assertNotIn("handmade", expired)
+        self.assertNotIn("other-" + stamp(9), expired)
+
+    def test_keep_days(self):
+        expired = expired_snapshots(names, bases, {'keep_days': 5}, set(), now)
+        self.assertEqual(expired, sorted(["bookworm-main-" + stamp(days) for days in range(5, 10)] +
+                                         ["bookworm-" + stamp(days) for days in range(5, 10)]))
+
+    def test_either_keeps(self):
+        expired = expired_snapshots(names, bases, {'keep_last': 7, 'keep_days': 5}, set(), now)
+        self.assertEqual(len(expired), 6)
+
+    def test_protected(self):
+        protected = {"bookworm-main-" + stamp(9)}
+        expired = expired_snapshots(names, bases, {'keep_last': 1}, protected, now)
+        self.assertNotIn("bookworm-main-" + stamp(9), expired)
+        self.assertIn("bookworm-main-" + stamp(8), expired)
+
+    def test_no_policy(self):
+        self.assertEqual(expired_snapshots(names, bases, {}, set(), now), [])
+
+class TestFreed(unittest.TestCase):
+    def test_freed(self):
+        self.assertEqual(freed_size("Deleting unreferenced files (12)...\nDisk space freed: 1.50 MiB...\n"),
+                         int(1.5 * (1 << 20)))
+        self.assertIsNone(freed_size("Compacting database...\n"))
+
+class TestCollect(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        logfile = os.path.join(self.directory.name, "log")
+        self.patch = patch.object(aptly_update, 'get_logfile', lambda: logfile)
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        self.directory.cleanup()
+
+    def test_collect(self):
+        state = State(None)
+        state.set_mirror('bookworm-main', {'fingerprint': "abc", 'snapshot': "bookworm-main-" + stamp(8)})
+        state.set_publish('bookworm', {'snapshot': "bookworm-" + stamp(0), 'inputs': ["bookworm-main-" + stamp(0)]})
+        published = "bookworm-" + stamp(9)
+        outputs = {("aptly", "snapshot", "list", "-raw"): "\n".join(names),
+                   ("aptly", "publish", "list", "-raw"): ". bookworm\n",
+                   ("aptly", "publish", "show", "bookworm", "."):
+                       "Prefix: .\nDistribution: bookworm\nSources:\n  main: " + published + " [snapshot]\n"}
+        tasks = []
+        def task_run(cmds, debug):
+            tasks.append(cmds)
+            return [Result(True, 0) for cmd in cmds]
+        def run_command(argv, debug, *args):
+            return Result(True, 0, "Disk space freed: 2.00 GiB...\n")
+        with patch.object(aptly_update, 'query', lambda argv, debug: outputs.get(tuple(argv), "")), \
+             patch.object(aptly_update, 'task_run', task_run), \
+             patch.object(aptly_update, 'run_command', run_command), \
+             patch.object(aptly_update.time, 'time', lambda: now), \
+             patch('builtins.print') as printed:
+            collect_garbage({}, state, CliBackend(False), {'keep_last': 2}, False)
+        self.assertEqual(len(tasks), 1)
+        dropped = [cmd[-1] for cmd in tasks[0]]
+        self.assertTrue(all(cmd[:4] == ["aptly", "snapshot", "drop", "-force"] for cmd in tasks[0]))
+        self.assertNotIn(published, dropped)
+        self.assertNotIn("bookworm-main-" + stamp(8), dropped)
+        self.assertNotIn("bookworm-main-" + stamp(1), dropped)
+        self.assertEqual(len(dropped), 14)
+        printed.assert_called_with("Retention: dropped 14 of 14 snapshots and freed 2.00 GiB")
+
+    def test_plugin_inputs(self):
+        # The repo snapshots a plugin merged its own from are expired by their
+        # own name, and those it is using are kept.
+        state = State(None)
+        state.set_plugin('http_deb', {'snapshot': "http_deb-" + stamp(3), 'inputs': ["zoom-" + stamp(3)]})
+        snapshots = ["zoom-" + stamp(days) for days in range(5)] + ["http_deb-" + stamp(3), "other-" + stamp(9)]
+        tasks = []
+        def task_run(cmds, debug):
+            tasks.append(cmds)
+            return [Result(True, 0) for cmd in cmds]
+        with patch.object(aptly_update, 'query',
+                          lambda argv, debug: "\n".join(snapshots) if argv[1] == "snapshot" else ""), \
+             patch.object(aptly_update, 'task_run', task_run), \
+             patch.object(aptly_update, 'run_command', lambda argv, debug, *args: Result(True, 0, "")), \
+             patch.object(aptly_update.time, 'time', lambda: now), \
+             patch('builtins.print'):
+            collect_garbage({}, state, CliBackend(False), {'keep_last': 1}, False)
+        self.assertEqual(sorted(cmd[-1] for cmd in tasks[0]),
+                         ["zoom-" + stamp(4), "zoom-" + stamp(2), "zoom-" + stamp(1)])
+
+if __name__ == '__main__':
+    unittest.main()
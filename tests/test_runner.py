@@ -0,0 +1,113 @@
+import unittest
+import tempfile
+import os
+import sys
+import threading
+import time
+from unittest.mock import patch
+import src.aptly_update.aptly_update as aptly_update
+from src.aptly_update.aptly_update import run_command, run_graph, Node, CliBackend, Result, DEFAULT_SETTINGS
+
+class TestRunCommand(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.logfile = os.path.join(self.directory.name, "log")
+        self.patch = patch.object(aptly_update, 'get_logfile', lambda: self.logfile)
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        self.directory.cleanup()
+
+    def test_output(self):
+        result = run_command([sys.executable, "-c", "print('x' * 99)"], False)
+        self.assertTrue(result.ok)
+        self.assertEqual(result.status, 0)
+        self.assertEqual(result.logged, 100)
+        self.assertGreaterEqual(result.wall, 0)
+        with open(self.logfile) as log:
+            self.assertIn('x' * 99, log.read())
+
+    def test_exit_code(self):
+        result = run_command([sys.executable, "-c", "import sys; print('broken'); sys.exit(3)"], False)
+        self.assertFalse(result.ok)
+        self.assertEqual(result.status, 3)
+        self.assertIn("broken", result.error())
+
+    def test_timeout(self):
+        result = run_command([sys.executable, "-c", "import time; time.sleep(30)"], False, timeout=0.5)
+        self.assertFalse(result.ok)
+        self.assertTrue(result.timed_out)
+        self.assertLess(result.wall, 10)
+
+    def test_retries(self):
+        result = run_command([sys.executable, "-c", "import sys; sys.exit(1)"], False, retries=2, backoff=0)
+        self.assertEqual(result.attempts, 3)
+
+    def test_missing(self):
+        result = run_command(["no-such-aptly"], False)
+        self.assertFalse(result.ok)
+
+    def test_debug(self):
+        result = run_command(["aptly", "mirror", "update", "bookworm-main"], True)
+        self.assertTrue(result.ok)
+
+class TestJobs(unittest.TestCase):
+    def test_limits(self):
+        # Five updates from one host and three from another, with jobs 3 and
+        # jobs_per_host 2.
+        lock = threading.Lock()
+        running = []
+        most = {'all': 0, 'a': 0, 'b': 0}
+        def update(node):
+            with lock:
+                running.append(node.host)
+                most['all'] = max(most['all'], len(running))
+                most[node.host] = max(most[node.host], running.count(node.host))
+            time.sleep(0.05)
+            with lock:
+                running.remove(node.host)
+        nodes = {}
+        for number, host in enumerate("aaaaabbb"):
+            node = Node(('update', 'mirror' + str(number)), 'update', update, host=host)
+            nodes[node.key] = node
+        run_graph(nodes, dict(DEFAULT_SETTINGS, jobs=3, jobs_per_host=2), False)
+        self.assertTrue(all(node.status == 'done' for node in nodes.values()))
+        self.assertEqual(most['all'], 3)
+        self.assertEqual(most['a'], 2)
+        self.assertLessEqual(most['b'], 2)
+
+class TestLocked(unittest.TestCase):
+    def test_locked(self):
+        locked = Result(False, 1, "ERROR: can't open database: resource temporarily unavailable\n")
+        results = [locked, locked, Result(True, 0)]
+        backend = CliBackend(False)
+        with patch.object(aptly_update, 'run_command', lambda *args: results.pop(0)), \
+             patch.object(aptly_update.time, 'sleep'), \
+             patch('builtins.open'):
+            self.assertTrue(backend.run(["aptly", "snapshot", "list"]).ok)
+        self.assertEqual(results, [])
+
+    def test_settings(self):
+        # The tries and the wait come from the settings, and the wait is not
+        # spent holding the lock the other aptly commands need.
+        locked = Result(False, 1, "ERROR: can't open database: resource temporarily unavailable\n")
+        results = [locked, locked, locked]
+        backend = CliBackend(False, settings=dict(DEFAULT_SETTINGS, locked_retries=1, locked_wait=7))
+        waits = []
+        def sleep(seconds):
+            waits.append((seconds, backend.lock.locked()))
+        with patch.object(aptly_update, 'run_command', lambda *args: results.pop(0)), \
+             patch.object(aptly_update.time, 'sleep', sleep), \
+             patch('builtins.open'):
+            self.assertFalse(backend.run(["aptly", "snapshot", "list"]).ok)
+        self.assertEqual(waits, [(7, False)])
+        self.assertEqual(len(results), 1)
+
+    def test_other_failure(self):
+        results = [Result(False, 1, "ERROR: mirror not found\n"), Result(True, 0)]
+        with patch.object(aptly_update, 'run_command', lambda *args: results.pop(0)):
+            self.assertFalse(CliBackend(False).run(["aptly", "mirror", "update", "x"]).ok)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+import tempfile
+import os
+from unittest.mock import patch
+import src.aptly_update.aptly_update as aptly_update
+from src.aptly_update.aptly_update import State, build_graph, run_graph, DEFAULT_SETTINGS
+
+entries = [{'name': 'bookworm',
+            'mirrors': ['bookworm-main', 'bookworm-security']}]
+
+class TestStateFile(unittest.TestCase):
+    def test_state_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "state.json")
+            state = State(path)
+            self.assertEqual(state.mirror('bookworm-main'), {})
+            state.set_mirror('bookworm-main', {'fingerprint': 'abc', 'snapshot': 'bookworm-main-1'})
+            state.save(path)
+            self.assertEqual(State(path).mirror('bookworm-main')['snapshot'], 'bookworm-main-1')
+
+def run(state, fingerprints):
+    cmds = []
+    def run_command(argv, debug, *args):
+        cmds.append(" ".join(argv))
+        return aptly_update.Result(True, 0)
+    with patch.object(aptly_update, 'run_command', run_command), \
+         patch.object(aptly_update, 'fingerprint', lambda info, debug: fingerprints[info['Name']]), \
+         patch.object(aptly_update, 'mirror_info', lambda mirror, debug: {'Name': mirror}):
+        run_graph(build_graph(entries, False, state), DEFAULT_SETTINGS, False)
+    return cmds
+
+class TestUnchanged(unittest.TestCase):
+    def test_unchanged(self):
+        state = State(None)
+        cmds = run(state, {'bookworm-main': 'a', 'bookworm-security': 'b'})
+        self.assertEqual(len([cmd for cmd in cmds if 'publish snapshot' in cmd]), 1)
+        cmds = run(state, {'bookworm-main': 'a', 'bookworm-security': 'b'})
+        self.assertEqual(cmds, [])
+
+    def test_one_changed(self):
+        state = State(None)
+        run(state, {'bookworm-main': 'a', 'bookworm-security': 'b'})
+        last = state.mirror('bookworm-main')['snapshot']
+        cmds = run(state, {'bookworm-main': 'a', 'bookworm-security': 'c'})
+        self.assertFalse(any('mirror update bookworm-main' in cmd for cmd in cmds))
+        self.assertTrue(any('mirror update bookworm-security' in cmd for cmd in cmds))
+        merge = [cmd for cmd in cmds if 'snapshot merge' in cmd][0]
+        self.assertIn(last, merge)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import unittest
+import tempfile
+import os
+import hashlib
+from unittest.mock import patch
+from src.aptly_update.aptly_update import DownloadStore
+
+def write(path, data):
+    with open(path, "wb") as out:
+        out.write(data)
+    return hashlib.sha256(data).hexdigest()
+
+class TestStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store_path = os.path.join(self.directory.name, "store")
+        self.path = os.path.join(self.directory.name, "vscode")
+        os.mkdir(self.path)
+        self.store = DownloadStore({'path': self.store_path}, False)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def test_dedup(self):
+        digest = write(self.file("code_1.deb"), b"one")
+        self.assertEqual(self.store.add(self.file("code_1.deb"), "vscode"), digest)
+        # The same file under another name is linked to the one already stored.
+        write(self.file("code_1-renamed.deb"), b"one")
+        self.assertEqual(self.store.add(self.file("code_1-renamed.deb"), "vscode"), digest)
+        self.assertEqual(os.listdir(self.store_path), [digest])
+        self.assertTrue(os.path.samefile(self.file("code_1.deb"), self.file("code_1-renamed.deb")))
+        self.assertEqual(len(self.store.files[digest]['links']), 2)
+
+    def test_link(self):
+        digest = write(self.file("code_1.deb"), b"one")
+        self.store.add(self.file("code_1.deb"), "vscode")
+        self.assertTrue(self.store.link(digest.upper(), self.file("again.deb"), "vscode"))
+        with open(self.file("again.deb"), "rb") as linked:
+            self.assertEqual(linked.read(), b"one")
+        self.assertFalse(self.store.link("0" * 64, self.file("missing.deb"), "vscode"))
+        self.assertFalse(os.path.exists(self.file("missing.deb")))
+
+    def test_in_repo(self):
+        digest = write(self.file("code_1.deb"), b"one")
+        self.store.add(self.file("code_1.deb"), "vscode")
+        self.assertFalse(self.store.in_repo(digest, "vscode"))
+        self.store.set_in_repo(digest, "vscode")
+        self.store.save()
+        again = DownloadStore({'path': self.store_path}, False)
+        self.assertTrue(again.in_repo(digest, "vscode"))
+        self.assertFalse(again.in_repo(digest, "chrome"))
+
+    def versions(self, settings, count):
+        # Stores 'count' versions of one package from earlier runs, oldest
+        # first, and returns the store as the next run sees it.
+        digests = []
+        with patch('time.time', lambda: 1000):
+            store = DownloadStore(settings, False)
+            for version in range(count):
+                digests.append(write(self.file("code_" + str(version) + ".deb"), b"x" * 1024 * 1024 * (version + 1)))
+                store.add(self.file("code_" + str(version) + ".deb"), "vscode")
+                store.files[digests[-1]]['used'] = version
+            store.save()
+        return DownloadStore(settings, False), digests
+
+    def test_keep_last(self):
+        store, digests = self.versions({'path': self.store_path, 'keep_last': 2}, 4)
+        self.assertEqual(store.expired(), [digests[1], digests[0]])
+        with patch('builtins.print') as printed:
+            store.prune()
+        printed.assert_called_with("Download store: removed 2 files and freed 3.00 MiB")
+        self.assertEqual(sorted(os.listdir(self.path)), ["code_2.deb", "code_3.deb"])
+        self.assertEqual(sorted(os.listdir(self.store_path)), sorted(digests[2:] + ["index.json"]))
+
+    def test_max_size(self):
+        # 1 + 2 + 3 + 4 MiB, of which the newest 7 MiB fit.
+        store, digests = self.versions({'path': self.store_path, 'max_size': 7}, 4)
+        self.assertEqual(store.expired(), [digests[1], digests[0]])
+
+    def test_used_kept(self):
+        store, digests = self.versions({'path': self.store_path, 'keep_last': 1}, 3)
+        # Both used in this run, so kept, though keep_last would keep one.
+        store.link(digests[0], self.file("code_0.deb"), "vscode")
+        store.link(digests[1], self.file("code_1.deb"), "vscode")
+        self.assertEqual(store.expired(), [digests[2]])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+from unittest.mock import patch
+import src.aptly_update.aptly_update as aptly_update
+from src.aptly_update.aptly_update import build_graph, run_graph, DEFAULT_SETTINGS
+
+entries = [{'name': 'bookworm',
+            'mirrors': ['bookworm-main']}]
+
+def run(published, settings=DEFAULT_SETTINGS, switch_rc=0):
+    cmds = []
+    def run_command(argv, debug, *args):
+        cmd = " ".join(argv)
+        cmds.append(cmd)
+        status = switch_rc if 'publish switch' in cmd else 0
+        return aptly_update.Result(status == 0, status)
+    def query(argv, debug):
+        return ". " + published if published else ""
+    with patch.object(aptly_update, 'run_command', run_command), \
+         patch.object(aptly_update, 'query', query):
+        run_graph(build_graph(entries, False, None, settings), settings, False)
+    return cmds
+
+class TestSwitch(unittest.TestCase):
+    def test_switch(self):
+        cmds = run("bookworm")
+        self.assertTrue(any(cmd.startswith("aptly publish switch bookworm bookworm-main-") for cmd in cmds))
+        self.assertFalse(any('publish drop' in cmd for cmd in cmds))
+
+    def test_first_publication(self):
+        cmds = run(None)
+        self.assertFalse(any('publish switch' in cmd for cmd in cmds))
+        self.assertTrue(any('publish drop bookworm' in cmd for cmd in cmds))
+        self.assertTrue(any('publish snapshot -distribution=bookworm' in cmd for cmd in cmds))
+
+    def test_switch_fails(self):
+        cmds = run("bookworm", switch_rc=1)
+        self.assertTrue(any('publish snapshot -distribution=bookworm' in cmd for cmd in cmds))
+
+    def test_drop_mode(self):
+        settings = dict(DEFAULT_SETTINGS, publish_mode='drop')
+        cmds = run("bookworm", settings)
+        self.assertFalse(any('publish switch' in cmd for cmd in cmds))
+        self.assertTrue(any('publish drop bookworm' in cmd for cmd in cmds))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import unittest
+import types
+import tempfile
+import threading
+import json
+import os
+from unittest.mock import Mock, patch
+from src.aptly_update.aptly_update import Trace, build_graph, run_graph, Result, DEFAULT_SETTINGS
+import src.aptly_update.aptly_update as aptly_update
+
+def spans(trace):
+    return [event for event in trace.events if event['ph'] == 'X']
+
+class TestTrace(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "trace.json")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_nested(self):
+        trace = Trace(self.path)
+        with trace.span("run graph"):
+            with trace.span("update:bookworm-main", 'update', mirror="bookworm-main"):
+                pass
+        inner, outer = spans(trace)
+        self.assertEqual((inner['name'], inner['cat'], inner['args']), ("update:bookworm-main", 'update',
+                                                                        {'mirror': "bookworm-main"}))
+        self.assertEqual(inner['tid'], outer['tid'])
+        self.assertLessEqual(outer['ts'], inner['ts'])
+        self.assertGreaterEqual(outer['ts'] + outer['dur'], inner['ts'] + inner['dur'])
+
+    def test_lanes(self):
+        trace = Trace(self.path)
+        with trace.span("main"):
+            pass
+        # Coroutines all run in one thread, so they are given lanes by name.
+        with trace.span("async", lane="plugin:vscode"):
+            pass
+        names = dict((event['tid'], event['args']['name']) for event in trace.events if event['ph'] == 'M')
+        self.assertEqual(sorted(names.values()), ["MainThread", "plugin:vscode"])
+        self.assertNotEqual(spans(trace)[0]['tid'], spans(trace)[-1]['tid'])
+
+    def test_thread(self):
+        trace = Trace(self.path)
+        def work():
+            with trace.span("download"):
+                pass
+        worker = threading.Thread(target=work, name="plugin_0")
+        worker.start()
+        worker.join()
+        lane = [event for event in trace.events if event['ph'] == 'M'][0]
+        self.assertEqual(lane['args']['name'], "plugin_0")
+        self.assertEqual(spans(trace)[0]['tid'], lane['tid'])
+
+    def test_error(self):
+        trace = Trace(self.path)
+        with self.assertRaises(ValueError):
+            with trace.span("publish"):
+                raise ValueError("no")
+        self.assertEqual(spans(trace)[0]['args'], {'error': "ValueError('no')"})
+
+    def test_save(self):
+        trace = Trace(self.path)
+        with trace.span("plan"):
+            pass
+        trace.save()
+        with open(self.path) as trace_file:
+            saved = json.load(trace_file)
+        self.assertEqual(saved['traceEvents'][0]['name'], 'process_name')
+        self.assertEqual([event['name'] for event in saved['traceEvents'] if event['ph'] == 'X'], ["plan"])
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+
+    def test_off(self):
+        trace = Trace(None)
+        with trace.span("plan"):
+            pass
+        trace.save()
+        self.assertEqual(trace.events, [])
+        self.assertFalse(os.path.exists(self.path))
+
+class TestGraphTrace(unittest.TestCase):
+    def test_steps(self):
+        mod = types.ModuleType("async_plugin")
+        async def fetch_repo(ctx):
+            with ctx.span("HEAD"):
+                pass
+            return {'changed': True}
+        mod.fetch_repo = fetch_repo
+        entries = [{'name': 'vendor', 'mirrors': [], 'plugins': [{'async_plugin': {}}]}]
+        backend = Mock()
+        backend.snapshot_from_repo.return_value = Result(True, 0)
+        backend.publish_list.return_value = Result(True, 0, data=[])
+        trace = Trace("unused")
+        with tempfile.TemporaryDirectory() as directory, \
+             patch.object(aptly_update, 'get_logfile', lambda: os.path.join(directory, "log")), \
+             patch.object(aptly_update, 'import_module', lambda name, debug: mod):
+            nodes = build_graph(entries, True, None, DEFAULT_SETTINGS, backend)
+            for node in nodes.values():
+                node.trace = trace
+            run_graph(nodes, DEFAULT_SETTINGS, True)
+        found = dict((event['name'], event) for event in spans(trace))
+        self.assertEqual(set(found), {"plugin:async_plugin", "HEAD", "publish:vendor", "aptly publish drop",
+                                      "aptly publish snapshot"})
+        self.assertEqual(found["HEAD"]['tid'], found["plugin:async_plugin"]['tid'])
+        self.assertEqual(found["aptly publish drop"]['tid'], found["publish:vendor"]['tid'])
+
+if __name__ == '__main__':
+    unittest.main()
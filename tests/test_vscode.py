@@ -8,6 +8,11 @@ import re
 from src.aptly_update.aptly_update import import_module
 import sys
 import platform
+import tempfile
+import threading
+import hashlib
+import socket
+from http.server import HTTPServer, BaseHTTPRequestHandler
 # import requests
 
 SEPARATOR = "\\" if platform.system() == "Windows" else "/" # Because I'm developing on Windows
@@ -84,7 +89,123 @@ class TestCheckFile(unittest.TestCase):
 class TestGetFile(unittest.TestCase):
     def test_get_file(self):
         rtn = src.aptly_update.plugins.vscode.get_file("http://www.example.com", "test.file", 600, True)
-        self.assertEqual(rtn, "curl --no-progress-meter --max-time 600 --write-out %{exitcode} --output test.file 'http://www.example.com' 2>&1")
+        self.assertEqual(rtn, "GET http://www.example.com -> test.file")
+
+DEB = b"!<arch>\n" + bytes(range(256)) * 1024
+
+class FlakyServer(BaseHTTPRequestHandler):
+# Serves DEB, but drops the connection half way through the first request.
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        start = 0
+        if 'Range' in self.headers:
+            start = int(re.match(r'bytes=(\d+)-', self.headers['Range']).group(1))
+        FlakyServer.requests.append(start)
+        self.send_response(206 if start else 200)
+        self.send_header('Content-Length', str(len(DEB) - start))
+        self.end_headers()
+        if len(FlakyServer.requests) == 1:
+            self.wfile.write(DEB[:len(DEB) // 2])
+            self.wfile.flush()
+            self.connection.shutdown(socket.SHUT_RDWR)
+        else:
+            self.wfile.write(DEB[start:])
+
+class TestResume(unittest.TestCase):
+    def test_resume(self):
+        server = HTTPServer(('127.0.0.1', 0), FlakyServer)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:" + str(server.server_port) + "/code.deb"
+        with tempfile.TemporaryDirectory() as directory:
+            fqfile = os.path.join(directory, "code.deb")
+            rtn = src.aptly_update.plugins.vscode.get_file(url, fqfile, 10, False, len(DEB),
+                                                           hashlib.sha256(DEB).hexdigest())
+            self.assertEqual(rtn, "")
+            self.assertEqual(FlakyServer.requests[0], 0)
+            self.assertGreater(FlakyServer.requests[1], 0)
+            with open(fqfile, "rb") as deb:
+                self.assertEqual(deb.read(), DEB)
+            self.assertFalse(exists(fqfile + ".part"))
+        server.shutdown()
+
+class TestBadChecksum(unittest.TestCase):
+    def test_bad_checksum(self):
+        with tempfile.TemporaryDirectory() as directory:
+            fqfile = os.path.join(directory, "code.deb")
+            with open(fqfile, "wb") as deb:
+                deb.write(DEB)
+            rtn = src.aptly_update.plugins.vscode.verify_file(fqfile, len(DEB), "0" * 64)
+            self.assertIn("Checksum mismatch", rtn)
+            rtn = src.aptly_update.plugins.vscode.verify_file(fqfile, len(DEB) + 1, None)
+            self.assertIn("Expected", rtn)
+
+class EtagServer(BaseHTTPRequestHandler):
+# Serves DEB as code_1.deb with an ETag, answering 304 when it matches.
+    def log_message(self, *args):
+        pass
+
+    def headers_for(self, body):
+        if self.headers.get('If-None-Match') == '"1"':
+            self.send_response(304)
+            self.end_headers()
+            return False
+        self.send_response(200)
+        self.send_header('ETag', '"1"')
+        self.send_header('Content-Disposition', 'attachment; filename=code_1.deb; filename*=UTF-8\'\'code_1.deb')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        return True
+
+    def do_HEAD(self):
+        self.headers_for(DEB)
+
+    def do_GET(self):
+        if self.headers_for(DEB):
+            self.wfile.write(DEB)
+
+class TestConditional(unittest.TestCase):
+    def test_conditional(self):
+        server = HTTPServer(('127.0.0.1', 0), EtagServer)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        with tempfile.TemporaryDirectory() as directory:
+            backend = Mock()
+            args = {'url': "http://127.0.0.1:" + str(server.server_port) + "/download",
+                    'path': directory, 'timeout': 10, 'debug': False,
+                    'timestamp': "20240601T23:25:00", 'logfile': "log", 'backend': backend}
+            rtn = src.aptly_update.plugins.vscode.fetch_repo(dict(args))
+            self.assertEqual(rtn['snapshot'], "vscode-20240601T23:25:00")
+            self.assertTrue(rtn['changed'])
+            self.assertEqual(backend.repo_add.call_count, 1)
+            args['timestamp'] = "20240602T23:25:00"
+            rtn = src.aptly_update.plugins.vscode.fetch_repo(dict(args))
+            self.assertEqual(rtn['snapshot'], "vscode-20240601T23:25:00")
+            self.assertFalse(rtn['changed'])
+            self.assertEqual(backend.repo_add.call_count, 1)
+        server.shutdown()
+
+    def test_missing(self):
+        # A 304 for a file that has since been deleted downloads it again.
+        server = HTTPServer(('127.0.0.1', 0), EtagServer)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        with tempfile.TemporaryDirectory() as directory:
+            backend = Mock()
+            args = {'url': "http://127.0.0.1:" + str(server.server_port) + "/download",
+                    'path': directory, 'timeout': 10, 'debug': False,
+                    'timestamp': "20240601T23:25:00", 'logfile': "log", 'backend': backend}
+            src.aptly_update.plugins.vscode.fetch_repo(dict(args))
+            os.remove(os.path.join(directory, "code_1.deb"))
+            for timestamp in ("20240602T23:25:00", "20240603T23:25:00"):
+                args['timestamp'] = timestamp
+                rtn = src.aptly_update.plugins.vscode.fetch_repo(dict(args))
+                self.assertEqual(rtn['snapshot'], "vscode-20240602T23:25:00")
+            with open(os.path.join(directory, "code_1.deb"), "rb") as deb:
+                self.assertEqual(deb.read(), DEB)
+            self.assertEqual(backend.repo_add.call_count, 2)
+        server.shutdown()
 
 yaml_vscode = """
 - 